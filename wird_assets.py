@@ -0,0 +1,195 @@
+"""إنتاج نسخ مضغوطة من الصور مناسبة للرفع إلى تيليجرام
+
+تيليجرام يعيد ضغط الصور المرسلة ويصغّرها إلى 1280 بكسل للضلع الأطول، فرفع
+الصور بحجمها الأصلي يستهلك وقت الرفع وحجمه بلا فائدة. هذا الأمر يُشغَّل وقت
+البناء (يحتاج Pillow) وينتج نسخة JPEG محدودة الحجم لكل صورة تحت images/
+في images_optimized/ مع فهرس manifest.json ببصمة الأصل والنسخة. يقرأ البوت
+الفهرس ويرسل النسخة المضغوطة فقط إذا طابقت بصمتها الأصل الحالي:
+
+    pip install Pillow
+    python wird_assets.py --max-side 1280 --quality 85 --max-kb 1024
+    python wird_assets.py --report
+"""
+import os
+import sys
+import json
+import glob
+import hashlib
+import argparse
+from pathlib import Path
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+IMAGES_PATH = Path("images")
+OPTIMIZED_PATH = Path(os.environ.get("OPTIMIZED_PATH", "images_optimized"))
+OPTIMIZED_MANIFEST = OPTIMIZED_PATH / "manifest.json"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+MANIFEST_VERSION = 1
+
+# أقل جودة مسموحة عند تصغير الملف ليدخل تحت الحد
+MIN_QUALITY = 60
+QUALITY_STEP = 5
+
+# البث -> الصور التي يرفعها (الورد اليومي يرفع المصحف كاملاً على مدى الختمة)
+BROADCASTS = {
+    'morning_azkar': ['azkar/morning_azkar.*'],
+    'evening_azkar': ['azkar/evening_azkar.*'],
+    'mulk': ['azkar/surah_mulk.*'],
+    'bakarah': ['bakarah_qiyam/*'],
+    'daily_wird': ['quran_pages/*'],
+}
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest() -> dict:
+    try:
+        with open(OPTIMIZED_MANIFEST, encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'version': MANIFEST_VERSION, 'settings': {}, 'assets': {}}
+
+def save_manifest(manifest: dict):
+    OPTIMIZED_PATH.mkdir(parents=True, exist_ok=True)
+    temp = OPTIMIZED_MANIFEST.with_suffix('.tmp')
+    with open(temp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(temp, OPTIMIZED_MANIFEST)
+
+def source_images() -> list:
+    return sorted(path for path in IMAGES_PATH.rglob('*') if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS)
+
+def variant_path(source: Path) -> Path:
+    return OPTIMIZED_PATH / source.relative_to(IMAGES_PATH).with_suffix('.jpg')
+
+# ======================== الضغط ========================
+def encode_jpeg(image, quality: int, target: Path):
+    image.save(target, 'JPEG', quality=quality, optimize=True, progressive=True)
+
+def optimize_image(source: Path, target: Path, max_side: int, quality: int, max_bytes: int) -> int:
+    """حفظ نسخة JPEG بضلع أطول لا يتجاوز max_side وحجم لا يتجاوز max_bytes إن أمكن"""
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        target.parent.mkdir(parents=True, exist_ok=True)
+        encode_jpeg(image, quality, target)
+        while target.stat().st_size > max_bytes and quality - QUALITY_STEP >= MIN_QUALITY:
+            quality -= QUALITY_STEP
+            encode_jpeg(image, quality, target)
+    return quality
+
+def build(args) -> dict:
+    if Image is None:
+        sys.exit("Pillow غير مثبّت: pip install Pillow")
+
+    settings = {'max_side': args.max_side, 'quality': args.quality, 'max_bytes': args.max_kb * 1024}
+    manifest = load_manifest()
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('settings') != settings:
+        manifest = {'version': MANIFEST_VERSION, 'settings': settings, 'assets': {}}
+    previous = manifest['assets']
+    assets = {}
+    counts = {'optimized': 0, 'unchanged': 0, 'kept_original': 0}
+
+    for source in source_images():
+        key = source.as_posix()
+        source_size = source.stat().st_size
+        source_hash = file_sha256(source)
+        target = variant_path(source)
+        record = previous.get(key)
+
+        if not args.force and record and record['source_hash'] == source_hash and target.exists() and file_sha256(target) == record['hash']:
+            assets[key] = record
+            counts['unchanged'] += 1
+            continue
+
+        quality = optimize_image(source, target, args.max_side, args.quality, settings['max_bytes'])
+        size = target.stat().st_size
+        if size >= source_size:
+            # الأصل أصغر من النسخة: يبقى البوت على الأصل
+            target.unlink()
+            counts['kept_original'] += 1
+            continue
+
+        assets[key] = {
+            'path': target.as_posix(),
+            'size': size,
+            'hash': file_sha256(target),
+            'quality': quality,
+            'source_size': source_size,
+            'source_hash': source_hash,
+        }
+        counts['optimized'] += 1
+
+    # حذف نسخ الصور التي لم تعد موجودة
+    for key, record in previous.items():
+        if key not in assets and Path(record['path']).exists():
+            Path(record['path']).unlink()
+
+    manifest['assets'] = assets
+    save_manifest(manifest)
+    return counts
+
+# ======================== التقرير ========================
+def summarize(paths: list, assets: dict) -> dict:
+    original = optimized = 0
+    for path in paths:
+        size = path.stat().st_size
+        record = assets.get(path.as_posix())
+        original += size
+        optimized += record['size'] if record else size
+    return {
+        'files': len(paths),
+        'original_bytes': original,
+        'upload_bytes': optimized,
+        'saved_bytes': original - optimized,
+        'saved_percent': round(100 * (original - optimized) / original, 1) if original else 0.0,
+    }
+
+def report() -> dict:
+    """التوفير الكلي، وتوفير الرفع لكل بث (كل ملف يُرفع مرة واحدة ثم يُرسل بـ file_id)"""
+    assets = load_manifest()['assets']
+    broadcasts = {}
+    for name, patterns in BROADCASTS.items():
+        paths = sorted({
+            Path(match) for pattern in patterns for match in glob.glob(str(IMAGES_PATH / pattern))
+            if Path(match).suffix.lower() in IMAGE_EXTENSIONS
+        })
+        broadcasts[name] = summarize(paths, assets)
+
+    wird = broadcasts['daily_wird']
+    if wird['files']:
+        wird['saved_bytes_per_page'] = wird['saved_bytes'] // wird['files']
+    return {'total': summarize(source_images(), assets), 'broadcasts': broadcasts}
+
+def main():
+    parser = argparse.ArgumentParser(description='إنتاج نسخ مضغوطة من الصور للرفع إلى تيليجرام')
+    parser.add_argument('--max-side', type=int, default=1280, help='أقصى طول للضلع الأطول بالبكسل')
+    parser.add_argument('--quality', type=int, default=85, help='جودة JPEG المبدئية')
+    parser.add_argument('--max-kb', type=int, default=1024, help='الحد الأعلى لحجم النسخة بالكيلوبايت')
+    parser.add_argument('--force', action='store_true', help='إعادة إنتاج كل النسخ')
+    parser.add_argument('--report', action='store_true', help='طباعة التوفير فقط بدون إنتاج')
+    args = parser.parse_args()
+
+    output = {}
+    if not args.report:
+        output['build'] = build(args)
+    output.update(report())
+    print(json.dumps(output, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
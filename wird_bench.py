@@ -0,0 +1,503 @@
+"""قياس أداء البث على قاعدة بيانات اصطناعية وخادم محلي يحاكي Bot API
+
+يشغّل دوال المهام الحقيقية في wird_bot (أذكار الصباح، الورد اليومي، سورة البقرة...)
+ضد خادم وهمي بزمن استجابة ونسب أخطاء 429 و Forbidden قابلة للضبط، ويطبع النتائج
+بصيغة JSON لمقارنة الإصدارات:
+
+    python wird_bench.py --users 10000 --rate 1000 --latency 0.05 --output bench.json
+    python wird_bench.py --scenarios --updates 300 --update-chats 50 --update-concurrency 1
+    python wird_bench.py --scenarios --prayer-calendar
+    python wird_bench.py --users 1800 --scenarios morning_azkar --window 1 --peak-rate 40
+    python wird_bench.py --users 600 --scenarios --crash-resume 7.5 --rate 20
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import calendar
+import asyncio
+import signal
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from types import SimpleNamespace
+
+# النوع -> (اسم المهمة، بيانات المهمة)
+SCENARIOS = {
+    'morning_azkar': ('morning_azkar_tz3', {'tz': 3}),
+    'daily_wird': ('daily_wird_09:00_tz3', {'quran_time': '09:00', 'tz': 3}),
+    'bakarah': ('bakarah_Makkah_Saudi Arabia_Fajr', {'prayer': 'Fajr', 'city': 'Makkah', 'country': 'Saudi Arabia', 'tz': 3}),
+    'random_dhikr': ('random_dhikr_morning_tz3', {'tz': 3}),
+}
+
+# السيناريوهات التي تُوزع على نافذة التوصيل مع --window (اسم السيناريو هو اسم البث)
+WINDOWED_SCENARIOS = ('morning_azkar', 'random_dhikr')
+
+# تسلسل النقرات الذي ترسله كل محادثة في اختبار الدفعة (pages_ ينتظر ثانية قبل عرض الإعدادات)
+CALLBACK_BURST = ('settings', 'set_pages', 'pages_3', 'set_notifications', 'toggle_kahf', 'back_main')
+
+# ======================== خادم Bot API الوهمي ========================
+class FakeBotAPI:
+    """يحاكي طلبات الإرسال مع تأخير وأخطاء 429 و Forbidden بنسب محددة"""
+
+    def __init__(self, latency: float, jitter: float, rate_429: float, forbidden_rate: float, retry_after: int, seed: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.forbidden_rate = forbidden_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.message_id = 0
+        self.stats = {'requests': 0, 'bytes_uploaded': 0, 'retry_after': 0, 'forbidden': 0, 'methods': {}, 'aladhan': 0, 'connections': 0, 'per_second': {}}
+        # عدد الطلبات التي وصلت لكل محادثة، لاختبار الاستئناف بعد الانهيار
+        self.deliveries = {}
+
+    def is_forbidden(self, chat_id: int) -> bool:
+        # ثابت لكل محادثة حتى تبقى نفس المحادثات "محظورة" بين التشغيلات، والطلبات بلا محادثة (answerCallbackQuery) لا تُحظر
+        return chat_id != 0 and (chat_id * 2654435761) % 10000 < self.forbidden_rate * 10000
+
+    def message(self, chat_id: int, method: str) -> dict:
+        self.message_id += 1
+        message = {'message_id': self.message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        if method in ('sendPhoto', 'sendMediaGroup'):
+            message['photo'] = [{'file_id': f'photo{self.message_id}', 'file_unique_id': f'u{self.message_id}', 'width': 1, 'height': 1}]
+        elif method == 'sendDocument':
+            message['document'] = {'file_id': f'doc{self.message_id}', 'file_unique_id': f'u{self.message_id}'}
+        return message
+
+    async def respond(self, method: str, body: bytes):
+        if method == 'getMe':
+            return {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot'}}
+
+        self.stats['requests'] += 1
+        self.stats['bytes_uploaded'] += len(body)
+        self.stats['methods'][method] = self.stats['methods'].get(method, 0) + 1
+        second = str(int(time.time()))
+        self.stats['per_second'][second] = self.stats['per_second'].get(second, 0) + 1
+        await asyncio.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+
+        match = re.search(rb'name="chat_id"\r\n(?:[^\r\n]+\r\n)*\r\n(-?\d+)', body) or re.search(rb'(?:^|&)chat_id=(-?\d+)', body)
+        chat_id = int(match.group(1)) if match else 0
+        if chat_id:
+            self.deliveries[chat_id] = self.deliveries.get(chat_id, 0) + 1
+
+        if self.random.random() < self.rate_429:
+            self.stats['retry_after'] += 1
+            return {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {self.retry_after}',
+                    'parameters': {'retry_after': self.retry_after}}
+        if self.is_forbidden(chat_id):
+            self.stats['forbidden'] += 1
+            return {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+
+        if method == 'sendMediaGroup':
+            count = max(1, body.count(b'%22type%22') + body.count(b'"type"'))
+            return {'ok': True, 'result': [self.message(chat_id, method) for _ in range(count)]}
+        return {'ok': True, 'result': self.message(chat_id, method)}
+
+    def aladhan_calendar(self, target: str) -> dict:
+        """بديل calendarByCity في aladhan: مواقيت ثابتة لكل يوم في الشهر"""
+        self.stats['aladhan'] += 1
+        year, month = (int(part) for part in target.split('?', 1)[0].rstrip('/').split('/')[-2:])
+        days = calendar.monthrange(year, month)[1]
+        timings = {'Fajr': '04:30 (+03)', 'Dhuhr': '12:05 (+03)', 'Asr': '15:30 (+03)', 'Maghrib': '18:10 (+03)', 'Isha': '19:40 (+03)'}
+        return {'code': 200, 'status': 'OK', 'data': [
+            {'timings': timings, 'date': {'gregorian': {'day': f'{day:02d}', 'date': f'{day:02d}-{month:02d}-{year}'}},
+             'meta': {'timezone': 'Asia/Riyadh'}}
+            for day in range(1, days + 1)
+        ]}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # اتصال مستمر (keep-alive) كما يستخدمه httpx
+        self.stats['connections'] += 1
+        try:
+            while request_line := await reader.readline():
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                body = await reader.readexactly(length) if length else b''
+
+                if target == '/stats':
+                    payload = self.stats
+                elif target == '/deliveries':
+                    payload = self.deliveries
+                elif target.startswith('/aladhan/'):
+                    payload = self.aladhan_calendar(target)
+                else:
+                    payload = await self.respond(target.rsplit('/', 1)[-1], body)
+                data = json.dumps(payload).encode()
+                status = payload.get('error_code', 200)
+                writer.write(
+                    f'HTTP/1.1 {status} X\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n'.encode() + data
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+def serve_fake_api(port: int, options: dict):
+    async def serve():
+        api = FakeBotAPI(**options)
+        server = await asyncio.start_server(api.handle, '127.0.0.1', port)
+        async with server:
+            await server.serve_forever()
+    asyncio.run(serve())
+
+# ======================== قاعدة البيانات الاصطناعية ========================
+def build_database(path: str, users: int, groups_ratio: float, bakarah_ratio: float, seed: int):
+    """محادثات في فرق التوقيت +3 بوقت ورد 09:00، ونسبة منها مجموعات ومشتركة في البقرة"""
+    import wird_bot
+
+    rng = random.Random(seed)
+    database = wird_bot.Database(path)
+    rows = []
+    for user_id in range(1, users + 1):
+        chat_id = -1000000000000 - user_id if rng.random() < groups_ratio else user_id
+        rows.append((chat_id, int(rng.random() < bakarah_ratio), rng.randint(1, 600)))
+    database.conn.executemany(
+        '''INSERT INTO chats (chat_id, bakarah_enabled, current_page, quran_time, timezone_offset, city, country)
+           VALUES (?, ?, ?, '09:00', 3, 'Makkah', 'Saudi Arabia')''',
+        rows
+    )
+    database.conn.commit()
+    database.close()
+
+# ======================== تشغيل السيناريوهات ========================
+def build_bot(args, port: int):
+    import wird_bot
+    from telegram.ext import ExtBot
+    from telegram.request import HTTPXRequest
+
+    return ExtBot(
+        token='1:bench',
+        base_url=f'http://127.0.0.1:{port}/bot',
+        request=HTTPXRequest(connection_pool_size=args.concurrency + 4),
+        rate_limiter=wird_bot.TelegramRateLimiter(rate=args.rate),
+    )
+
+async def run_scenarios(args, port: int) -> list:
+    import httpx
+    import wird_bot
+
+    bot = build_bot(args, port)
+    await bot.initialize()
+    if args.workers:
+        # العمّال يبنون البوت من BOT_TOKEN و TELEGRAM_API_URL المضبوطين في main
+        pool = wird_bot.BroadcastWorkerPool(args.workers)
+        await pool.start()
+        wird_bot.broadcaster.pool = pool
+
+    async with httpx.AsyncClient() as client:
+        async def server_stats():
+            return (await client.get(f'http://127.0.0.1:{port}/stats')).json()
+
+        results = []
+        for name in args.scenarios:
+            job_name, data = SCENARIOS[name]
+            callback = {
+                'morning_azkar': wird_bot.send_morning_azkar,
+                'daily_wird': wird_bot.daily_wird_slot_job,
+                'bakarah': wird_bot.bakarah_job,
+                'random_dhikr': wird_bot.send_random_dhikr,
+            }[name]
+            job = SimpleNamespace(name=job_name, data=dict(data), callback=callback, schedule_removal=lambda: None)
+            context = SimpleNamespace(bot=bot, job=job, job_queue=None)
+            if args.window and name in WINDOWED_SCENARIOS:
+                # النافذة تبدأ من دقيقة التذكير: تذكير في بداية الدقيقة التالية
+                await asyncio.sleep(60 - time.time() % 60)
+                # في بيانات المهمة كما يضعها schedule_timezone_bucket، فتصل إلى عمّال البث أيضاً
+                job.data['time'] = wird_bot.local_now(data['tz']).strftime('%H:%M')
+
+            before = await server_stats()
+            sent_before = dict(wird_bot.MESSAGES_SENT.values)
+            failed_before = dict(wird_bot.MESSAGES_FAILED.values)
+            backoff_before = bot.rate_limiter.backoff_seconds
+            started = time.perf_counter()
+            if name == 'bakarah':
+                await wird_bot.send_bakarah_part(context, data['prayer'], data['city'], data['country'])
+            else:
+                await callback(context)
+            await wird_bot.db.flush_progress()
+            wall_time = time.perf_counter() - started
+            after = await server_stats()
+            per_second = [value - before['per_second'].get(second, 0) for second, value in after['per_second'].items()]
+
+            # الفرق في مقاييس البوت نفسها قبل السيناريو وبعده
+            sent = sum(value - sent_before.get(key, 0) for key, value in wird_bot.MESSAGES_SENT.values.items())
+            failed = {}
+            for (job_label, error), value in wird_bot.MESSAGES_FAILED.values.items():
+                delta = value - failed_before.get((job_label, error), 0)
+                if delta:
+                    failed[error] = failed.get(error, 0) + delta
+            results.append({
+                'scenario': name,
+                'targets': sent + sum(failed.values()),
+                'sent': sent,
+                'failed': failed,
+                'wall_time_s': round(wall_time, 3),
+                'msgs_per_s': round(sent / wall_time, 2) if wall_time else 0.0,
+                'peak_requests_per_s': max(per_second, default=0),
+                'api_requests': after['requests'] - before['requests'],
+                'bytes_uploaded': after['bytes_uploaded'] - before['bytes_uploaded'],
+                'retry_after_injected': after['retry_after'] - before['retry_after'],
+                'backoff_s': round(bot.rate_limiter.backoff_seconds - backoff_before, 3),
+                'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            })
+
+    if args.workers:
+        await wird_bot.broadcaster.pool.stop()
+    await bot.shutdown()
+    # بعد البث لأن إيقاف التطبيق يوقف المذيع
+    if args.updates:
+        results.append(await run_update_burst(args))
+    if args.prayer_calendar:
+        results.append(await run_prayer_calendar(port))
+    if args.crash_resume:
+        results.append(await run_crash_resume(args, port))
+    return results
+
+def callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'},
+            'chat_instance': str(chat_id),
+            'data': data,
+            'message': {'message_id': 1, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}},
+        },
+    }
+
+def percentile(values: list, fraction: float) -> float:
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+async def run_update_burst(args) -> dict:
+    """دفعة نقرات من عدة محادثات عبر التطبيق الحقيقي: زمن كل نقرة من وصولها حتى انتهاء معالجتها"""
+    import wird_bot
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    concurrency = args.update_concurrency or wird_bot.UPDATE_CONCURRENCY
+    application = wird_bot.build_application(concurrency)
+    queued, latencies, last_seen = {}, [], {}
+    out_of_order = 0
+    done = asyncio.Event()
+
+    async def record(update, context):
+        # المجموعة 1 تُعالج بعد انتهاء معالج النقرة في المجموعة 0
+        nonlocal out_of_order
+        latencies.append(time.perf_counter() - queued[update.update_id])
+        chat_id = update.effective_chat.id
+        if update.update_id < last_seen.get(chat_id, 0):
+            out_of_order += 1
+        last_seen[chat_id] = update.update_id
+        if len(latencies) == args.updates:
+            done.set()
+
+    application.add_handler(TypeHandler(Update, record), group=1)
+    await application.initialize()
+    await application.start()
+    started = time.perf_counter()
+    for update_id in range(1, args.updates + 1):
+        chat_id = (update_id - 1) % args.update_chats + 1
+        data = CALLBACK_BURST[(update_id - 1) // args.update_chats % len(CALLBACK_BURST)]
+        update = Update.de_json(callback_update(update_id, chat_id, data), application.bot)
+        queued[update_id] = time.perf_counter()
+        await application.update_queue.put(update)
+    await done.wait()
+    wall_time = time.perf_counter() - started
+    await application.stop()
+    await application.shutdown()
+
+    latencies.sort()
+    return {
+        'scenario': 'callback_burst',
+        'updates': args.updates,
+        'chats': args.update_chats,
+        'concurrency': concurrency,
+        'wall_time_s': round(wall_time, 3),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'max_ms': round(latencies[-1] * 1000, 1),
+        'out_of_order': out_of_order,
+    }
+
+async def run_prayer_calendar(port: int) -> dict:
+    """تقويم aladhan الشهري لكل مدن CITIES: من الخادم الوهمي، ثم من الذاكرة، ثم من القرص بعد إعادة التشغيل"""
+    import httpx
+    import wird_bot
+
+    wird_bot.PRAYER_TIMES_SOURCE = 'aladhan'
+    cities = sorted({(city, country) for city, country, _ in wird_bot.CITIES.values()})
+    result = {'scenario': 'prayer_calendar', 'cities': len(cities)}
+    async with httpx.AsyncClient() as client:
+        async def aladhan_requests():
+            stats = (await client.get(f'http://127.0.0.1:{port}/stats')).json()
+            return stats['aladhan'], stats['connections']
+
+        phases = (
+            ('cold', wird_bot.prayer_calendar),
+            ('warm', wird_bot.prayer_calendar),
+            ('restart', wird_bot.PrayerCalendar(wird_bot.aladhan_http)),
+        )
+        for phase, prayer_calendar in phases:
+            requests_before, connections_before = await aladhan_requests()
+            started = time.perf_counter()
+            await prayer_calendar.ensure_loaded()
+            result[f'{phase}_available'] = await prayer_calendar.prefetch(cities)
+            result[f'{phase}_ms'] = round((time.perf_counter() - started) * 1000, 1)
+            requests_after, connections_after = await aladhan_requests()
+            result[f'{phase}_requests'] = requests_after - requests_before
+            result[f'{phase}_connections'] = connections_after - connections_before
+    await wird_bot.aladhan_http.close()
+    return result
+
+# اسم مهمة مستقل حتى لا يكون لها run_id أنهاه سيناريو أذكار الصباح في نفس التشغيل
+CRASH_JOB = ('crash_resume_tz3', {'tz': 3})
+
+def crash_job_context(bot):
+    import wird_bot
+
+    job = SimpleNamespace(name=CRASH_JOB[0], data=dict(CRASH_JOB[1]), callback=wird_bot.send_morning_azkar, schedule_removal=lambda: None)
+    return SimpleNamespace(bot=bot, job=job, job_queue=None)
+
+def crash_child(args, port: int):
+    """بث أذكار الصباح في عملية تُقتل أثناءه بـ SIGKILL دون أي إيقاف منظم"""
+    async def broadcast():
+        import wird_bot
+
+        bot = build_bot(args, port)
+        await bot.initialize()
+        await wird_bot.send_morning_azkar(crash_job_context(bot))
+
+    asyncio.run(broadcast())
+
+async def run_crash_resume(args, port: int) -> dict:
+    """قتل البث بعد --crash-resume ثانية (بين حفظين للسجل) ثم استئنافه، وعدّ المكرر والمفقود لكل محادثة
+
+    المكرر محدود بما أُرسل بعد آخر حفظ للسجل وصندوق الإرسال، والمفقود يجب أن يكون صفراً.
+    """
+    import httpx
+    import wird_bot
+
+    async def deliveries(client) -> dict:
+        return {int(chat_id): count for chat_id, count in (await client.get(f'http://127.0.0.1:{port}/deliveries')).json().items()}
+
+    expected = [chat_id async for chat_id in wird_bot.db.iter_window_chat_ids('morning_azkar_enabled', CRASH_JOB[1]['tz'])]
+    async with httpx.AsyncClient() as client:
+        before = await deliveries(client)
+        # spawn لا fork: خيوط القاعدة في هذه العملية لا تنتقل إلى الابن
+        child = multiprocessing.get_context('spawn').Process(target=crash_child, args=(args, port), daemon=True)
+        child.start()
+        await asyncio.sleep(args.crash_resume)
+        os.kill(child.pid, signal.SIGKILL)
+        child.join()
+        killed = await deliveries(client)
+
+        # إعادة التشغيل: صندوق الإرسال أولاً ثم استئناف نفس العملية كما في bootstrap
+        bot = build_bot(args, port)
+        await bot.initialize()
+        await wird_bot.outbox.replay(bot)
+        started = time.perf_counter()
+        await wird_bot.send_morning_azkar(crash_job_context(bot))
+        if wird_bot.outbox.replaying is not None:
+            await wird_bot.outbox.replaying
+        await wird_bot.outbox.flush()
+        resume_time = time.perf_counter() - started
+        after = await deliveries(client)
+        await bot.shutdown()
+
+    counts = {chat_id: after.get(chat_id, 0) - before.get(chat_id, 0) for chat_id in expected}
+    return {
+        'scenario': 'crash_resume',
+        'targets': len(expected),
+        'killed_after_s': args.crash_resume,
+        'sent_before_kill': sum(killed.get(chat_id, 0) - before.get(chat_id, 0) for chat_id in expected),
+        'resume_wall_time_s': round(resume_time, 3),
+        'duplicates': sum(1 for count in counts.values() if count > 1),
+        'missing': sum(1 for count in counts.values() if count == 0),
+        'journal_flush_s': wird_bot.PROGRESS_FLUSH_INTERVAL,
+        'journal_checkpoint_every': wird_bot.JOURNAL_CHECKPOINT_EVERY,
+    }
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def main():
+    parser = argparse.ArgumentParser(description='قياس أداء البث ضد Bot API وهمي')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups-ratio', type=float, default=0.0)
+    parser.add_argument('--bakarah-ratio', type=float, default=0.3)
+    parser.add_argument('--latency', type=float, default=0.05, help='زمن استجابة الخادم الوهمي بالثواني')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--rate-429', type=float, default=0.0, help='نسبة الطلبات التي تُرد بـ 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--forbidden-rate', type=float, default=0.02, help='نسبة المحادثات التي حظرت البوت')
+    parser.add_argument('--rate', type=float, default=30, help='الحد العام للرسائل في الثانية')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--window', type=float, default=0, help='نافذة التوصيل بالدقائق للأذكار والذكر العشوائي (0 = الإرسال دفعة واحدة)')
+    parser.add_argument('--peak-rate', type=float, default=20, help='الحد الأعلى للرسائل في الثانية خلال النافذة')
+    parser.add_argument('--workers', type=int, default=0, help='عدد عمليات البث المنفصلة (0 = نفس العملية)')
+    parser.add_argument('--scenarios', nargs='*', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--updates', type=int, default=0, help='عدد النقرات في اختبار دفعة التحديثات (0 = بدون)')
+    parser.add_argument('--update-chats', type=int, default=50, help='عدد المحادثات التي تتوزع عليها النقرات')
+    parser.add_argument('--update-concurrency', type=int, default=0, help='عدد التحديثات المعالجة معاً (0 = إعداد البوت)')
+    parser.add_argument('--prayer-calendar', action='store_true', help='قياس جلب تقويم المواقيت الشهري من aladhan الوهمي')
+    parser.add_argument('--crash-resume', type=float, default=0, help='قتل بث أذكار الصباح بعد هذه الثواني ثم استئنافه وعدّ المكرر والمفقود (0 = بدون)')
+    parser.add_argument('--port', type=int, default=18081)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='ملف JSON للنتائج (الافتراضي: الطباعة فقط)')
+    args = parser.parse_args()
+
+    # wird_bot يقرأ DB_PATH وباقي الإعدادات عند الاستيراد فتُضبط قبله، أما القاعدة فتُفتح عند أول استخدام
+    workdir = tempfile.mkdtemp(prefix='wird_bench_')
+    os.environ['DB_PATH'] = os.path.join(workdir, 'wird_bot.db')
+    os.environ['BROADCAST_CONCURRENCY'] = str(args.concurrency)
+    os.environ['BROADCAST_RATE'] = str(args.rate)
+    os.environ['BROADCAST_PEAK_RATE'] = str(args.peak_rate)
+    os.environ['DELIVERY_WINDOWS'] = ','.join(f'{name}:{args.window}' for name in WINDOWED_SCENARIOS)
+    os.environ['BOT_TOKEN'] = '1:bench'
+    os.environ['TELEGRAM_API_URL'] = f'http://127.0.0.1:{args.port}/bot'
+    os.environ['ALADHAN_API_URL'] = f'http://127.0.0.1:{args.port}/aladhan/v1'
+    os.environ['PRAYER_CACHE_PATH'] = os.path.join(workdir, 'prayer_times')
+    # الخادم في عملية منفصلة حتى لا يُحسب ضمن ذاكرة البوت ومعالجه
+    server = multiprocessing.Process(target=serve_fake_api, args=(args.port, {
+        'latency': args.latency, 'jitter': args.jitter, 'rate_429': args.rate_429,
+        'forbidden_rate': args.forbidden_rate, 'retry_after': args.retry_after, 'seed': args.seed,
+    }), daemon=True)
+    server.start()
+
+    import wird_bot
+    build_database(os.environ['DB_PATH'], args.users, args.groups_ratio, args.bakarah_ratio, args.seed)
+
+    try:
+        time.sleep(0.5)
+        results = asyncio.run(run_scenarios(args, args.port))
+    finally:
+        server.terminate()
+        wird_bot.db.close()
+
+    output = {
+        'revision': git_revision(),
+        'python': sys.version.split()[0],
+        'config': vars(args),
+        'results': results,
+    }
+    text = json.dumps(output, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,49 @@
+import time
+# بداية التشغيل لتقرير زمن الاستيراد والتهيئة (STARTUP_TIMING)
+STARTUP_STARTED = time.perf_counter()
+
 import os
 import asyncio
+import hashlib
+import heapq
 import logging
 import sqlite3
-import requests
+import httpx
 import random
-from datetime import datetime, timedelta
+import signal
+import queue
+import threading
+import itertools
+import json
+import math
+import multiprocessing
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from functools import lru_cache, partial, wraps
 from pathlib import Path
 from typing import Optional
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputFile, InputMediaPhoto, TelegramObject
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
     ChatMemberHandler,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     ConversationHandler,
+    ExtBot,
     MessageHandler,
     filters
 )
 from telegram.constants import ChatMemberStatus
+from telegram.error import BadRequest, ChatMigrated, Forbidden, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -28,38 +53,313 @@ logger = logging.getLogger(__name__)
 
 # استخدام متغير بيئة للتوكن (مهم لـ Render)
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "YOUR_BOT_TOKEN_HERE")
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+ALADHAN_API_URL = os.environ.get("ALADHAN_API_URL", "https://api.aladhan.com/v1")
 PORT = int(os.environ.get("PORT", 8443))
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "https://wird-muslim-bot.onrender.com")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+# مسار المقاييس على نفس منفذ webhook
+METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")
 
 QURAN_PAGES = 604
 
+# حدود الإرسال الجماعي (تيليجرام يسمح بحوالي 30 رسالة في الثانية)
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 30))
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 20))
+GROUP_MESSAGES_PER_MINUTE = 20
+
+# أولويات الإرسال تحت الحد العام: الأصغر يُخدم أولاً (ردود المستخدمين، ثم القرآن، ثم الأذكار)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_QURAN = 1
+PRIORITY_BROADCAST = 2
+# أسماء البث (بالبادئة) التي تُرسل بأولوية القرآن، والباقي بأولوية الأذكار
+QURAN_BROADCASTS = ('daily_wird', 'bakarah', 'friday_kahf')
+
+# عمّال البث: عمليات منفصلة تقسم البث المجدول حسب chat_id (0 = البث في نفس العملية)
+BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", 0))
+WORKER_PROGRESS_INTERVAL = 1.0
+UPLOAD_LOCK_POLL = 0.05
+
 IMAGES_PATH = Path("images")
 QURAN_PAGES_PATH = IMAGES_PATH / "quran_pages"
 AZKAR_PATH = IMAGES_PATH / "azkar"
 BAKARAH_QIYAM_PATH = IMAGES_PATH / "bakarah_qiyam"
 PDF_PATH = Path("pdfs")
 
-IMAGES_PATH.mkdir(exist_ok=True)
-QURAN_PAGES_PATH.mkdir(exist_ok=True)
-AZKAR_PATH.mkdir(exist_ok=True)
-BAKARAH_QIYAM_PATH.mkdir(exist_ok=True)
-PDF_PATH.mkdir(exist_ok=True)
+# فهرس الملفات وذاكرة محتواها
+ASSET_EXTENSIONS = ('jpg', 'png', 'jpeg', 'pdf')
+ASSET_CHECK_INTERVAL = float(os.environ.get("ASSET_CHECK_INTERVAL", 30))
+ASSET_CACHE_BYTES = int(os.environ.get("ASSET_CACHE_MB", 32)) * 1024 * 1024
+
+# نسخ الصور المضغوطة للرفع (تُنتج بـ wird_assets.py) وفهرسها
+OPTIMIZED_PATH = Path(os.environ.get("OPTIMIZED_PATH", "images_optimized"))
+OPTIMIZED_MANIFEST = OPTIMIZED_PATH / "manifest.json"
+USE_OPTIMIZED_ASSETS = os.environ.get("USE_OPTIMIZED_ASSETS", "true").lower() != "false"
+
+def create_directories():
+    for directory in (IMAGES_PATH, QURAN_PAGES_PATH, AZKAR_PATH, BAKARAH_QIYAM_PATH, PDF_PATH):
+        directory.mkdir(exist_ok=True)
 
 # حالات المحادثة
 SELECTING_CITY = 1
 
+# حجم الدفعة عند قراءة المشتركين من قاعدة البيانات
+DB_CHUNK_SIZE = 500
+DB_PATH = os.environ.get("DB_PATH", "wird_bot.db")
+DB_READERS = int(os.environ.get("DB_READERS", 3))
+
+# تجميع تحديثات تقدّم القراءة وكتابتها في معاملة واحدة
+PROGRESS_BATCH_SIZE = 200
+PROGRESS_FLUSH_INTERVAL = 5.0
+
+# عدد المستخدمين الذين تبقى إعداداتهم في الذاكرة
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+
+# عدد التحديثات التي تُعالج معاً (1 = تحديث واحد في كل مرة)، وتحديثات المحادثة الواحدة تبقى بترتيب وصولها
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", 64))
+
+# تقرير زمن كل مرحلة من التشغيل، وتحذير إن تأخر أول استعداد لاستقبال التحديثات عن الحد
+STARTUP_TIMING = os.environ.get("STARTUP_TIMING", "").lower() in ("1", "true")
+STARTUP_BUDGET = float(os.environ.get("STARTUP_BUDGET", 3))
+
+# عميل HTTP للخدمات الخارجية: مهلة الطلب، الاتصالات المستمرة، وقاطع الدائرة بعد أخطاء متتالية
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 10))
+HTTP_MAX_CONNECTIONS = 4
+HTTP_KEEPALIVE = 60.0
+CIRCUIT_FAILURES = 5
+CIRCUIT_RESET = 60.0
+
+# سجل البث: حفظ نقطة الاستئناف وما أُرسل بعدها كل عدد من المحادثات أو كل PROGRESS_FLUSH_INTERVAL في معاملة
+# واحدة، فالانهيار بين حفظين يعيد إرسال ما بعد آخر حفظ فقط (بحد أقصى للعدد والمدة)، واستئناف ما انقطع خلال هذه المدة
+JOURNAL_CHECKPOINT_EVERY = 100
+BROADCAST_RESUME_HOURS = float(os.environ.get("BROADCAST_RESUME_HOURS", 3))
+BROADCAST_JOURNAL_DAYS = 7
+
+# نوافذ التوصيل: التذكير الثابت يتوزع على المحادثات خلال دقائق من وقته بدل أن يصل للجميع في نفس الثانية،
+# بحد أعلى واحد لعدد رسائل كل النوافذ في الثانية. لكل محادثة موضع ثابت من DELIVERY_SLOTS موضعاً داخل النافذة
+BROADCAST_PEAK_RATE = float(os.environ.get("BROADCAST_PEAK_RATE", 20))
+DELIVERY_SLOTS = 1024
+
+# ======================== المقاييس ========================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+JOB_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+LAG_BUCKETS = (0.5, 1, 2.5, 5, 15, 30, 60, 300, 900)
+
+def format_labels(names: tuple, values: tuple) -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class CounterMetric:
+    """عدّاد تراكمي بتسميات اختيارية"""
+    kind = 'counter'
+    
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+    
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        self.values[key] = self.values.get(key, 0) + amount
+    
+    def value(self, **labels) -> float:
+        return self.values.get(tuple(labels[name] for name in self.labels), 0)
+    
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield f'{self.name}{format_labels(self.labels, key)} {value}'
+
+class HistogramMetric:
+    """توزيع القيم على حدود ثابتة مع المجموع والعدد"""
+    kind = 'histogram'
+    
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # التسميات -> [عدد كل حد..., المجموع, العدد]
+        self.values = {}
+    
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[index] += 1
+        state[-2] += value
+        state[-1] += 1
+    
+    def count(self, **labels) -> int:
+        state = self.values.get(tuple(labels[name] for name in self.labels))
+        return state[-1] if state else 0
+    
+    def samples(self):
+        bucket_labels = self.labels + ('le',)
+        for key, state in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, state):
+                yield f'{self.name}_bucket{format_labels(bucket_labels, key + (bound,))} {count}'
+            yield f'{self.name}_bucket{format_labels(bucket_labels, key + ("+Inf",))} {state[-1]}'
+            yield f'{self.name}_sum{format_labels(self.labels, key)} {state[-2]}'
+            yield f'{self.name}_count{format_labels(self.labels, key)} {state[-1]}'
+
+class MetricsRegistry:
+    """مقاييس البوت بصيغة Prometheus النصية"""
+    
+    def __init__(self):
+        self.metrics = []
+    
+    def counter(self, name: str, documentation: str, labels: tuple = ()) -> CounterMetric:
+        metric = CounterMetric(name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+    
+    def histogram(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> HistogramMetric:
+        metric = HistogramMetric(name, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+JOB_DURATION = metrics.histogram('wird_job_duration_seconds', 'Duration of scheduled broadcast jobs.', ('job',), JOB_BUCKETS)
+DELIVERY_LAG = metrics.histogram('wird_delivery_lag_seconds', 'Delay between a chat\'s time in the delivery window and its send, by job.', ('job',), LAG_BUCKETS)
+MESSAGES_SENT = metrics.counter('wird_messages_sent_total', 'Broadcast messages delivered.', ('job',))
+MESSAGES_FAILED = metrics.counter('wird_messages_failed_total', 'Broadcast messages that failed, by error type.', ('job', 'error'))
+TELEGRAM_API_LATENCY = metrics.histogram('wird_telegram_api_seconds', 'Telegram Bot API request latency.', ('endpoint',))
+RATE_LIMIT_HITS = metrics.counter('wird_rate_limit_hits_total', 'RetryAfter (429) responses from Telegram.')
+RATE_LIMIT_BACKOFF = metrics.counter('wird_rate_limit_backoff_seconds_total', 'Seconds spent paused after RetryAfter.')
+DB_QUERY_DURATION = metrics.histogram('wird_db_query_seconds', 'Database call latency including queueing.', ('query',))
+HANDLER_LATENCY = metrics.histogram('wird_handler_seconds', 'Update handler latency.', ('handler',))
+SEND_QUEUE_WAIT = metrics.histogram('wird_send_queue_seconds', 'Time requests wait for the global rate limit, by priority.', ('priority',))
+UPDATE_WAIT = metrics.histogram('wird_update_wait_seconds', 'Time updates wait behind earlier updates of the same chat.')
+HANDLER_ERRORS = metrics.counter('wird_handler_errors_total', 'Unhandled errors raised by update handlers.', ('error',))
+EXTERNAL_API_LATENCY = metrics.histogram('wird_external_api_seconds', 'External HTTP API request latency.', ('service',))
+EXTERNAL_API_ERRORS = metrics.counter('wird_external_api_errors_total', 'External HTTP API failures, including requests skipped by an open circuit.', ('service', 'error'))
+ASSET_UPLOAD_BYTES = metrics.counter('wird_asset_upload_bytes_total', 'Bytes of media assets uploaded to Telegram.')
+ASSET_UPLOAD_SAVED = metrics.counter('wird_asset_upload_saved_bytes_total', 'Upload bytes avoided by sending optimized variants.')
+
+def instrumented(callback):
+    """قياس زمن تنفيذ معالج التحديثات"""
+    @wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=callback.__name__)
+            if startup_timer.first_update is None:
+                startup_timer.first_update = time.perf_counter() - STARTUP_STARTED
+    return wrapper
+
+# ======================== زمن التشغيل ========================
+class StartupTimer:
+    """مدة كل مرحلة من التشغيل: الاستيراد، التهيئة، ومهام الخلفية"""
+    
+    def __init__(self, started: float):
+        self.started = started
+        self.last = started
+        self.phases = []
+        self.ready = None
+        self.first_update = None
+    
+    def mark(self, phase: str):
+        """مرحلة متتالية: المدة منذ المرحلة السابقة"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+    
+    @contextmanager
+    def measure(self, phase: str):
+        """مرحلة قد تعمل بالتوازي مع غيرها"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((phase, time.perf_counter() - started))
+    
+    def mark_ready(self):
+        self.mark('ready')
+        self.ready = self.last - self.started
+        if self.ready > STARTUP_BUDGET:
+            logger.warning("⏱️ الاستعداد لاستقبال التحديثات استغرق %.0f ms (الحد %.0f ms)", self.ready * 1000, STARTUP_BUDGET * 1000)
+    
+    def report(self):
+        if not STARTUP_TIMING:
+            return
+        lines = [f"{phase:<28} {seconds * 1000:8.1f} ms" for phase, seconds in self.phases]
+        if self.ready is not None:
+            lines.append(f"{'ready (since start)':<28} {self.ready * 1000:8.1f} ms")
+        if self.first_update is not None:
+            lines.append(f"{'first update (since start)':<28} {self.first_update * 1000:8.1f} ms")
+        logger.info("⏱️ زمن التشغيل:\n%s", '\n'.join(lines))
+
+startup_timer = StartupTimer(STARTUP_STARTED)
+
 # ======================== قاعدة البيانات ========================
+# معرّفات تيليجرام لا تتجاوز 52 بت، فيتسع مفتاح (الموضع، chat_id) لعدد صحيح واحد في SQLite
+CHAT_ID_BITS = 53
+CHAT_ID_OFFSET = 1 << (CHAT_ID_BITS - 1)
+
+def delivery_slot(chat_id: int) -> int:
+    """موضع المحادثة الثابت في نوافذ التوصيل (ضرب Knuth ثم أعلى البتات)"""
+    return ((chat_id * 2654435761) & 0xFFFFFFFF) * DELIVERY_SLOTS >> 32
+
+def delivery_key(chat_id: int) -> int:
+    """مفتاح ترتيب البث الموزع ونقطة استئنافه: الموضع ثم chat_id"""
+    return (delivery_slot(chat_id) << CHAT_ID_BITS) + chat_id + CHAT_ID_OFFSET
+
+def split_delivery_key(key: int) -> tuple:
+    return key >> CHAT_ID_BITS, (key & ((1 << CHAT_ID_BITS) - 1)) - CHAT_ID_OFFSET
+
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect('wird_bot.db', check_same_thread=False)
-        self.create_tables()
-        self.upgrade_database()
+    def __init__(self, path: str = DB_PATH, readonly: bool = False):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.configure(readonly)
+        if not readonly:
+            self.create_tables()
+            self.upgrade_database()
+            self.migrate_users_to_chats()
+            self.assign_delivery_slots()
+            self.create_indexes()
+    
+    def configure(self, readonly: bool):
+        """إعدادات WAL تسمح بالقراءة أثناء الكتابة وتقلل عمليات fsync"""
+        cursor = self.conn.cursor()
+        cursor.execute('PRAGMA busy_timeout = 5000')
+        cursor.execute('PRAGMA temp_store = MEMORY')
+        cursor.execute('PRAGMA cache_size = -8000')
+        if readonly:
+            cursor.execute('PRAGMA query_only = ON')
+        else:
+            cursor.execute('PRAGMA journal_mode = WAL')
+            cursor.execute('PRAGMA synchronous = NORMAL')
+    
+    def close(self):
+        self.conn.close()
+    
+    def checkpoint(self):
+        """نقل محتوى WAL إلى ملف القاعدة قبل الإغلاق"""
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
     
     def create_tables(self):
         cursor = self.conn.cursor()
+        # الاشتراك وإعداداته لكل محادثة: المجموعة تُرسل لها الرسالة مرة واحدة مهما كان عدد أعضائها المشتركين
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                chat_id INTEGER,
+            CREATE TABLE IF NOT EXISTS chats (
+                chat_id INTEGER PRIMARY KEY,
                 daily_pages INTEGER DEFAULT 2,
                 bakarah_enabled BOOLEAN DEFAULT 0,
                 morning_azkar_enabled BOOLEAN DEFAULT 1,
@@ -72,21 +372,86 @@ class Database:
                 city TEXT DEFAULT 'Makkah',
                 country TEXT DEFAULT 'Saudi Arabia',
                 timezone_offset INTEGER DEFAULT 3,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                is_active BOOLEAN DEFAULT 1,
+                inactive_since TIMESTAMP,
+                delivery_slot INTEGER
+            )
+        ''')
+        # المستخدمون الذين اشتركوا من كل محادثة (في الخاص user_id = chat_id)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_users (
+                chat_id INTEGER NOT NULL,
+                user_id INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (chat_id, user_id)
+            ) WITHOUT ROWID
+        ''')
+        # ذاكرة file_id الخاصة بتيليجرام لكل ملف (المسار + بصمة المحتوى)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS media_cache (
+                asset_path TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                file_id TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (asset_path, content_hash)
+            )
+        ''')
+        # سجل عمليات البث: نقطة الاستئناف لكل عملية وما أُرسل بعدها
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_runs (
+                run_id TEXT PRIMARY KEY,
+                job_name TEXT NOT NULL,
+                callback TEXT NOT NULL,
+                data TEXT,
+                status TEXT DEFAULT 'running',
+                checkpoint INTEGER,
+                processed INTEGER DEFAULT 0,
+                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+                run_id TEXT NOT NULL,
+                target INTEGER NOT NULL,
+                PRIMARY KEY (run_id, target)
+            ) WITHOUT ROWID
+        ''')
+        # صندوق الإرسال: طلبات تيليجرام التي لم تُرسل بعد، وطلب البث يحمل عمليته وهدفه في السجل
+        # deferred: أجّله الإيقاف المنظم فلم يُرسل قطعاً، وغيره قد يكون أُرسل قبل انهيار لم يُسجَّل فيه
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY,
+                priority INTEGER NOT NULL,
+                endpoint TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                run_id TEXT,
+                target INTEGER,
+                deferred INTEGER NOT NULL DEFAULT 0,
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
         self.conn.commit()
     
     def upgrade_database(self):
+        """إضافة الأعمدة الناقصة في جدول users القديم قبل ترحيله"""
         cursor = self.conn.cursor()
         cursor.execute("PRAGMA table_info(users)")
         columns = [column[1] for column in cursor.fetchall()]
+        if not columns:
+            return
         
         columns_to_add = {
+            'morning_azkar_enabled': 'BOOLEAN DEFAULT 1',
+            'evening_azkar_enabled': 'BOOLEAN DEFAULT 1',
+            'current_page': 'INTEGER DEFAULT 1',
             'city': 'TEXT DEFAULT "Makkah"',
             'country': 'TEXT DEFAULT "Saudi Arabia"',
             'timezone_offset': 'INTEGER DEFAULT 3',
-            'white_days_reminder': 'BOOLEAN DEFAULT 1'
+            'white_days_reminder': 'BOOLEAN DEFAULT 1',
+            'is_active': 'BOOLEAN DEFAULT 1',
+            'inactive_since': 'TIMESTAMP'
         }
         
         for column_name, column_def in columns_to_add.items():
@@ -97,32 +462,721 @@ class Database:
                 except:
                     pass
     
-    def add_user(self, user_id: int, chat_id: int):
+    # أعمدة التفعيل التي تُرسل حسبها التذكيرات
+    SUBSCRIPTION_FLAGS = (
+        'morning_azkar_enabled',
+        'evening_azkar_enabled',
+        'kahf_enabled',
+        'mulk_enabled',
+        'bakarah_enabled',
+        'white_days_reminder',
+    )
+    
+    def create_indexes(self):
+        """فهارس جزئية تجعل SQLite يتخطى المحادثات التي أوقفت التذكير أو توقفت"""
+        cursor = self.conn.cursor()
+        # التذكيرات الثابتة تُقرأ حسب موضع التوصيل، فالفهارس القديمة المرتبة حسب chat_id لم تعد تُستخدم
+        for flag in self.SUBSCRIPTION_FLAGS:
+            cursor.execute(f'DROP INDEX IF EXISTS idx_chats_{flag}_active')
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_chats_{flag}_slot ON chats (timezone_offset, delivery_slot, chat_id) WHERE {flag} = 1 AND is_active = 1')
+        cursor.execute('DROP INDEX IF EXISTS idx_chats_active_tz')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_active_slot ON chats (timezone_offset, delivery_slot, chat_id) WHERE is_active = 1')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_quran_active ON chats (quran_time, timezone_offset, chat_id, is_active) WHERE is_active = 1')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_bakarah_active ON chats (city, country, chat_id, bakarah_enabled, is_active) WHERE bakarah_enabled = 1 AND is_active = 1')
+        self.conn.commit()
+    
+    def _iter_rows(self, query: str, params: tuple = (), chunk_size: int = DB_CHUNK_SIZE):
+        """قراءة النتائج دفعة بعد دفعة بدل تحميل الجدول كاملاً في الذاكرة"""
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield from rows
+    
+    def _subscriber_conditions(self, flag: Optional[str], tz: Optional[int]) -> tuple:
+        conditions = ['is_active = 1']
+        params = []
+        if flag is not None:
+            if flag not in self.SUBSCRIPTION_FLAGS:
+                raise ValueError(f'Unknown subscription flag: {flag}')
+            conditions.append(f'{flag} = 1')
+        if tz is not None:
+            conditions.append('timezone_offset = ?')
+            params.append(tz)
+        return conditions, params
+    
+    @staticmethod
+    def _shard_condition(shard: tuple) -> tuple:
+        """(shard, shards): المحادثات التي chat_id % shards == shard بقسمة Python (باقي SQLite سالب للمعرّفات السالبة)"""
+        index, count = shard
+        return '((chat_id % ?) + ?) % ? = ?', (count, count, count, index)
+    
+    def iter_chat_ids(self, flag: Optional[str] = None, tz: Optional[int] = None, after: Optional[int] = None, shard: Optional[tuple] = None):
+        """chat_id لكل المحادثات النشطة، أو لمن فعّل إعداداً معيناً فقط، وفي منطقة زمنية معينة إن حُددت"""
+        conditions, params = self._subscriber_conditions(flag, tz)
+        if shard is not None:
+            condition, shard_params = self._shard_condition(shard)
+            conditions.append(condition)
+            params.extend(shard_params)
+        if after is not None:
+            conditions.append('chat_id > ?')
+            params.append(after)
+        
+        where = ' AND '.join(conditions)
+        for row in self._iter_rows(f'SELECT chat_id FROM chats WHERE {where} ORDER BY chat_id', tuple(params)):
+            yield row[0]
+    
+    def iter_window_chat_ids(self, flag: Optional[str] = None, tz: Optional[int] = None, after: Optional[int] = None, shard: Optional[tuple] = None):
+        """مثل iter_chat_ids لكن مرتبة حسب موضع التوصيل، و after مفتاح delivery_key"""
+        for row in self._iter_window_rows('chat_id', flag, tz, after, shard):
+            yield row[0]
+    
+    def iter_window_chat_countries(self, flag: Optional[str] = None, tz: Optional[int] = None, after: Optional[int] = None, shard: Optional[tuple] = None):
+        """(chat_id, country) بترتيب iter_window_chat_ids، للتذكيرات التي تختلف حسب دولة المحادثة"""
+        yield from self._iter_window_rows('chat_id, country', flag, tz, after, shard)
+    
+    def _iter_window_rows(self, columns: str, flag: Optional[str], tz: Optional[int], after: Optional[int], shard: Optional[tuple]):
+        conditions, params = self._subscriber_conditions(flag, tz)
+        if shard is not None:
+            condition, shard_params = self._shard_condition(shard)
+            conditions.append(condition)
+            params.extend(shard_params)
+        if after is not None:
+            conditions.append('(delivery_slot, chat_id) > (?, ?)')
+            params.extend(split_delivery_key(after))
+        
+        where = ' AND '.join(conditions)
+        yield from self._iter_rows(f'SELECT {columns} FROM chats WHERE {where} ORDER BY delivery_slot, chat_id', tuple(params))
+    
+    def iter_timezone_offsets(self):
+        """فروق التوقيت المختلفة بين المحادثات"""
+        for row in self._iter_rows('SELECT DISTINCT timezone_offset FROM chats WHERE is_active = 1 AND timezone_offset IS NOT NULL'):
+            yield row[0]
+    
+    def iter_quran_slots(self):
+        """(quran_time, timezone_offset) المختلفة بين المحادثات"""
+        yield from self._iter_rows('SELECT DISTINCT quran_time, timezone_offset FROM chats WHERE is_active = 1 AND timezone_offset IS NOT NULL')
+    
+    def iter_wird_targets(self, quran_time: str, tz: int, after: Optional[int] = None, shard: Optional[tuple] = None):
+        """chat_id للمحادثات التي وقت وردها يساوي quran_time في فرق التوقيت tz"""
+        query = 'SELECT chat_id FROM chats WHERE is_active = 1 AND quran_time = ? AND timezone_offset = ?'
+        params = (quran_time, tz)
+        if shard is not None:
+            condition, shard_params = self._shard_condition(shard)
+            query += f' AND {condition}'
+            params += shard_params
+        if after is not None:
+            query += ' AND chat_id > ?'
+            params += (after,)
+        for row in self._iter_rows(query + ' ORDER BY chat_id', params):
+            yield row[0]
+    
+    def get_wird_progress(self, chat_id: int):
+        """(daily_pages, current_page) للمحادثة"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT daily_pages, current_page FROM chats WHERE chat_id = ?', (chat_id,))
+        return cursor.fetchone()
+    
+    def iter_bakarah_cities(self):
+        """(city, country, timezone_offset) لكل مدينة فيها مشترك في سورة البقرة"""
+        yield from self._iter_rows('''
+            SELECT city, country, MAX(timezone_offset) FROM chats
+            WHERE bakarah_enabled = 1 AND is_active = 1
+            GROUP BY city, country
+        ''')
+    
+    def iter_bakarah_chat_ids(self, city: str, country: str, after: Optional[int] = None, shard: Optional[tuple] = None):
+        query = 'SELECT chat_id FROM chats WHERE bakarah_enabled = 1 AND is_active = 1 AND city = ? AND country = ?'
+        params = (city, country)
+        if shard is not None:
+            condition, shard_params = self._shard_condition(shard)
+            query += f' AND {condition}'
+            params += shard_params
+        if after is not None:
+            query += ' AND chat_id > ?'
+            params += (after,)
+        for row in self._iter_rows(query + ' ORDER BY chat_id', params):
+            yield row[0]
+    
+    def add_chat(self, chat_id: int, user_id: Optional[int] = None):
+        """تسجيل المحادثة مرة واحدة وربط المستخدم الذي اشترك منها"""
+        cursor = self.conn.cursor()
+        cursor.execute('INSERT OR IGNORE INTO chats (chat_id, delivery_slot) VALUES (?, ?)', (chat_id, delivery_slot(chat_id)))
+        if user_id is not None:
+            cursor.execute('INSERT OR IGNORE INTO chat_users (chat_id, user_id) VALUES (?, ?)', (chat_id, user_id))
+        # وصول رسالة من المحادثة يعني أنها عادت متاحة
+        cursor.execute('UPDATE chats SET is_active = 1, inactive_since = NULL WHERE chat_id = ? AND is_active = 0', (chat_id,))
+        self.conn.commit()
+    
+    def deactivate_chat(self, chat_id: int) -> int:
+        """إيقاف الإرسال لمحادثة حظرت البوت أو لم تعد موجودة"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'UPDATE chats SET is_active = 0, inactive_since = CURRENT_TIMESTAMP WHERE chat_id = ? AND is_active = 1',
+            (chat_id,)
+        )
+        self.conn.commit()
+        return cursor.rowcount
+    
+    def migrate_chat(self, old_chat_id: int, new_chat_id: int):
+        """نقل اشتراك مجموعة تمت ترقيتها إلى supergroup إلى المعرّف الجديد"""
         cursor = self.conn.cursor()
-        cursor.execute('INSERT OR IGNORE INTO users (user_id, chat_id) VALUES (?, ?)', (user_id, chat_id))
+        # إن سبق تسجيل المعرّف الجديد تبقى إعداداته ويُحذف القديم
+        cursor.execute('UPDATE OR IGNORE chats SET chat_id = ? WHERE chat_id = ?', (new_chat_id, old_chat_id))
+        cursor.execute('DELETE FROM chats WHERE chat_id = ?', (old_chat_id,))
+        cursor.execute(
+            'UPDATE chats SET is_active = 1, inactive_since = NULL, delivery_slot = ? WHERE chat_id = ?',
+            (delivery_slot(new_chat_id), new_chat_id)
+        )
+        cursor.execute('UPDATE OR IGNORE chat_users SET chat_id = ? WHERE chat_id = ?', (new_chat_id, old_chat_id))
+        cursor.execute('DELETE FROM chat_users WHERE chat_id = ?', (old_chat_id,))
         self.conn.commit()
     
-    def get_user(self, user_id: int):
+    def get_chat(self, chat_id: int):
         cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
+        cursor.execute('SELECT * FROM chats WHERE chat_id = ?', (chat_id,))
         return cursor.fetchone()
     
-    def update_user_setting(self, user_id: int, setting: str, value):
+    def get_chat_settings(self, chat_id: int) -> Optional['ChatSettings']:
+        cursor = self.conn.cursor()
+        cursor.execute(f'SELECT {", ".join(ChatSettings.__slots__)} FROM chats WHERE chat_id = ?', (chat_id,))
+        row = cursor.fetchone()
+        return ChatSettings(*row) if row else None
+    
+    # الأعمدة التي يمكن تعديلها من الإعدادات
+    SETTING_COLUMNS = SUBSCRIPTION_FLAGS + (
+        'daily_pages',
+        'quran_time',
+        'current_page',
+        'city',
+        'country',
+        'timezone_offset',
+    )
+    
+    # أعمدة المحادثة التي تُنقل من جدول users القديم
+    CHAT_COLUMNS = SETTING_COLUMNS + ('created_at', 'is_active', 'inactive_since')
+    
+    def migrate_users_to_chats(self):
+        """ترحيل لمرة واحدة من صف لكل مستخدم إلى صف لكل محادثة
+        
+        كان /start داخل المجموعة يضيف صفاً لكل عضو بنفس chat_id فتصل الرسالة للمجموعة مكررة.
+        إعدادات المحادثة تؤخذ من صفها الخاص (user_id = chat_id) إن وُجد وإلا من أقدم مشترك فيها،
+        ويبقى الجدول القديم باسم users_legacy للرجوع إليه.
+        """
+        cursor = self.conn.cursor()
+        # العمّال قد يفتحون القاعدة في نفس الوقت: التحقق داخل المعاملة حتى يُرحَّل مرة واحدة
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            if not cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone():
+                cursor.execute('COMMIT')
+                return
+            columns = ', '.join(self.CHAT_COLUMNS)
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO chats (chat_id, {columns})
+                SELECT chat_id, {columns} FROM users WHERE chat_id IS NOT NULL
+                ORDER BY chat_id, user_id != chat_id, created_at, user_id
+            ''')
+            chats = cursor.rowcount
+            # معرّفات المستخدمين موجبة، والسالب صف المجموعة نفسها
+            cursor.execute('''
+                INSERT OR IGNORE INTO chat_users (chat_id, user_id, created_at)
+                SELECT chat_id, user_id, created_at FROM users WHERE chat_id IS NOT NULL AND user_id > 0
+            ''')
+            rows = cursor.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+            for (index,) in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'users' AND sql IS NOT NULL").fetchall():
+                cursor.execute(f'DROP INDEX {index}')
+            cursor.execute('ALTER TABLE users RENAME TO users_legacy')
+            # الورد اليومي كان يُستأنف حسب user_id، فلا تصلح نقطته بعد الترحيل
+            cursor.execute("UPDATE broadcast_runs SET status = 'abandoned' WHERE status = 'running' AND job_name LIKE 'daily_wird%'")
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        logger.info("🔁 ترحيل المشتركين: %d صف -> %d محادثة", rows, chats)
+    
+    def assign_delivery_slots(self):
+        """حساب موضع التوصيل للمحادثات التي أُضيفت بدونه (الترحيل والقواعد الأقدم)"""
+        cursor = self.conn.cursor()
+        cursor.execute("PRAGMA table_info(chats)")
+        if 'delivery_slot' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE chats ADD COLUMN delivery_slot INTEGER')
+            # نقطة استئناف التذكيرات الثابتة كانت chat_id ولا تصلح مع الترتيب حسب الموضع
+            cursor.execute("UPDATE broadcast_runs SET status = 'abandoned' WHERE status = 'running' AND job_name NOT LIKE 'daily_wird%' AND job_name NOT LIKE 'bakarah%'")
+        chat_ids = [row[0] for row in cursor.execute('SELECT chat_id FROM chats WHERE delivery_slot IS NULL').fetchall()]
+        cursor.executemany('UPDATE chats SET delivery_slot = ? WHERE chat_id = ?', [(delivery_slot(chat_id), chat_id) for chat_id in chat_ids])
+        self.conn.commit()
+    
+    def update_chat_settings(self, chat_id: int, values: dict):
+        """تحديث عدة إعدادات في استعلام UPDATE واحد"""
+        unknown = set(values) - set(self.SETTING_COLUMNS)
+        if unknown:
+            raise ValueError(f'Unknown settings: {sorted(unknown)}')
+        assignments = ', '.join(f'{column} = ?' for column in values)
+        cursor = self.conn.cursor()
+        cursor.execute(f'UPDATE chats SET {assignments} WHERE chat_id = ?', (*values.values(), chat_id))
+        self.conn.commit()
+    
+    def get_all_chats(self):
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT * FROM chats')
+        return cursor.fetchall()
+    
+    def update_current_page(self, chat_id: int, page: int):
+        cursor = self.conn.cursor()
+        cursor.execute('UPDATE chats SET current_page = ? WHERE chat_id = ?', (page, chat_id))
+        self.conn.commit()
+    
+    def update_current_pages(self, progress: list):
+        """حفظ تقدّم قراءة عدة محادثات في معاملة واحدة"""
+        cursor = self.conn.cursor()
+        cursor.executemany('UPDATE chats SET current_page = ? WHERE chat_id = ?', [(page, chat_id) for chat_id, page in progress])
+        self.conn.commit()
+    
+    def get_media_file_id(self, asset_path: str, content_hash: str) -> Optional[str]:
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'SELECT file_id FROM media_cache WHERE asset_path = ? AND content_hash = ?',
+            (asset_path, content_hash)
+        )
+        row = cursor.fetchone()
+        return row[0] if row else None
+    
+    def save_media_file_id(self, asset_path: str, content_hash: str, file_id: str):
+        cursor = self.conn.cursor()
+        # حذف النسخ القديمة من نفس الملف بعد تغيّر محتواه
+        cursor.execute('DELETE FROM media_cache WHERE asset_path = ? AND content_hash != ?', (asset_path, content_hash))
+        cursor.execute(
+            'INSERT OR REPLACE INTO media_cache (asset_path, content_hash, file_id) VALUES (?, ?, ?)',
+            (asset_path, content_hash, file_id)
+        )
+        self.conn.commit()
+    
+    def delete_media_file_id(self, asset_path: str):
+        cursor = self.conn.cursor()
+        cursor.execute('DELETE FROM media_cache WHERE asset_path = ?', (asset_path,))
+        self.conn.commit()
+    
+    def begin_broadcast(self, run_id: str, job_name: str, callback: str, data: dict):
+        """تسجيل عملية بث جديدة أو استرجاع حالتها: (status, checkpoint, processed, targets)"""
+        cursor = self.conn.cursor()
+        cursor.execute(
+            'INSERT OR IGNORE INTO broadcast_runs (run_id, job_name, callback, data) VALUES (?, ?, ?, ?)',
+            (run_id, job_name, callback, json.dumps(data))
+        )
+        self.conn.commit()
+        cursor.execute('SELECT status, checkpoint, processed FROM broadcast_runs WHERE run_id = ?', (run_id,))
+        status, checkpoint, processed = cursor.fetchone()
+        cursor.execute('SELECT target FROM broadcast_deliveries WHERE run_id = ?', (run_id,))
+        return status, checkpoint, processed, [row[0] for row in cursor.fetchall()]
+    
+    def checkpoint_broadcast(self, run_id: str, checkpoint: Optional[int], processed: int, delivered: list = ()):
+        """تقديم نقطة الاستئناف وتسجيل ما أُرسل بعدها وحذف ما تغطيه، في معاملة واحدة"""
+        cursor = self.conn.cursor()
+        cursor.executemany(
+            'INSERT OR IGNORE INTO broadcast_deliveries (run_id, target) VALUES (?, ?)',
+            [(run_id, target) for target in delivered]
+        )
+        cursor.execute(
+            'UPDATE broadcast_runs SET checkpoint = ?, processed = ?, updated_at = CURRENT_TIMESTAMP WHERE run_id = ?',
+            (checkpoint, processed, run_id)
+        )
+        cursor.execute('DELETE FROM broadcast_deliveries WHERE run_id = ? AND target <= ?', (run_id, checkpoint))
+        self.conn.commit()
+    
+    def finish_broadcast(self, run_id: str, processed: int, status: str = 'done'):
         cursor = self.conn.cursor()
-        cursor.execute(f'UPDATE users SET {setting} = ? WHERE user_id = ?', (value, user_id))
+        cursor.execute(
+            'UPDATE broadcast_runs SET status = ?, processed = ?, updated_at = CURRENT_TIMESTAMP WHERE run_id = ?',
+            (status, processed, run_id)
+        )
+        cursor.execute('DELETE FROM broadcast_deliveries WHERE run_id = ?', (run_id,))
         self.conn.commit()
     
-    def get_all_users(self):
+    def get_unfinished_broadcasts(self):
+        """(run_id, job_name, callback, data, processed, age_hours) لعمليات البث التي انقطعت"""
         cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM users')
+        cursor.execute('''
+            SELECT run_id, job_name, callback, data, processed, (julianday('now') - julianday(started_at)) * 24
+            FROM broadcast_runs WHERE status = 'running'
+        ''')
         return cursor.fetchall()
     
-    def update_current_page(self, user_id: int, page: int):
+    def prune_broadcasts(self, days: int = BROADCAST_JOURNAL_DAYS):
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM broadcast_runs WHERE status != 'running' AND started_at < datetime('now', ?)", (f'-{days} days',))
+        self.conn.commit()
+    
+    def save_outbox(self, entries: list, sent: list) -> list:
+        """إضافة الطلبات المنتظرة وحذف ما أُرسل في معاملة واحدة، وإرجاع معرّفات الطلبات المضافة"""
+        cursor = self.conn.cursor()
+        ids = []
+        for entry in entries:
+            cursor.execute('INSERT INTO outbox (priority, endpoint, payload, run_id, target, deferred) VALUES (?, ?, ?, ?, ?, ?)', entry)
+            ids.append(cursor.lastrowid)
+        cursor.executemany('DELETE FROM outbox WHERE id = ?', [(entry_id,) for entry_id in sent])
+        self.conn.commit()
+        return ids
+    
+    def defer_outbox(self, ids: list):
+        cursor = self.conn.cursor()
+        cursor.executemany('UPDATE outbox SET deferred = 1 WHERE id = ?', [(entry_id,) for entry_id in ids])
+        self.conn.commit()
+    
+    def load_outbox(self, hours: float = BROADCAST_RESUME_HOURS):
+        """(id, priority, endpoint, payload) لما بقي في صندوق الإرسال، بترتيب الأولوية ثم الوصول
+        
+        طلب البث الذي لم يؤجله الإيقاف بقي من انهيار وقد يكون أُرسل، فيُترك لسجل عمليته الذي يعيد ما لم يُسجَّل فقط.
+        أما المؤجل فيُسجَّل مرسلاً في سجل عمليته، فلا يعيد الاستئناف إرساله مع إعادة الصندوق له.
+        """
         cursor = self.conn.cursor()
-        cursor.execute('UPDATE users SET current_page = ? WHERE user_id = ?', (page, user_id))
+        cursor.execute("DELETE FROM outbox WHERE created_at < datetime('now', ?)", (f'-{hours} hours',))
+        cursor.execute('DELETE FROM outbox WHERE run_id IS NOT NULL AND deferred = 0')
+        cursor.execute('''
+            INSERT OR IGNORE INTO broadcast_deliveries (run_id, target)
+            SELECT run_id, target FROM outbox
+            WHERE run_id IN (SELECT run_id FROM broadcast_runs WHERE status = 'running')
+        ''')
         self.conn.commit()
+        cursor.execute('SELECT id, priority, endpoint, payload FROM outbox ORDER BY priority, id')
+        return cursor.fetchall()
+
+class ChatSettings:
+    """إعدادات محادثة واحدة بأسماء الأعمدة بدل فهارس الصف"""
+    __slots__ = (
+        'chat_id', 'daily_pages', 'quran_time', 'current_page',
+        'bakarah_enabled', 'morning_azkar_enabled', 'evening_azkar_enabled',
+        'kahf_enabled', 'mulk_enabled', 'white_days_reminder',
+        'city', 'country', 'timezone_offset', 'is_active',
+    )
+    
+    # القيم الافتراضية للأعمدة الفارغة في القواعد القديمة
+    DEFAULTS = {
+        'daily_pages': 2, 'quran_time': '09:00', 'current_page': 1,
+        'bakarah_enabled': 0, 'morning_azkar_enabled': 1, 'evening_azkar_enabled': 1,
+        'kahf_enabled': 1, 'mulk_enabled': 1, 'white_days_reminder': 1, 'is_active': 1,
+    }
+    
+    def __init__(self, *values):
+        for name, value in itertools.zip_longest(self.__slots__, values):
+            setattr(self, name, self.DEFAULTS.get(name) if value is None else value)
+    
+    def update(self, values: dict):
+        for name, value in values.items():
+            setattr(self, name, value)
+
+class ChatSettingsCache:
+    """ذاكرة LRU محدودة لإعدادات المحادثات"""
+    
+    def __init__(self, max_size: int = USER_CACHE_SIZE):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        # يزيد مع كل تعديل، حتى لا تُحفظ نتيجة قراءة بدأت قبل التعديل
+        self.version = 0
+    
+    def get(self, chat_id: int) -> Optional[ChatSettings]:
+        settings = self.items.get(chat_id)
+        if settings is not None:
+            self.items.move_to_end(chat_id)
+        return settings
+    
+    def put(self, settings: ChatSettings, version: int):
+        if version != self.version:
+            return
+        self.items[settings.chat_id] = settings
+        self.items.move_to_end(settings.chat_id)
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+    
+    def update(self, chat_id: int, values: dict):
+        self.version += 1
+        settings = self.items.get(chat_id)
+        if settings is not None:
+            settings.update(values)
+    
+    def invalidate(self, chat_id: int):
+        self.version += 1
+        self.items.pop(chat_id, None)
+    
+    def clear(self):
+        self.version += 1
+        self.items.clear()
+
+class AsyncDatabase:
+    """واجهة غير متزامنة: الكتابة في خيط مخصص عبر طابور، والقراءة من مجموعة اتصالات"""
+    
+    def __init__(self, path: str = DB_PATH, readers: int = DB_READERS):
+        self.path = path
+        # القاعدة تُفتح وتُرقّى في خيط الكتابة عند أول استخدام، لا عند الاستيراد
+        self.writer = None
+        self.writer_thread = None
+        self.ready = threading.Event()
+        self.open_error = None
+        self.write_queue = queue.Queue()
+        
+        # اتصالات القراءة تُنشأ عند الحاجة، ولا تزيد عن عدد خيوط القراءة
+        self.read_pool = queue.Queue()
+        self.read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-reader')
+        
+        # تقدّم القراءة المنتظر كتابته: chat_id -> current_page
+        self.pending_pages = {}
+        self.flushing_pages = {}
+        self.flush_lock = asyncio.Lock()
+        self.flush_timer = None
+        
+        self.settings_cache = ChatSettingsCache()
+    
+    def start(self):
+        """بدء خيط الكتابة، وهو يفتح القاعدة وينشئ الجداول في الخلفية"""
+        if self.writer_thread is None:
+            self.writer_thread = threading.Thread(target=self._writer_loop, name='db-writer', daemon=True)
+            self.writer_thread.start()
+    
+    def _open_writer(self):
+        try:
+            with startup_timer.measure('database open'):
+                self.writer = Database(self.path)
+        except Exception as e:
+            logger.error("تعذّر فتح قاعدة البيانات: %s", e)
+            self.open_error = e
+        finally:
+            self.ready.set()
+    
+    def _writer_loop(self):
+        self._open_writer()
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                break
+            func, args, loop, future = item
+            try:
+                if self.open_error is not None:
+                    raise self.open_error
+                result = func(self.writer, *args)
+            except Exception as e:
+                loop.call_soon_threadsafe(self._resolve, future, None, e)
+            else:
+                loop.call_soon_threadsafe(self._resolve, future, result, None)
+    
+    @staticmethod
+    def _resolve(future: asyncio.Future, result, error):
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+    
+    async def _write(self, func, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        started = time.perf_counter()
+        self.start()
+        self.write_queue.put((func, args, loop, future))
+        try:
+            return await future
+        finally:
+            DB_QUERY_DURATION.observe(time.perf_counter() - started, query=func.__name__)
+    
+    def _connect_reader(self) -> Database:
+        """اتصال قراءة جديد بعد أن يجهّز خيط الكتابة الجداول"""
+        self.ready.wait()
+        if self.open_error is not None:
+            raise self.open_error
+        return Database(self.path, readonly=True)
+    
+    def _with_reader(self, func, *args):
+        try:
+            reader = self.read_pool.get_nowait()
+        except queue.Empty:
+            reader = self._connect_reader()
+        try:
+            return func(reader, *args)
+        finally:
+            self.read_pool.put(reader)
+    
+    async def _read(self, func, *args):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        self.start()
+        try:
+            return await loop.run_in_executor(self.read_executor, self._with_reader, func, *args)
+        finally:
+            DB_QUERY_DURATION.observe(time.perf_counter() - started, query=func.__name__)
+    
+    async def _iterate(self, func, *args):
+        """تمرير نتائج مولّد القراءة دفعة بعد دفعة دون حجز حلقة الأحداث"""
+        loop = asyncio.get_running_loop()
+        self.start()
+        # اتصال خاص بكل عملية تمرير حتى لا تحجز اتصالات القراءة المشتركة طوال البث
+        reader = await loop.run_in_executor(self.read_executor, self._connect_reader)
+        try:
+            rows = func(reader, *args)
+            while True:
+                started = time.perf_counter()
+                chunk = await loop.run_in_executor(self.read_executor, list, itertools.islice(rows, DB_CHUNK_SIZE))
+                DB_QUERY_DURATION.observe(time.perf_counter() - started, query=func.__name__)
+                if not chunk:
+                    break
+                for row in chunk:
+                    yield row
+        finally:
+            reader.close()
+    
+    async def add_chat(self, chat_id: int, user_id: Optional[int] = None):
+        await self._write(Database.add_chat, chat_id, user_id)
+        self.settings_cache.invalidate(chat_id)
+    
+    async def deactivate_chat(self, chat_id: int) -> int:
+        changed = await self._write(Database.deactivate_chat, chat_id)
+        self.settings_cache.invalidate(chat_id)
+        return changed
+    
+    async def migrate_chat(self, old_chat_id: int, new_chat_id: int):
+        await self._write(Database.migrate_chat, old_chat_id, new_chat_id)
+        self.settings_cache.invalidate(old_chat_id)
+        self.settings_cache.invalidate(new_chat_id)
+    
+    async def get_chat(self, chat_id: int):
+        await self._ensure_progress_written(chat_id)
+        return await self._read(Database.get_chat, chat_id)
+    
+    async def get_chat_settings(self, chat_id: int) -> Optional[ChatSettings]:
+        """إعدادات المحادثة من الذاكرة، ومن القاعدة عند أول طلب فقط"""
+        settings = self.settings_cache.get(chat_id)
+        if settings is not None:
+            return settings
+        
+        version = self.settings_cache.version
+        await self._ensure_progress_written(chat_id)
+        settings = await self._read(Database.get_chat_settings, chat_id)
+        if settings is not None:
+            self.settings_cache.put(settings, version)
+        return settings
+    
+    async def update_chat_setting(self, chat_id: int, setting: str, value):
+        return await self.update_chat_settings(chat_id, **{setting: value})
+    
+    async def update_chat_settings(self, chat_id: int, **values):
+        """الكتابة في القاعدة ثم تحديث النسخة المحفوظة في الذاكرة"""
+        await self._write(Database.update_chat_settings, chat_id, values)
+        self.settings_cache.update(chat_id, values)
+    
+    async def toggle_chat_setting(self, chat_id: int, setting: str) -> Optional[bool]:
+        """عكس إعداد تفعيل وإرجاع قيمته الجديدة"""
+        settings = await self.get_chat_settings(chat_id)
+        if settings is None:
+            return None
+        enabled = not getattr(settings, setting)
+        await self.update_chat_settings(chat_id, **{setting: int(enabled)})
+        return enabled
+    
+    async def get_all_chats(self):
+        return await self._read(Database.get_all_chats)
+    
+    async def update_current_page(self, chat_id: int, page: int):
+        """تخزين التقدّم مؤقتاً وكتابته مع غيره دفعة واحدة"""
+        self.pending_pages[chat_id] = page
+        self.settings_cache.update(chat_id, {'current_page': page})
+        if len(self.pending_pages) >= PROGRESS_BATCH_SIZE:
+            await self.flush_progress()
+        elif self.flush_timer is None:
+            loop = asyncio.get_running_loop()
+            self.flush_timer = loop.call_later(PROGRESS_FLUSH_INTERVAL, lambda: asyncio.ensure_future(self.flush_progress()))
+    
+    async def flush_progress(self):
+        async with self.flush_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            if not self.pending_pages:
+                return
+            self.flushing_pages, self.pending_pages = self.pending_pages, {}
+            try:
+                await self._write(Database.update_current_pages, list(self.flushing_pages.items()))
+            finally:
+                self.flushing_pages = {}
+    
+    async def _ensure_progress_written(self, chat_id: int):
+        """ضمان أن تقرأ المحادثة آخر ما كُتب لها"""
+        if chat_id in self.pending_pages or chat_id in self.flushing_pages:
+            await self.flush_progress()
+    
+    async def get_media_file_id(self, asset_path: str, content_hash: str) -> Optional[str]:
+        return await self._read(Database.get_media_file_id, asset_path, content_hash)
+    
+    async def save_media_file_id(self, asset_path: str, content_hash: str, file_id: str):
+        return await self._write(Database.save_media_file_id, asset_path, content_hash, file_id)
+    
+    async def delete_media_file_id(self, asset_path: str):
+        return await self._write(Database.delete_media_file_id, asset_path)
+    
+    def iter_chat_ids(self, flag: Optional[str] = None, tz: Optional[int] = None, after: Optional[int] = None, shard: Optional[tuple] = None):
+        return self._iterate(Database.iter_chat_ids, flag, tz, after, shard)
+    
+    def iter_window_chat_ids(self, flag: Optional[str] = None, tz: Optional[int] = None, after: Optional[int] = None, shard: Optional[tuple] = None):
+        return self._iterate(Database.iter_window_chat_ids, flag, tz, after, shard)
+    
+    def iter_window_chat_countries(self, flag: Optional[str] = None, tz: Optional[int] = None, after: Optional[int] = None, shard: Optional[tuple] = None):
+        return self._iterate(Database.iter_window_chat_countries, flag, tz, after, shard)
+    
+    def iter_timezone_offsets(self):
+        return self._iterate(Database.iter_timezone_offsets)
+    
+    def iter_quran_slots(self):
+        return self._iterate(Database.iter_quran_slots)
+    
+    def iter_wird_targets(self, quran_time: str, tz: int, after: Optional[int] = None, shard: Optional[tuple] = None):
+        return self._iterate(Database.iter_wird_targets, quran_time, tz, after, shard)
+    
+    async def get_wird_progress(self, chat_id: int):
+        await self._ensure_progress_written(chat_id)
+        return await self._read(Database.get_wird_progress, chat_id)
+    
+    def iter_bakarah_cities(self):
+        return self._iterate(Database.iter_bakarah_cities)
+    
+    def iter_bakarah_chat_ids(self, city: str, country: str, after: Optional[int] = None, shard: Optional[tuple] = None):
+        return self._iterate(Database.iter_bakarah_chat_ids, city, country, after, shard)
+    
+    async def begin_broadcast(self, run_id: str, job_name: str, callback: str, data: dict):
+        return await self._write(Database.begin_broadcast, run_id, job_name, callback, data)
+    
+    async def checkpoint_broadcast(self, run_id: str, checkpoint: Optional[int], processed: int, delivered: list = ()):
+        return await self._write(Database.checkpoint_broadcast, run_id, checkpoint, processed, delivered)
+    
+    async def finish_broadcast(self, run_id: str, processed: int, status: str = 'done'):
+        return await self._write(Database.finish_broadcast, run_id, processed, status)
+    
+    async def get_unfinished_broadcasts(self):
+        return await self._read(Database.get_unfinished_broadcasts)
+    
+    async def prune_broadcasts(self, days: int = BROADCAST_JOURNAL_DAYS):
+        return await self._write(Database.prune_broadcasts, days)
+    
+    async def save_outbox(self, entries: list, sent: list) -> list:
+        return await self._write(Database.save_outbox, entries, sent)
+    
+    async def defer_outbox(self, ids: list):
+        return await self._write(Database.defer_outbox, ids)
+    
+    async def load_outbox(self):
+        return await self._write(Database.load_outbox)
+    
+    def close(self):
+        """إنهاء خيط الكتابة بعد تنفيذ كل ما في الطابور ثم إغلاق الاتصالات"""
+        if self.writer_thread is not None:
+            self.write_queue.put(None)
+            self.writer_thread.join()
+        self.read_executor.shutdown(wait=True)
+        while not self.read_pool.empty():
+            self.read_pool.get().close()
+        if self.writer is not None:
+            self.writer.checkpoint()
+            self.writer.close()
 
-db = Database()
+db = AsyncDatabase()
 
 # ======================== المدن المتاحة ========================
 CITIES = {
@@ -150,57 +1204,550 @@ CITIES = {
     '🇲🇦 الرباط': ('Rabat', 'Morocco', 1),
 }
 
-# ======================== API التقويم الهجري ========================
-class IslamicCalendar:
-    @staticmethod
-    def get_hijri_date():
-        try:
-            response = requests.get('http://api.aladhan.com/v1/gToH', timeout=10)
-            if response.status_code == 200:
-                data = response.json()
-                hijri = data['data']['hijri']
-                return {
-                    'day': int(hijri['day']),
-                    'month': int(hijri['month']['number']),
-                    'month_name': hijri['month']['ar'],
-                    'year': hijri['year']
-                }
-        except:
-            pass
-        return None
+# إحداثيات كل مدينة وطريقة الحساب المعتمدة فيها: (خط العرض، خط الطول، الطريقة)
+CITY_COORDINATES = {
+    'Makkah': (21.4225, 39.8262, 'UmmAlQura'),
+    'Madinah': (24.4672, 39.6111, 'UmmAlQura'),
+    'Riyadh': (24.7136, 46.6753, 'UmmAlQura'),
+    'Jeddah': (21.4858, 39.1925, 'UmmAlQura'),
+    'Dubai': (25.2048, 55.2708, 'Dubai'),
+    'Abu Dhabi': (24.4539, 54.3773, 'Dubai'),
+    'Cairo': (30.0444, 31.2357, 'Egyptian'),
+    'Alexandria': (31.2001, 29.9187, 'Egyptian'),
+    'Amman': (31.9454, 35.9284, 'Jordan'),
+    'Kuwait City': (29.3759, 47.9774, 'Kuwait'),
+    'Doha': (25.2854, 51.5310, 'Qatar'),
+    'Manama': (26.2285, 50.5860, 'Gulf'),
+    'Muscat': (23.5880, 58.3829, 'Gulf'),
+    'Sanaa': (15.3694, 44.1910, 'MWL'),
+    'Damascus': (33.5138, 36.2765, 'MWL'),
+    'Beirut': (33.8938, 35.5018, 'MWL'),
+    'Baghdad': (33.3152, 44.3661, 'MWL'),
+    'Jerusalem': (31.7683, 35.2137, 'MWL'),
+    'Tripoli': (32.8872, 13.1913, 'Egyptian'),
+    'Tunis': (36.8065, 10.1815, 'Tunisia'),
+    'Algiers': (36.7538, 3.0588, 'Algeria'),
+    'Rabat': (34.0209, -6.8416, 'Morocco'),
+}
+
+# ======================== التقويم الهجري (أم القرى) ========================
+def parse_hijri_offsets(value: str) -> dict:
+    """تحويل "Morocco:-1,Egypt:0" إلى قاموس فروق الأيام لكل دولة"""
+    offsets = {}
+    for item in value.split(','):
+        if ':' in item:
+            country, days = item.rsplit(':', 1)
+            offsets[country.strip()] = int(days)
+    return offsets
+
+# فرق أيام اختياري لكل دولة تعتمد رؤية محلية تختلف عن أم القرى
+HIJRI_DAY_OFFSETS = parse_hijri_offsets(os.environ.get("HIJRI_DAY_OFFSETS", ""))
+
+class HijriCalendar:
+    """تحويل التاريخ الميلادي إلى هجري محلياً حسب تقويم أم القرى"""
     
-    @staticmethod
-    def get_prayer_times(city="Makkah", country="Saudi Arabia"):
-        try:
-            response = requests.get(
-                f'http://api.aladhan.com/v1/timingsByCity',
-                params={'city': city, 'country': country},
-                timeout=10
-            )
-            if response.status_code == 200:
-                data = response.json()
-                timings = data['data']['timings']
-                return {
-                    'Fajr': timings['Fajr'],
-                    'Dhuhr': timings['Dhuhr'],
-                    'Asr': timings['Asr'],
-                    'Maghrib': timings['Maghrib'],
-                    'Isha': timings['Isha']
-                }
-        except:
-            pass
-        return None
+    # 1 محرم 1440
+    EPOCH = date(2018, 9, 11)
+    FIRST_YEAR = 1440
+    # كل سنة 12 بت: البت رقم n يعني أن الشهر n+1 ثلاثون يوماً وإلا فتسعة وعشرون
+    MONTH_LENGTHS = (
+        0x2BA, 0x5B5, 0x5AA, 0xD55, 0xA9A, 0x92E, 0x26E, 0x55D, 0xADA, 0x6D4,  # 1440 - 1449
+        0x6A5, 0x54B, 0xA97, 0x54E, 0xAAE, 0x5AC, 0xBA9, 0xD92, 0xB25, 0x64B,  # 1450 - 1459
+        0xCAB, 0x55A, 0xB55, 0x6D2, 0xEA5, 0xE4A, 0xA95, 0x52D, 0xAAD, 0x36C,  # 1460 - 1469
+        0x759,                                                                 # 1470
+    )
+    MONTH_NAMES = (
+        'مُحَرَّم', 'صَفَر', 'رَبيع الأوَّل', 'رَبيع الثاني', 'جُمادى الأولى', 'جُمادى الآخرة',
+        'رَجَب', 'شَعْبان', 'رَمَضان', 'شَوّال', 'ذوالقعدة', 'ذوالحجة',
+    )
+    
+    @classmethod
+    def _build_month_starts(cls) -> list:
+        starts = []
+        ordinal = cls.EPOCH.toordinal()
+        for year_bits in cls.MONTH_LENGTHS:
+            for month in range(12):
+                starts.append(ordinal)
+                ordinal += 30 if year_bits >> month & 1 else 29
+        starts.append(ordinal)
+        return starts
     
     @staticmethod
-    def check_islamic_occasions():
-        hijri = IslamicCalendar.get_hijri_date()
-        if not hijri:
+    @lru_cache(maxsize=64)
+    def convert(gregorian: date, day_offset: int = 0) -> Optional[dict]:
+        ordinal = gregorian.toordinal() + day_offset
+        starts = HIJRI_MONTH_STARTS
+        if not starts[0] <= ordinal < starts[-1]:
+            logger.warning("التاريخ %s خارج جدول أم القرى", gregorian)
             return None
         
-        day = hijri['day']
-        month = hijri['month']
+        # بحث ثنائي عن الشهر الذي يحتوي اليوم
+        low, high = 0, len(starts) - 2
+        while low < high:
+            mid = (low + high + 1) // 2
+            if starts[mid] <= ordinal:
+                low = mid
+            else:
+                high = mid - 1
         
-        occasions = {
+        return {
+            'day': ordinal - starts[low] + 1,
+            'month': low % 12 + 1,
+            'month_name': HijriCalendar.MONTH_NAMES[low % 12],
+            'year': str(HijriCalendar.FIRST_YEAR + low // 12)
+        }
+
+HIJRI_MONTH_STARTS = HijriCalendar._build_month_starts()
+
+# ======================== مواقيت الصلاة (حساب فلكي محلي) ========================
+class PrayerTimesCalculator:
+    """حساب مواقيت الصلاة فلكياً دون الحاجة للإنترنت"""
+    
+    # زاوية الفجر والعشاء، أو عدد دقائق العشاء بعد المغرب
+    METHODS = {
+        'MWL': {'fajr': 18, 'isha': 17},
+        'ISNA': {'fajr': 15, 'isha': 15},
+        'Egyptian': {'fajr': 19.5, 'isha': 17.5},
+        'UmmAlQura': {'fajr': 18.5, 'isha_minutes': 90},
+        'Karachi': {'fajr': 18, 'isha': 18},
+        'Gulf': {'fajr': 19.5, 'isha_minutes': 90},
+        'Kuwait': {'fajr': 18, 'isha': 17.5},
+        'Qatar': {'fajr': 18, 'isha_minutes': 90},
+        'Dubai': {'fajr': 18.2, 'isha': 18.2},
+        'Jordan': {'fajr': 18, 'isha': 18},
+        'Tunisia': {'fajr': 18, 'isha': 18},
+        'Algeria': {'fajr': 18, 'isha': 17},
+        'Morocco': {'fajr': 19, 'isha': 17},
+    }
+    # طول الظل في العصر: الجمهور (المثل) أو الحنفية (المثلان)
+    ASR_FACTORS = {'Standard': 1, 'Hanafi': 2}
+    PRAYERS = ('Fajr', 'Dhuhr', 'Asr', 'Maghrib', 'Isha')
+    
+    @staticmethod
+    def julian_day(day: date) -> float:
+        """اليوم اليولياني عند منتصف الليل بالتوقيت العالمي"""
+        return day.toordinal() + 1721424.5
+    
+    @staticmethod
+    def sun_position(jd: float) -> tuple:
+        """(الميل الشمسي بالدرجات، معادلة الزمن بالساعات)"""
+        d = jd - 2451545.0
+        g = math.radians((357.529 + 0.98560028 * d) % 360)
+        q = (280.459 + 0.98564736 * d) % 360
+        l = math.radians((q + 1.915 * math.sin(g) + 0.020 * math.sin(2 * g)) % 360)
+        e = math.radians(23.439 - 0.00000036 * d)
+        ra = (math.degrees(math.atan2(math.cos(e) * math.sin(l), math.cos(l))) / 15) % 24
+        eqt = q / 15 - ra
+        eqt = (eqt + 12) % 24 - 12
+        decl = math.degrees(math.asin(math.sin(e) * math.sin(l)))
+        return decl, eqt
+    
+    @staticmethod
+    def ephemeris(first_day: date, days: int) -> list:
+        """موقع الشمس عند منتصف ليل كل يوم، مشترك بين كل المدن"""
+        jd = PrayerTimesCalculator.julian_day(first_day)
+        return [PrayerTimesCalculator.sun_position(jd + i) for i in range(days)]
+    
+    @staticmethod
+    def compute_year(ephemeris: list, days: int, lat: float, lng: float, tz: float,
+                     method: str = 'MWL', asr: str = 'Standard', ramadan: frozenset = frozenset()) -> array:
+        """مواقيت كل أيام السنة لمدينة واحدة بالدقائق منذ منتصف الليل المحلي
+        
+        ephemeris يبدأ بيوم قبل أول يوم في السنة، وramadan أرقام أيام رمضان فيها
+        """
+        params = PrayerTimesCalculator.METHODS[method]
+        asr_factor = PrayerTimesCalculator.ASR_FACTORS[asr]
+        sin_lat = math.sin(math.radians(lat))
+        cos_lat = math.cos(math.radians(lat))
+        sin_fajr = math.sin(math.radians(params['fajr']))
+        sin_sunset = math.sin(math.radians(0.833))
+        sin_isha = math.sin(math.radians(params['isha'])) if 'isha' in params else None
+        shift = tz - lng / 15
+        result = array('H')
+        
+        def hour_angle(sin_angle, decl):
+            value = (-sin_angle - math.sin(decl) * sin_lat) / (math.cos(decl) * cos_lat)
+            return math.degrees(math.acos(max(-1.0, min(1.0, value)))) / 15
+        
+        # موقع الشمس عند الأوقات التقريبية (5، 12، 13، 18 بالتوقيت الشمسي المحلي)
+        fractions = [hour / 24 - lng / 360 for hour in (5, 12, 13, 18)]
+        
+        for day in range(1, days + 1):
+            positions = []
+            for fraction in fractions:
+                index = day + fraction
+                base = int(index)
+                weight = index - base
+                decl0, eqt0 = ephemeris[base]
+                decl1, eqt1 = ephemeris[base + 1]
+                positions.append((math.radians(decl0 + (decl1 - decl0) * weight), eqt0 + (eqt1 - eqt0) * weight))
+            
+            (decl_fajr, eqt_fajr), (_, eqt_noon), (decl_asr, eqt_asr), (decl_night, eqt_night) = positions
+            asr_angle = -math.atan(1 / (asr_factor + math.tan(abs(math.radians(lat) - decl_asr))))
+            
+            fajr = 12 - eqt_fajr - hour_angle(sin_fajr, decl_fajr)
+            dhuhr = 12 - eqt_noon
+            asr_time = 12 - eqt_asr + hour_angle(math.sin(asr_angle), decl_asr)
+            maghrib = 12 - eqt_night + hour_angle(sin_sunset, decl_night)
+            if day - 1 in ramadan and method == 'UmmAlQura':
+                # أم القرى: العشاء بعد المغرب بساعتين في رمضان
+                isha = maghrib + 2
+            elif sin_isha is not None:
+                isha = 12 - eqt_night + hour_angle(sin_isha, decl_night)
+            else:
+                isha = maghrib + params['isha_minutes'] / 60
+            
+            result.extend(int(round((t + shift) * 60)) % 1440 for t in (fajr, dhuhr, asr_time, maghrib, isha))
+        return result
+
+class PrayerTimesTable:
+    """جدول سنوي مضغوط لمواقيت كل مدينة في CITIES، والبحث فيه O(1)"""
+    
+    def __init__(self, year: int, asr: str = 'Standard'):
+        self.year = year
+        self.first_day = date(year, 1, 1)
+        self.days = (date(year + 1, 1, 1) - self.first_day).days
+        self.asr = asr
+        self.tables = {}
+        self.build()
+    
+    def build(self):
+        started = time.perf_counter()
+        # يوم إضافي قبل السنة وبعدها للاستيفاء الخطي
+        ephemeris = PrayerTimesCalculator.ephemeris(self.first_day - timedelta(days=1), self.days + 3)
+        # أيام رمضان في هذه السنة من جدول أم القرى
+        first = self.first_day.toordinal()
+        ramadan = set()
+        for index in range(8, len(HIJRI_MONTH_STARTS) - 1, 12):
+            for ordinal in range(HIJRI_MONTH_STARTS[index], HIJRI_MONTH_STARTS[index + 1]):
+                if 0 <= ordinal - first < self.days:
+                    ramadan.add(ordinal - first)
+        
+        for city, country, tz in CITIES.values():
+            if city not in CITY_COORDINATES:
+                continue
+            lat, lng, method = CITY_COORDINATES[city]
+            table = PrayerTimesCalculator.compute_year(ephemeris, self.days, lat, lng, tz, method, self.asr, ramadan)
+            self.tables[(city, country)] = table
+        
+        logger.info("🕌 جدول المواقيت %s: %d مدينة في %.0f ms", self.year, len(self.tables), (time.perf_counter() - started) * 1000)
+    
+    def get(self, city: str, country: str, day: date) -> Optional[dict]:
+        table = self.tables.get((city, country))
+        if table is None:
+            return None
+        offset = (day - self.first_day).days * 5
+        return {
+            prayer: f'{table[offset + i] // 60:02d}:{table[offset + i] % 60:02d}'
+            for i, prayer in enumerate(PrayerTimesCalculator.PRAYERS)
+        }
+
+PRAYER_ASR_METHOD = os.environ.get("PRAYER_ASR_METHOD", "Standard")
+_prayer_tables = {}
+
+def get_prayer_table(year: int) -> PrayerTimesTable:
+    if year not in _prayer_tables:
+        _prayer_tables[year] = PrayerTimesTable(year, PRAYER_ASR_METHOD)
+    return _prayer_tables[year]
+
+# ======================== عميل HTTP ========================
+class CircuitBreaker:
+    """إيقاف الطلبات إلى خدمة بعد أخطاء متتالية، ثم السماح بطلب تجربة واحد بعد مهلة"""
+    
+    def __init__(self, failures: int = CIRCUIT_FAILURES, reset_after: float = CIRCUIT_RESET):
+        self.max_failures = failures
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if time.monotonic() - self.opened_at >= self.reset_after else 'open'
+    
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self.probing:
+            self.probing = True
+            return True
+        return False
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+    
+    def record_failure(self) -> bool:
+        """تسجيل خطأ، وإرجاع True إن فُتحت الدائرة بسببه"""
+        self.failures += 1
+        self.probing = False
+        was_open = self.opened_at is not None
+        if was_open or self.failures >= self.max_failures:
+            # فشل طلب التجربة يعيد بدء المهلة
+            self.opened_at = time.monotonic()
+            return not was_open
+        return False
+
+class HttpClient:
+    """عميل httpx مشترك لخدمة خارجية: اتصالات مستمرة بين الطلبات، مهلات، وقاطع دائرة"""
+    
+    def __init__(self, service: str, base_url: str, timeout: float = HTTP_TIMEOUT):
+        self.service = service
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.breaker = CircuitBreaker()
+        self.client = None
+    
+    def _client(self) -> httpx.AsyncClient:
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 5)),
+                limits=httpx.Limits(
+                    max_connections=HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                    keepalive_expiry=HTTP_KEEPALIVE,
+                ),
+            )
+        return self.client
+    
+    async def get_json(self, path: str, params: Optional[dict] = None):
+        """GET وإرجاع JSON، أو None عند الخطأ أو إن كانت الدائرة مفتوحة"""
+        if not self.breaker.allow():
+            EXTERNAL_API_ERRORS.inc(service=self.service, error='circuit_open')
+            return None
+        
+        started = time.perf_counter()
+        try:
+            response = await self._client().get(path, params=params)
+            # 4xx خطأ في الطلب نفسه (مدينة غير معروفة مثلاً) لا في الخدمة
+            if response.status_code >= 500:
+                response.raise_for_status()
+        except httpx.HTTPError as e:
+            EXTERNAL_API_ERRORS.inc(service=self.service, error=type(e).__name__)
+            if self.breaker.record_failure():
+                logger.warning("⚡ إيقاف الطلبات إلى %s لمدة %.0f ث بعد %d أخطاء متتالية: %s",
+                               self.service, self.breaker.reset_after, self.breaker.failures, e)
+            return None
+        except asyncio.CancelledError:
+            self.breaker.probing = False
+            raise
+        finally:
+            EXTERNAL_API_LATENCY.observe(time.perf_counter() - started, service=self.service)
+        
+        self.breaker.record_success()
+        if response.is_error:
+            EXTERNAL_API_ERRORS.inc(service=self.service, error=str(response.status_code))
+            return None
+        try:
+            return response.json()
+        except ValueError:
+            EXTERNAL_API_ERRORS.inc(service=self.service, error='invalid_json')
+            return None
+    
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+# ======================== تقويم المواقيت الشهري (aladhan) ========================
+# مصدر المواقيت: local للجدول المحلي، و aladhan لتقويم aladhan الشهري لكل مدن CITIES (طلب لكل مدينة في الشهر).
+# مدن المشتركين خارج الجدول المحلي تُجلب من aladhan في الحالتين
+PRAYER_TIMES_SOURCE = os.environ.get("PRAYER_TIMES_SOURCE", "local").lower()
+PRAYER_CACHE_PATH = Path(os.environ.get("PRAYER_CACHE_PATH", "cache/prayer_times"))
+PRAYER_CACHE_TTL_DAYS = float(os.environ.get("PRAYER_CACHE_TTL_DAYS", 35))
+# جلب الشهر التالي قبل بدايته بهذه المدة
+PRAYER_PREFETCH_DAYS = 7
+# أرقام طرق الحساب في aladhan المقابلة لطرق CITY_COORDINATES
+ALADHAN_METHODS = {
+    'Karachi': 1, 'ISNA': 2, 'MWL': 3, 'UmmAlQura': 4, 'Egyptian': 5, 'Gulf': 8, 'Kuwait': 9,
+    'Qatar': 10, 'Dubai': 16, 'Tunisia': 18, 'Algeria': 19, 'Morocco': 21, 'Jordan': 23,
+}
+
+def needs_prayer_calendar(city: str, country: str) -> bool:
+    """هل تُؤخذ مواقيت المدينة من تقويم aladhan بدل الجدول المحلي"""
+    return PRAYER_TIMES_SOURCE == 'aladhan' or city not in CITY_COORDINATES
+
+class PrayerCalendar:
+    """تقويم aladhan الشهري لكل (مدينة، دولة، شهر) في الذاكرة وعلى القرص بمدة صلاحية
+    
+    البحث متزامن ولا يطلب الشبكة؛ الجلب يتم مسبقاً في الخلفية أو قبل جدولة ورد البقرة.
+    الشهر المنتهية صلاحيته يبقى مستخدماً حتى يُجلب بدلاً منه، فانقطاع aladhan لا يُفقد المواقيت.
+    مواقيت aladhan بالتوقيت المحلي شاملاً التوقيت الصيفي، فتُحفظ معها منطقتها الزمنية.
+    """
+    
+    def __init__(self, http: HttpClient, path: Path = PRAYER_CACHE_PATH, ttl_days: float = PRAYER_CACHE_TTL_DAYS):
+        self.http = http
+        self.path = path
+        self.ttl = ttl_days * 86400
+        # (city, country, 'YYYY-MM') -> {'fetched_at': ..., 'timezone': 'Africa/Cairo', 'days': {'DD': {prayer: 'HH:MM'}}}
+        self.months = {}
+        self.loading = None
+        # طلبات الجلب الجارية حتى لا يُطلب نفس الشهر مرتين
+        self.fetching = {}
+    
+    @staticmethod
+    def month_key(day: date) -> str:
+        return f'{day.year:04d}-{day.month:02d}'
+    
+    def file_path(self, city: str, country: str, month: str) -> Path:
+        name = f'{city}_{country}_{month}'.replace(' ', '_').replace('/', '_')
+        return self.path / f'{name}.json'
+    
+    def fresh(self, entry: Optional[dict]) -> bool:
+        # الأشهر المحفوظة قبل حفظ المنطقة الزمنية تُجلب من جديد
+        return entry is not None and 'timezone' in entry and time.time() - entry['fetched_at'] < self.ttl
+    
+    def load(self):
+        """قراءة الأشهر المحفوظة على القرص، وحذف الأشهر الماضية"""
+        current = self.month_key(date.today())
+        for file in self.path.glob('*.json'):
+            try:
+                with open(file, encoding='utf-8') as f:
+                    entry = json.load(f)
+                key = (entry['city'], entry['country'], entry['month'])
+            except (OSError, ValueError, KeyError):
+                continue
+            if entry['month'] < current:
+                file.unlink(missing_ok=True)
+                continue
+            self.months.setdefault(key, entry)
+    
+    async def ensure_loaded(self):
+        if self.loading is None:
+            self.loading = asyncio.ensure_future(asyncio.to_thread(self.load))
+        await self.loading
+    
+    def save(self, entry: dict):
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            target = self.file_path(entry['city'], entry['country'], entry['month'])
+            temp = target.with_suffix('.tmp')
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(temp, target)
+        except OSError as e:
+            logger.warning("تعذّر حفظ تقويم المواقيت: %s", e)
+    
+    def get(self, city: str, country: str, day: date) -> Optional[dict]:
+        entry = self.months.get((city, country, self.month_key(day)))
+        return entry['days'].get(f'{day.day:02d}') if entry else None
+    
+    def zone(self, city: str, country: str, day: date) -> Optional[ZoneInfo]:
+        """المنطقة الزمنية التي كُتبت بها مواقيت الشهر، أو None إن لم تكن معروفة"""
+        entry = self.months.get((city, country, self.month_key(day)))
+        return get_zone(entry.get('timezone')) if entry else None
+    
+    @staticmethod
+    def parse(payload) -> tuple:
+        """({'DD': {'Fajr': 'HH:MM', ...}}, 'Africa/Cairo') من استجابة calendarByCity"""
+        days = {}
+        zone = None
+        try:
+            for item in payload['data']:
+                # aladhan يضيف اختصار المنطقة بعد الوقت: "04:12 (EEST)"، واسمها الكامل في meta
+                days[item['date']['gregorian']['day']] = {
+                    prayer: item['timings'][prayer].split()[0] for prayer in PrayerTimesCalculator.PRAYERS
+                }
+                zone = zone or item.get('meta', {}).get('timezone')
+        except (TypeError, KeyError, IndexError, AttributeError):
+            return {}, None
+        return days, zone
+    
+    async def _fetch(self, key: tuple, year: int, month: int) -> bool:
+        city, country, _ = key
+        params = {'city': city, 'country': country}
+        if city in CITY_COORDINATES:
+            # نفس طريقة الحساب والعصر المستخدمة في الجدول المحلي
+            params['method'] = ALADHAN_METHODS[CITY_COORDINATES[city][2]]
+            params['school'] = 1 if PRAYER_ASR_METHOD == 'Hanafi' else 0
+        days, zone = self.parse(await self.http.get_json(f'/calendarByCity/{year}/{month}', params))
+        if not days:
+            return False
+        entry = {'city': city, 'country': country, 'month': key[2], 'fetched_at': time.time(), 'timezone': zone, 'days': days}
+        self.months[key] = entry
+        await asyncio.to_thread(self.save, entry)
+        return True
+    
+    async def fetch_month(self, city: str, country: str, year: int, month: int) -> bool:
+        """جلب شهر واحد إن لم يكن محفوظاً وصالحاً، وإرجاع هل مواقيته متاحة"""
+        key = (city, country, f'{year:04d}-{month:02d}')
+        if self.fresh(self.months.get(key)):
+            return True
+        task = self.fetching.get(key)
+        if task is None:
+            task = self.fetching[key] = asyncio.ensure_future(self._fetch(key, year, month))
+            task.add_done_callback(lambda _: self.fetching.pop(key, None))
+        # shield: إلغاء أحد المنتظرين لا يلغي الجلب المشترك
+        return await asyncio.shield(task) or key in self.months
+    
+    async def ensure(self, city: str, country: str, days) -> bool:
+        """ضمان وجود أشهر الأيام المطلوبة للمدينة"""
+        await self.ensure_loaded()
+        months = sorted({(day.year, day.month) for day in days})
+        results = await asyncio.gather(*(self.fetch_month(city, country, year, month) for year, month in months))
+        return all(results)
+    
+    async def prefetch(self, cities) -> int:
+        """الشهر الحالي لكل مدينة، والتالي إن اقترب؛ وإرجاع عدد المدن المتاحة مواقيتها"""
+        today = date.today()
+        days = (today, today + timedelta(days=PRAYER_PREFETCH_DAYS))
+        results = await asyncio.gather(*(self.ensure(city, country, days) for city, country in cities))
+        return sum(results)
+
+@lru_cache(maxsize=None)
+def get_zone(name: Optional[str]) -> Optional[ZoneInfo]:
+    if not name:
+        return None
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        logger.warning("منطقة زمنية غير معروفة من aladhan: %s", name)
+        return None
+
+aladhan_http = HttpClient('aladhan', ALADHAN_API_URL)
+prayer_calendar = PrayerCalendar(aladhan_http)
+
+# ======================== API التقويم الهجري ========================
+class IslamicCalendar:
+    @staticmethod
+    def get_hijri_date(gregorian: Optional[date] = None, country: Optional[str] = None):
+        gregorian = gregorian or date.today()
+        return HijriCalendar.convert(gregorian, HIJRI_DAY_OFFSETS.get(country, 0))
+    
+    @staticmethod
+    def get_prayer_times(city="Makkah", country="Saudi Arabia", day: Optional[date] = None):
+        """المواقيت من الذاكرة فقط: تقويم aladhan المجلوب مسبقاً أو الجدول المحلي"""
+        return IslamicCalendar.get_prayer_times_zone(city, country, day)[0]
+    
+    @staticmethod
+    def get_prayer_times_zone(city="Makkah", country="Saudi Arabia", day: Optional[date] = None):
+        """(المواقيت، منطقتها الزمنية): الجدول المحلي بفرق التوقيت الثابت في CITIES فالمنطقة None،
+        وتقويم aladhan بالتوقيت المحلي الفعلي للمدينة"""
+        day = day or date.today()
+        if PRAYER_TIMES_SOURCE == 'aladhan':
+            remote_times = prayer_calendar.get(city, country, day)
+            if remote_times:
+                return remote_times, prayer_calendar.zone(city, country, day)
+        local_times = get_prayer_table(day.year).get(city, country, day)
+        if local_times:
+            return local_times, None
+        return prayer_calendar.get(city, country, day), prayer_calendar.zone(city, country, day)
+    
+    @staticmethod
+    def check_islamic_occasions(gregorian: Optional[date] = None, country: Optional[str] = None):
+        hijri = IslamicCalendar.get_hijri_date(gregorian, country)
+        if not hijri:
+            return None
+        
+        day = hijri['day']
+        month = hijri['month']
+        
+        occasions = {
             (1, 1): "🌙 رأس السنة الهجرية",
             (1, 10): "🕌 يوم عاشوراء\n\nعن ابن عباس رضي الله عنهما: \"ما رأيت النبي ﷺ يتحرى صيام يوم فضله على غيره إلا هذا اليوم، يوم عاشوراء\"",
             (9, 1): "🌙 رمضان كريم\n\n﴿شَهْرُ رَمَضَانَ الَّذِي أُنزِلَ فِيهِ الْقُرْآنُ﴾",
@@ -216,8 +1763,8 @@ class IslamicCalendar:
         return occasions.get((month, day))
     
     @staticmethod
-    def is_day_before_white_days():
-        hijri = IslamicCalendar.get_hijri_date()
+    def is_day_before_white_days(gregorian: Optional[date] = None, country: Optional[str] = None):
+        hijri = IslamicCalendar.get_hijri_date(gregorian, country)
         return hijri and hijri['day'] == 12
 
 # ======================== محتوى الأذكار ========================
@@ -310,85 +1857,550 @@ class IslamicContent:
     def get_random_dhikr():
         return random.choice(IslamicContent.TASBIH_TYPES)
 
+# ======================== فهرس الملفات ========================
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class AssetEntry:
+    """ملف واحد في الفهرس: المسار والحجم وبصمة المحتوى"""
+    __slots__ = ('path', 'size', 'mtime_ns', '_hash')
+    
+    def __init__(self, path: Path, size: int, mtime_ns: int):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self._hash = None
+    
+    @property
+    def hash(self) -> str:
+        # تُحسب عند أول استخدام فقط حتى لا يتأخر التشغيل بقراءة كل الصور
+        if self._hash is None:
+            self._hash = file_sha256(self.path)
+        return self._hash
+
+class AssetManifest:
+    """فهرس لكل الصور وملفات PDF يُبنى مرة عند التشغيل ويُحدّث عند تغيّر المجلدات"""
+    
+    # النوع -> (المجلد، هل أسماء الملفات أرقام صفحات)
+    DIRECTORIES = {
+        'quran': (QURAN_PAGES_PATH, True),
+        'bakarah': (BAKARAH_QIYAM_PATH, True),
+        'azkar': (AZKAR_PATH, False),
+        'pdf': (PDF_PATH, False),
+    }
+    
+    def __init__(self, check_interval: float = ASSET_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.entries = {}
+        self.by_path = {}
+        # مسار الأصل -> (نسخة الرفع، حجم وبصمة الأصل الذي أُنتجت منه)
+        self.optimized = {}
+        self.sources = {}
+        self.variant_records = {}
+        self.variants_mtime = None
+        # يُبنى عند أول طلب لملف حتى لا يتأخر التشغيل بفحص المجلدات
+        self.checked = None
+    
+    def load_variant_records(self):
+        try:
+            mtime_ns = OPTIMIZED_MANIFEST.stat().st_mtime_ns
+        except FileNotFoundError:
+            self.variant_records, self.variants_mtime = {}, None
+            return
+        if mtime_ns == self.variants_mtime:
+            return
+        try:
+            with open(OPTIMIZED_MANIFEST, encoding='utf-8') as f:
+                self.variant_records = json.load(f).get('assets', {})
+        except (OSError, ValueError) as e:
+            logger.warning("⚠️ تعذّرت قراءة فهرس الصور المضغوطة: %s", e)
+            self.variant_records = {}
+        self.variants_mtime = mtime_ns
+    
+    def load(self):
+        entries = {}
+        for kind, (directory, numbered) in self.DIRECTORIES.items():
+            if not directory.is_dir():
+                continue
+            for item in os.scandir(directory):
+                stem, _, ext = item.name.rpartition('.')
+                if ext.lower() not in ASSET_EXTENSIONS or not item.is_file():
+                    continue
+                if numbered:
+                    if not stem.isdigit():
+                        continue
+                    stem = int(stem)
+                
+                # نفس ترتيب الأولوية السابق: jpg ثم png ثم jpeg
+                key = (kind, stem)
+                current = entries.get(key)
+                if current and ASSET_EXTENSIONS.index(current.path.suffix[1:].lower()) <= ASSET_EXTENSIONS.index(ext.lower()):
+                    continue
+                
+                stat = item.stat()
+                entry = AssetEntry(directory / item.name, stat.st_size, stat.st_mtime_ns)
+                previous = self.by_path.get(entry.path.as_posix())
+                if previous and previous.size == entry.size and previous.mtime_ns == entry.mtime_ns:
+                    entry._hash = previous._hash
+                entries[key] = entry
+        
+        signature = {entry.path: (entry.size, entry.mtime_ns) for entry in entries.values()}
+        changed = bool(self.entries) and signature != {
+            entry.path: (entry.size, entry.mtime_ns) for entry in self.entries.values()
+        }
+        self.entries = entries
+        self.by_path = {entry.path.as_posix(): entry for entry in entries.values()}
+        self.load_variants()
+        self.checked = time.monotonic()
+        if changed:
+            logger.info("🗂️ تم تحديث فهرس الملفات: %d ملف", len(entries))
+    
+    def load_variants(self):
+        self.load_variant_records()
+        optimized = {}
+        for source, record in self.variant_records.items():
+            if source not in self.by_path:
+                continue
+            path = Path(record['path'])
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if stat.st_size != record['size']:
+                continue
+            variant = AssetEntry(path, stat.st_size, stat.st_mtime_ns)
+            variant._hash = record['hash']
+            optimized[source] = (variant, record['source_size'], record['source_hash'])
+        
+        self.optimized = optimized
+        self.sources = {variant[0].path.as_posix(): self.by_path[source] for source, variant in optimized.items()}
+        self.by_path.update({variant[0].path.as_posix(): variant[0] for variant in optimized.values()})
+    
+    def refresh(self):
+        if self.checked is None or time.monotonic() - self.checked >= self.check_interval:
+            self.load()
+    
+    def ensure_loaded(self):
+        if self.checked is None:
+            self.load()
+    
+    def get(self, kind: str, key) -> Optional[Path]:
+        self.refresh()
+        entry = self.entries.get((kind, key))
+        return entry.path if entry else None
+    
+    def upload_path(self, kind: str, key) -> Optional[Path]:
+        """النسخة المضغوطة إن وُجدت وأُنتجت من نفس محتوى الأصل، وإلا الأصل"""
+        self.refresh()
+        entry = self.entries.get((kind, key))
+        if entry is None:
+            return None
+        if USE_OPTIMIZED_ASSETS and entry.path.as_posix() in self.optimized:
+            variant, source_size, source_hash = self.optimized[entry.path.as_posix()]
+            if entry.size == source_size and entry.hash == source_hash:
+                return variant.path
+        return entry.path
+    
+    def source(self, path: Path) -> Optional[AssetEntry]:
+        """الأصل الذي أُنتجت منه نسخة الرفع"""
+        self.ensure_loaded()
+        return self.sources.get(Path(path).as_posix())
+    
+    def entry(self, path: Path) -> Optional[AssetEntry]:
+        self.ensure_loaded()
+        return self.by_path.get(Path(path).as_posix())
+    
+    def content_hash(self, path: Path) -> str:
+        entry = self.entry(path)
+        if entry is None:
+            return file_sha256(path)
+        return entry.hash
+    
+    @property
+    def total_bytes(self) -> int:
+        self.ensure_loaded()
+        return sum(entry.size for entry in self.entries.values())
+
+class AssetByteCache:
+    """ذاكرة LRU محدودة الحجم لمحتوى الملفات الأكثر استخداماً"""
+    
+    def __init__(self, max_bytes: int = ASSET_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.size = 0
+    
+    def read(self, path: Path) -> bytes:
+        entry = asset_manifest.entry(path)
+        if entry is None:
+            with open(path, 'rb') as f:
+                return f.read()
+        
+        key = (entry.path.as_posix(), entry.size, entry.mtime_ns)
+        data = self.items.get(key)
+        if data is not None:
+            self.items.move_to_end(key)
+            return data
+        
+        with open(entry.path, 'rb') as f:
+            data = f.read()
+        if len(data) <= self.max_bytes:
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+        return data
+
+asset_manifest = AssetManifest()
+asset_bytes = AssetByteCache()
+
 # ======================== إدارة الصور ========================
 class MediaManager:
     @staticmethod
     def get_quran_page_image(page_number: int) -> Optional[Path]:
-        for ext in ['jpg', 'png', 'jpeg']:
-            page_file = QURAN_PAGES_PATH / f"{page_number:04d}.{ext}"
-            if page_file.exists():
-                return page_file
-        return None
+        return asset_manifest.upload_path('quran', page_number)
     
     @staticmethod
     def get_morning_azkar_image() -> Optional[Path]:
-        for ext in ['jpg', 'png', 'jpeg']:
-            image_file = AZKAR_PATH / f"morning_azkar.{ext}"
-            if image_file.exists():
-                return image_file
-        return None
+        return asset_manifest.upload_path('azkar', 'morning_azkar')
     
     @staticmethod
     def get_evening_azkar_image() -> Optional[Path]:
-        for ext in ['jpg', 'png', 'jpeg']:
-            image_file = AZKAR_PATH / f"evening_azkar.{ext}"
-            if image_file.exists():
-                return image_file
-        return None
+        return asset_manifest.upload_path('azkar', 'evening_azkar')
     
     @staticmethod
     def get_mulk_image() -> Optional[Path]:
-        for ext in ['jpg', 'png', 'jpeg']:
-            image_file = AZKAR_PATH / f"surah_mulk.{ext}"
-            if image_file.exists():
-                return image_file
-        return None
+        return asset_manifest.upload_path('azkar', 'surah_mulk')
     
     @staticmethod
     def get_bakarah_qiyam_images(start_page: int, end_page: int) -> list:
         images = []
         for page in range(start_page, end_page + 1):
-            for ext in ['jpg', 'png', 'jpeg']:
-                page_file = BAKARAH_QIYAM_PATH / f"{page:03d}.{ext}"
-                if page_file.exists():
-                    images.append(page_file)
-                    break
+            page_file = asset_manifest.upload_path('bakarah', page)
+            if page_file:
+                images.append(page_file)
         return images
     
     @staticmethod
     def get_kahf_pdf() -> Optional[Path]:
-        pdf_file = PDF_PATH / "surah_kahf.pdf"
-        return pdf_file if pdf_file.exists() else None
+        return asset_manifest.get('pdf', 'surah_kahf')
 
-# ======================== اختيار المدينة ========================
-async def ask_city_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """طلب اختيار المدينة"""
-    keyboard = []
-    cities_list = list(CITIES.keys())
+# ======================== ذاكرة ملفات تيليجرام ========================
+class MediaCache:
+    """حفظ file_id لكل ملف بعد أول رفع حتى لا يُرفع نفس الملف لكل مستخدم"""
+    
+    def __init__(self, database: AsyncDatabase):
+        self.db = database
+        self._file_ids = {}
+        self._locks = {}
+        # قفل مشترك بين عمّال البث (multiprocessing.Lock) حتى لا يرفع أكثر من عامل نفس الملف
+        self.shared_lock = None
     
-    # ترتيب الأزرار في صفوف (3 أزرار في كل صف)
-    for i in range(0, len(cities_list), 2):
-        row = [InlineKeyboardButton(city, callback_data=f'city_{i+j}') 
-               for j, city in enumerate(cities_list[i:i+2])]
-        keyboard.append(row)
+    @staticmethod
+    def asset_key(path: Path) -> str:
+        return Path(path).as_posix()
+    
+    def content_hash(self, path: Path) -> str:
+        """بصمة المحتوى من فهرس الملفات، وتتغير تلقائياً عند تغيّر الملف على القرص"""
+        return asset_manifest.content_hash(path)
+    
+    async def get_file_id(self, path: Path) -> Optional[str]:
+        key = (self.asset_key(path), self.content_hash(path))
+        if key not in self._file_ids:
+            file_id = await self.db.get_media_file_id(*key)
+            if not file_id:
+                return None
+            self._file_ids[key] = file_id
+        return self._file_ids[key]
+    
+    async def store(self, path: Path, file_id: str):
+        key = (self.asset_key(path), self.content_hash(path))
+        self._file_ids = {k: v for k, v in self._file_ids.items() if k[0] != key[0]}
+        self._file_ids[key] = file_id
+        await self.db.save_media_file_id(key[0], key[1], file_id)
+    
+    async def invalidate(self, path: Path):
+        asset_key = self.asset_key(path)
+        self._file_ids = {k: v for k, v in self._file_ids.items() if k[0] != asset_key}
+        await self.db.delete_media_file_id(asset_key)
+    
+    @asynccontextmanager
+    async def lock(self, *paths: Path):
+        """قفل يمنع رفع نفس الملف أكثر من مرة عند الإرسال المتزامن"""
+        key = tuple(self.asset_key(path) for path in paths)
+        if key not in self._locks:
+            self._locks[key] = asyncio.Lock()
+        async with self._locks[key]:
+            if self.shared_lock is None:
+                yield
+                return
+            # محاولة بلا انتظار: إلغاء المهمة أثناء الانتظار لا يترك القفل مأخوذاً في خيط لا يحرره أحد
+            while not self.shared_lock.acquire(block=False):
+                await asyncio.sleep(UPLOAD_LOCK_POLL)
+            try:
+                yield
+            finally:
+                self.shared_lock.release()
+
+media_cache = MediaCache(db)
+
+def read_upload(path: Path) -> bytes:
+    """محتوى الملف للرفع مع احتساب الحجم الموفَّر بالنسخة المضغوطة"""
+    data = asset_bytes.read(path)
+    ASSET_UPLOAD_BYTES.inc(len(data))
+    source = asset_manifest.source(path)
+    if source:
+        ASSET_UPLOAD_SAVED.inc(source.size - len(data))
+    return data
+
+# أخطاء تيليجرام التي تعني أن file_id المحفوظ لم يعد صالحاً (غيرها لا يستدعي إعادة الرفع)
+INVALID_FILE_ID_ERRORS = (
+    'wrong file identifier',
+    'wrong remote file identifier',
+    'file reference expired',
+)
+
+def is_invalid_file_id(error: BadRequest) -> bool:
+    message = str(error).lower()
+    return any(text in message for text in INVALID_FILE_ID_ERRORS)
+
+async def send_cached_photo(bot, chat_id: int, path: Path, **kwargs):
+    """إرسال صورة عبر file_id المحفوظ، ورفعها مرة واحدة فقط عند الحاجة"""
+    file_id = await media_cache.get_file_id(path)
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        except BadRequest as e:
+            if not is_invalid_file_id(e):
+                raise
+            await media_cache.invalidate(path)
     
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    async with media_cache.lock(path):
+        file_id = await media_cache.get_file_id(path)
+        if file_id:
+            return await bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+        message = await bot.send_photo(chat_id=chat_id, photo=read_upload(path), **kwargs)
+        await media_cache.store(path, message.photo[-1].file_id)
+        return message
+
+async def send_cached_document(bot, chat_id: int, path: Path, **kwargs):
+    """إرسال ملف عبر file_id المحفوظ، ورفعه مرة واحدة فقط عند الحاجة"""
+    file_id = await media_cache.get_file_id(path)
+    if file_id:
+        try:
+            return await bot.send_document(chat_id=chat_id, document=file_id, **kwargs)
+        except BadRequest as e:
+            if not is_invalid_file_id(e):
+                raise
+            await media_cache.invalidate(path)
+    
+    async with media_cache.lock(path):
+        file_id = await media_cache.get_file_id(path)
+        if file_id:
+            return await bot.send_document(chat_id=chat_id, document=file_id, **kwargs)
+        message = await bot.send_document(chat_id=chat_id, document=read_upload(path), **kwargs)
+        await media_cache.store(path, message.document.file_id)
+        return message
+
+def build_media_group(items: list, caption: Optional[str], parse_mode: Optional[str]) -> list:
+    media_group = []
+    for idx, media in enumerate(items):
+        if idx == 0 and caption:
+            media_group.append(InputMediaPhoto(media=media, caption=caption, parse_mode=parse_mode))
+        else:
+            media_group.append(InputMediaPhoto(media=media))
+    return media_group
+
+async def send_cached_media_group(bot, chat_id: int, paths: list, caption: Optional[str] = None, parse_mode: Optional[str] = None):
+    """إرسال ألبوم صور عبر file_id المحفوظة، ورفع الألبوم مرة واحدة فقط عند الحاجة"""
+    file_ids = [await media_cache.get_file_id(path) for path in paths]
+    if all(file_ids):
+        try:
+            return await bot.send_media_group(chat_id=chat_id, media=build_media_group(file_ids, caption, parse_mode))
+        except BadRequest as e:
+            if not is_invalid_file_id(e):
+                raise
+            for path in paths:
+                await media_cache.invalidate(path)
+    
+    async with media_cache.lock(*paths):
+        file_ids = [await media_cache.get_file_id(path) for path in paths]
+        if all(file_ids):
+            return await bot.send_media_group(chat_id=chat_id, media=build_media_group(file_ids, caption, parse_mode))
+        
+        items = []
+        for path, file_id in zip(paths, file_ids):
+            if file_id:
+                items.append(file_id)
+            else:
+                items.append(read_upload(path))
+        messages = await bot.send_media_group(chat_id=chat_id, media=build_media_group(items, caption, parse_mode))
+        for path, message in zip(paths, messages):
+            if message.photo:
+                await media_cache.store(path, message.photo[-1].file_id)
+        return messages
+
+# ======================== واجهة المستخدم ========================
+def build_keyboard(rows: list) -> InlineKeyboardMarkup:
+    """بناء لوحة أزرار من صفوف (النص، callback_data)"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(text, callback_data=data) for text, data in row]
+        for row in rows
+    ])
+
+CITY_NAMES = tuple(CITIES)
+
+class UI:
+    """لوحات الأزرار والنصوص الثابتة، تُبنى مرة واحدة عند التشغيل"""
     
-    message = """🌍 *اختر مدينتك*
+    # زران في كل صف
+    CITY_KEYBOARD = build_keyboard([
+        [(city, f'city_{index}') for index, city in enumerate(CITY_NAMES[start:start + 2], start)]
+        for start in range(0, len(CITY_NAMES), 2)
+    ])
+    
+    CITY_PROMPT = """🌍 *اختر مدينتك*
 
 لضبط مواقيت الصلاة والتذكيرات حسب موقعك
 """
     
+    MAIN_MENU = build_keyboard([
+        [("⚙️ إعداداتي", 'settings')],
+        [("📖 الورد اليومي", 'daily_wird')],
+        [("📿 أذكار سريعة", 'quick_azkar')],
+        [("ℹ️ المساعدة", 'help')],
+    ])
+    
+    MAIN_MENU_TEXT = """السلام عليكم ورحمة الله وبركاته 🌙
+
+*وِرْدُ المُسْلِم*
+
+📚 سأساعدك في:
+• قراءة الورد اليومي
+• التذكير بالأذكار
+• المناسبات الإسلامية
+
+اضغط الأزرار أدناه 👇
+"""
+    
+    SETTINGS_MENU = build_keyboard([
+        [("📖 عدد الصفحات", 'set_pages')],
+        [("⏰ وقت الورد", 'set_quran_time')],
+        [("🌍 المدينة", 'set_city')],
+        [("📗 سورة البقرة", 'set_bakarah')],
+        [("🔔 التنبيهات", 'set_notifications')],
+        [("🔙 رجوع", 'back_main')],
+    ])
+    
+    PAGES_MENU = build_keyboard([
+        [("1", 'pages_1'), ("2", 'pages_2'), ("3", 'pages_3')],
+        [("5", 'pages_5'), ("10", 'pages_10'), ("20", 'pages_20')],
+        [("🔙 رجوع", 'settings')],
+    ])
+    
+    QURAN_TIME_MENU = build_keyboard([
+        [(time_str, f'qtime_{time_str}') for time_str in row]
+        for row in (('05:00', '06:00', '07:00'), ('08:00', '09:00', '10:00'), ('20:00', '21:00', '22:00'))
+    ] + [[("🔙 رجوع", 'settings')]])
+    
+    QUICK_AZKAR_MENU = build_keyboard([
+        [("📿 ذكر", 'random_dhikr')],
+        [("🔙 رجوع", 'back_main')],
+    ])
+    
+    GROUP_WELCOME = """
+السلام عليكم 🌙
+
+*وِرْدُ المُسْلِم*
+
+📚 التذكيرات:
+• الورد اليومي
+• أذكار الصباح والمساء
+• سورة الكهف (الجمعة)
+• المناسبات الإسلامية
+
+🕌 بارك الله فيكم
+        """
+    
+    BOT_ADDED_WELCOME = """
+السلام عليكم ورحمة الله وبركاته 🌙
+
+تم تفعيل *وِرْدُ المُسْلِم*
+
+📚 سيتم إرسال:
+• الورد اليومي
+• أذكار الصباح والمساء
+• سورة الكهف (الجمعة)
+• المناسبات الإسلامية
+
+🕌 بارك الله فيكم
+        """
+    
+    HELP_TEXT = """ℹ️ *وِرْدُ المُسْلِم*
+
+/start - البدء
+
+*المميزات:*
+📖 الورد اليومي
+📗 سورة البقرة
+☀️ أذكار الصباح والمساء
+🌙 سورة الملك
+🕋 سورة الكهف
+⚪ الأيام البيض
+📅 المناسبات الاسلامية
+
+*للمجموعات:*
+أضف البوت كأدمن وسيعمل تلقائياً
+
+🤲 بارك الله فيك"""
+    
+    HELP_COMMAND_TEXT = """ℹ️ *وِرْدُ المُسْلِم*
+
+/start - البدء
+
+📖 الورد اليومي
+📗 سورة البقرة
+☀️ أذكار والاستغفار
+🕋 سورة الكهف
+📅 المناسبات الاسلامية
+
+🤲 بارك الله فيك"""
+    
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def bakarah_menu(enabled: bool) -> InlineKeyboardMarkup:
+        return build_keyboard([
+            [("تعطيل ❌" if enabled else "تفعيل ✅", 'toggle_bakarah')],
+            [("🔙 رجوع", 'settings')],
+        ])
+    
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def notifications_menu(kahf: bool, mulk: bool, white: bool) -> InlineKeyboardMarkup:
+        return build_keyboard([
+            [(f"{'✅' if kahf else '❌'} سورة الكهف", 'toggle_kahf')],
+            [(f"{'✅' if mulk else '❌'} سورة الملك", 'toggle_mulk')],
+            [(f"{'✅' if white else '❌'} الأيام البيض", 'toggle_white_days')],
+            [("🔙 رجوع", 'settings')],
+        ])
+
+# ======================== اختيار المدينة ========================
+async def ask_city_selection(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """طلب اختيار المدينة"""
     if update.callback_query:
         await update.callback_query.edit_message_text(
-            message,
-            reply_markup=reply_markup,
+            UI.CITY_PROMPT,
+            reply_markup=UI.CITY_KEYBOARD,
             parse_mode='Markdown'
         )
     else:
         await update.message.reply_text(
-            message,
-            reply_markup=reply_markup,
+            UI.CITY_PROMPT,
+            reply_markup=UI.CITY_KEYBOARD,
             parse_mode='Markdown'
         )
     
@@ -400,13 +2412,12 @@ async def city_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     city_index = int(query.data.split('_')[1])
-    city_name = list(CITIES.keys())[city_index]
+    city_name = CITY_NAMES[city_index]
     city, country, tz = CITIES[city_name]
     
-    user_id = query.from_user.id
-    db.update_user_setting(user_id, 'city', city)
-    db.update_user_setting(user_id, 'country', country)
-    db.update_user_setting(user_id, 'timezone_offset', tz)
+    chat_id = update.effective_chat.id
+    await db.update_chat_settings(chat_id, city=city, country=country, timezone_offset=tz)
+    await refresh_chat_schedule(context, chat_id)
     
     await query.edit_message_text(
         f"✅ تم ضبط المدينة: {city_name}\n\n🕌 مرحباً بك في *وِرْدُ المُسْلِم*",
@@ -420,36 +2431,16 @@ async def city_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """عرض القائمة الرئيسية"""
-    keyboard = [
-        [InlineKeyboardButton("⚙️ إعداداتي", callback_data='settings')],
-        [InlineKeyboardButton("📖 الورد اليومي", callback_data='daily_wird')],
-        [InlineKeyboardButton("📿 أذكار سريعة", callback_data='quick_azkar')],
-        [InlineKeyboardButton("ℹ️ المساعدة", callback_data='help')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    message = """السلام عليكم ورحمة الله وبركاته 🌙
-
-*وِرْدُ المُسْلِم*
-
-📚 سأساعدك في:
-• قراءة الورد اليومي
-• التذكير بالأذكار
-• المناسبات الإسلامية
-
-اضغط الأزرار أدناه 👇
-"""
-    
     if update.callback_query:
         await update.callback_query.message.reply_text(
-            message,
-            reply_markup=reply_markup,
+            UI.MAIN_MENU_TEXT,
+            reply_markup=UI.MAIN_MENU,
             parse_mode='Markdown'
         )
     else:
         await update.message.reply_text(
-            message,
-            reply_markup=reply_markup,
+            UI.MAIN_MENU_TEXT,
+            reply_markup=UI.MAIN_MENU,
             parse_mode='Markdown'
         )
 
@@ -464,26 +2455,24 @@ async def track_bot_added(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat = result.chat
     
     if new_status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR]:
-        db.add_user(chat.id, chat.id)
-        
-        welcome_message = """
-السلام عليكم ورحمة الله وبركاته 🌙
-
-تم تفعيل *وِرْدُ المُسْلِم*
-
-📚 سيتم إرسال:
-• الورد اليومي
-• أذكار الصباح والمساء
-• سورة الكهف (الجمعة)
-• المناسبات الإسلامية
-
-🕌 بارك الله فيكم
-        """
+        await db.add_chat(chat.id, result.from_user.id)
+        await refresh_chat_schedule(context, chat.id)
         
         try:
-            await context.bot.send_message(chat_id=chat.id, text=welcome_message, parse_mode='Markdown')
+            await context.bot.send_message(chat_id=chat.id, text=UI.BOT_ADDED_WELCOME, parse_mode='Markdown')
         except:
             pass
+    
+    elif new_status in [ChatMemberStatus.LEFT, ChatMemberStatus.BANNED]:
+        await db.deactivate_chat(chat.id)
+        logger.info("🚫 تمت إزالة البوت من %s", chat.id)
+
+async def track_chat_migration(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """نقل الاشتراكات عند ترقية المجموعة إلى supergroup"""
+    message = update.effective_message
+    if message and message.migrate_to_chat_id:
+        await db.migrate_chat(message.chat_id, message.migrate_to_chat_id)
+        logger.info("🔀 المجموعة %s انتقلت إلى %s", message.chat_id, message.migrate_to_chat_id)
 
 # ======================== وظائف البوت ========================
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -492,321 +2481,1210 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     chat_type = update.effective_chat.type
     
-    db.add_user(user.id, chat_id)
+    # الاشتراك للمحادثة: /start من عدة أعضاء في المجموعة لا يكرر الإرسال لها
+    await db.add_chat(chat_id, user.id)
+    await refresh_chat_schedule(context, chat_id)
+    
+    # التحقق من وجود مدينة محفوظة
+    settings = await db.get_chat_settings(chat_id)
+    
+    if not settings or not settings.city:
+        # لم يختر مدينة بعد
+        return await ask_city_selection(update, context)
+    
+    # عرض القائمة الرئيسية
+    if chat_type in ['group', 'supergroup', 'channel']:
+        await update.message.reply_text(UI.GROUP_WELCOME, parse_mode='Markdown')
+    else:
+        await show_main_menu(update, context)
+
+async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """قائمة الإعدادات"""
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text("⚙️ *الإعدادات*", reply_markup=UI.SETTINGS_MENU, parse_mode='Markdown')
+
+async def set_daily_pages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تعيين عدد الصفحات"""
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text("📖 *عدد الصفحات*", reply_markup=UI.PAGES_MENU, parse_mode='Markdown')
+
+async def set_quran_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """تعيين وقت الورد"""
+    query = update.callback_query
+    await query.answer()
+    await query.edit_message_text("⏰ *وقت الورد*", reply_markup=UI.QURAN_TIME_MENU, parse_mode='Markdown')
+
+async def set_bakarah_setting(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إعدادات سورة البقرة"""
+    query = update.callback_query
+    await query.answer()
+    
+    settings = await db.get_chat_settings(update.effective_chat.id)
+    enabled = bool(settings and settings.bakarah_enabled)
+    bakarah_status = "✅ مفعّلة" if enabled else "❌ معطّلة"
+    
+    await query.edit_message_text(f"📗 *سورة البقرة*\n\n{bakarah_status}\n\n12 صفحة على 5 صلوات", reply_markup=UI.bakarah_menu(enabled), parse_mode='Markdown')
+
+async def set_notifications(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """إعدادات التنبيهات"""
+    query = update.callback_query
+    await query.answer()
+    
+    settings = await db.get_chat_settings(update.effective_chat.id) or ChatSettings()
+    reply_markup = UI.notifications_menu(bool(settings.kahf_enabled), bool(settings.mulk_enabled), bool(settings.white_days_reminder))
+    
+    await query.edit_message_text("🔔 *التنبيهات*", reply_markup=reply_markup, parse_mode='Markdown')
+
+async def select_daily_pages(update: Update, context: ContextTypes.DEFAULT_TYPE, value: str):
+    pages = int(value)
+    await db.update_chat_setting(update.effective_chat.id, 'daily_pages', pages)
+    await update.callback_query.edit_message_text(f"✅ {pages} صفحة", parse_mode='Markdown')
+    await asyncio.sleep(1)
+    await settings_menu(update, context)
+
+async def select_quran_time(update: Update, context: ContextTypes.DEFAULT_TYPE, time_str: str):
+    chat_id = update.effective_chat.id
+    await db.update_chat_setting(chat_id, 'quran_time', time_str)
+    await refresh_chat_schedule(context, chat_id)
+    await update.callback_query.edit_message_text(f"✅ الوقت: {time_str}", parse_mode='Markdown')
+    await asyncio.sleep(1)
+    await settings_menu(update, context)
+
+# زر التفعيل -> (عمود الإعداد، الشاشة التي تُعرض بعده)
+TOGGLE_SETTINGS = {
+    'bakarah': ('bakarah_enabled', set_bakarah_setting),
+    'kahf': ('kahf_enabled', set_notifications),
+    'mulk': ('mulk_enabled', set_notifications),
+    'white_days': ('white_days_reminder', set_notifications),
+}
+
+async def toggle_setting(update: Update, context: ContextTypes.DEFAULT_TYPE, name: str):
+    if name not in TOGGLE_SETTINGS:
+        return
+    setting, screen = TOGGLE_SETTINGS[name]
+    chat_id = update.effective_chat.id
+    await db.toggle_chat_setting(chat_id, setting)
+    if setting == 'bakarah_enabled':
+        await refresh_chat_schedule(context, chat_id)
+    await screen(update, context)
+
+async def show_daily_wird(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    settings = await db.get_chat_settings(update.effective_chat.id)
+    if settings:
+        await update.callback_query.edit_message_text(f"📖 *وردك*\n\nالصفحات: {settings.daily_pages}\nالوقت: {settings.quran_time}", parse_mode='Markdown')
+
+async def show_quick_azkar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text("📿 *أذكار*", reply_markup=UI.QUICK_AZKAR_MENU, parse_mode='Markdown')
+
+async def show_random_dhikr(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text(IslamicContent.get_random_dhikr(), parse_mode='Markdown')
+
+async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.callback_query.edit_message_text(UI.HELP_TEXT, parse_mode='Markdown')
+
+# توجيه الأزرار: callback_data كاملة أولاً، ثم البادئة قبل أول "_" مع تمرير الباقي
+CALLBACK_ROUTES = {
+    'back_main': show_main_menu,
+    'settings': settings_menu,
+    'set_pages': set_daily_pages,
+    'set_quran_time': set_quran_time,
+    'set_city': ask_city_selection,
+    'set_bakarah': set_bakarah_setting,
+    'set_notifications': set_notifications,
+    'daily_wird': show_daily_wird,
+    'quick_azkar': show_quick_azkar,
+    'random_dhikr': show_random_dhikr,
+    'help': show_help,
+}
+
+CALLBACK_PREFIX_ROUTES = {
+    'pages': select_daily_pages,
+    'qtime': select_quran_time,
+    'toggle': toggle_setting,
+}
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """معالج الأزرار"""
+    query = update.callback_query
+    await query.answer()
+    
+    data = query.data
+    handler = CALLBACK_ROUTES.get(data)
+    if handler:
+        await handler(update, context)
+        return
+    
+    prefix, _, value = data.partition('_')
+    handler = CALLBACK_PREFIX_ROUTES.get(prefix)
+    if handler:
+        await handler(update, context, value)
+
+# ======================== محرك البث ========================
+class TokenBucket:
+    """دلو رموز لتحديد معدل الطلبات"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# أولوية الطلبات الصادرة من المهمة الحالية، ويضبطها محرك البث لكل عملية بث
+send_priority = ContextVar('send_priority', default=PRIORITY_INTERACTIVE)
+
+class PriorityTokenBucket(TokenBucket):
+    """دلو رموز يخدم المنتظرين حسب الأولوية ثم حسب ترتيب الوصول
+    
+    كل الطلبات تمر من هنا، فردّ المستخدم ينتظر رمزاً واحداً فقط مهما طال طابور البث.
+    الطلبات المنتظرة محفوظة أيضاً في صندوق الإرسال (Outbox) فلا تضيع عند الإيقاف أو الانهيار.
+    """
+    
+    def __init__(self, rate: float, capacity: float):
+        super().__init__(rate, capacity)
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.dispatcher = None
+    
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE, entry: Optional['OutboxEntry'] = None):
+        self.refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        # إغلاق صندوق الإرسال يُنهي انتظار الطلب المحفوظ فيه بـ SendDeferred
+        if entry is not None:
+            entry.waiter = future
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self.dispatch())
+        await future
+    
+    async def dispatch(self):
+        while self.waiters:
+            self.refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self.waiters)
+            # المنتظر الذي أُلغي لا يستهلك رمزاً
+            if future.done():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+
+class SendDeferred(Exception):
+    """الطلب حُفظ في صندوق الإرسال عند الإيقاف ولم يُرسل، ويُرسل عند التشغيل التالي"""
+
+# هدف البث الذي يُرسل له الطلب الحالي (run_id, key)، ويضبطه محرك البث لكل محادثة
+outbox_target = ContextVar('outbox_target', default=None)
+# طلب الصندوق الذي يُعاد إرساله بعد التشغيل، حتى لا يُضاف مرة ثانية
+outbox_replay = ContextVar('outbox_replay', default=None)
+
+class OutboxEntry:
+    __slots__ = ('priority', 'endpoint', 'data', 'target', 'id', 'waiter', 'sending', 'deferred', 'finished')
+    
+    def __init__(self, priority: int, endpoint: str, data: dict, target: Optional[tuple] = None, entry_id: Optional[int] = None):
+        self.priority = priority
+        self.endpoint = endpoint
+        self.data = data
+        self.target = target
+        self.id = entry_id
+        self.waiter = None
+        self.sending = False
+        self.deferred = False
+        self.finished = False
+
+def outbox_json(value):
+    if isinstance(value, TelegramObject):
+        return value.to_dict()
+    if isinstance(value, datetime):
+        return int(value.timestamp())
+    raise TypeError(type(value).__name__)
+
+class Outbox:
+    """صندوق إرسال في SQLite لكل رسائل البوت وتعديلاتها
+    
+    كل طلب إرسال أو تعديل يدخل الصندوق قبل انتظار دوره تحت الحد العام، ويُكتب في القاعدة ما زال
+    ينتظر كل PROGRESS_FLUSH_INTERVAL في معاملة واحدة مع حذف ما أُرسل، فالطلب الذي يُرسل قبلها لا يُكتب.
+    عند الإيقاف يُحفظ كل ما لم يبدأ إرساله وينتهي انتظاره بـ SendDeferred، ويُعاد إرساله بنفس أولويته
+    عند التشغيل التالي. الانهيار يفقد فقط ما دخل الصندوق بعد آخر كتابة، وطلبات البث التي بقيت بعده
+    لا يعيدها الصندوق بل سجل عمليتها، لأن ما أُرسل منها قبل الانهيار لم يُحذف بعد.
+    رفع الملفات لا يُحفظ (يُرسل file_id بعد أول رفع)، ولا إجابات الأزرار لأنها تنتهي صلاحيتها خلال ثوانٍ.
+    """
+    
+    ENDPOINTS = ('send', 'edit', 'copyMessage', 'forwardMessage')
+    SKIPPED_ENDPOINTS = ('sendChatAction',)
+    
+    def __init__(self, database: AsyncDatabase):
+        self.db = database
+        self.entries = set()
+        self.sent = []
+        self.closed = False
+        self.flush_lock = asyncio.Lock()
+        self.flush_timer = None
+        self.replaying = None
+    
+    def add(self, priority: int, endpoint: str, data: dict) -> Optional[OutboxEntry]:
+        if not endpoint.startswith(self.ENDPOINTS) or endpoint in self.SKIPPED_ENDPOINTS:
+            return None
+        entry = OutboxEntry(priority, endpoint, data, outbox_target.get())
+        self.entries.add(entry)
+        self.schedule_flush()
+        return entry
+    
+    @staticmethod
+    def payload(entry: OutboxEntry) -> Optional[str]:
+        """معاملات الطلب بصيغة JSON، أو None إن كان فيه ملف يُرفع"""
+        try:
+            return json.dumps(entry.data, default=outbox_json, ensure_ascii=False)
+        except TypeError:
+            return None
+    
+    async def sending(self, entry: Optional[OutboxEntry]):
+        """قبل إرسال الطلب مباشرة: بعد الإغلاق يُحفظ الطلب بدل إرساله"""
+        if entry is None:
+            return
+        if self.closed and entry.id is None:
+            await self.flush()
+        if entry.deferred or (self.closed and entry.id is not None):
+            if not entry.deferred:
+                entry.deferred = True
+                await self.db.defer_outbox([entry.id])
+            raise SendDeferred(entry.endpoint)
+        entry.sending = True
+    
+    def done(self, entry: Optional[OutboxEntry]):
+        """انتهاء الطلب بإرساله أو بخطأ نهائي، أما المؤجل فيبقى في القاعدة"""
+        if entry is None:
+            return
+        entry.finished = True
+        self.entries.discard(entry)
+        if entry.id is not None and not entry.deferred:
+            self.sent.append(entry.id)
+            self.schedule_flush()
+    
+    def schedule_flush(self):
+        if self.flush_timer is None and not self.closed:
+            loop = asyncio.get_running_loop()
+            self.flush_timer = loop.call_later(PROGRESS_FLUSH_INTERVAL, lambda: asyncio.ensure_future(self.flush()))
+    
+    async def flush(self):
+        """كتابة الطلبات التي ما زالت تنتظر وحذف ما أُرسل في معاملة واحدة"""
+        async with self.flush_lock:
+            if self.flush_timer is not None:
+                self.flush_timer.cancel()
+                self.flush_timer = None
+            pending = []
+            rows = []
+            for entry in self.entries:
+                if entry.id is not None:
+                    continue
+                payload = self.payload(entry)
+                if payload is None:
+                    continue
+                run_id, target = entry.target or (None, None)
+                pending.append(entry)
+                # بعد الإغلاق لا يُرسل ما لم يبدأ إرساله، فيُكتب مؤجلاً مباشرة
+                rows.append((entry.priority, entry.endpoint, payload, run_id, target, int(self.closed and not entry.sending)))
+            sent, self.sent = self.sent, []
+            if not rows and not sent:
+                return
+            try:
+                ids = await self.db.save_outbox(rows, sent)
+            except BaseException:
+                self.sent.extend(sent)
+                raise
+            for entry, entry_id in zip(pending, ids):
+                entry.id = entry_id
+                entry.deferred = entry.deferred or (self.closed and not entry.sending)
+                # أُرسل أثناء الكتابة: يُحذف في الكتابة التالية
+                if entry.finished and not entry.deferred:
+                    self.sent.append(entry_id)
+            if self.sent:
+                self.schedule_flush()
+    
+    async def close(self):
+        """حفظ كل ما لم يبدأ إرساله وإنهاء انتظاره، وما يُطلب بعدها يُحفظ ولا يُرسل"""
+        self.closed = True
+        await self.flush()
+        deferred = 0
+        saved = []
+        for entry in list(self.entries):
+            if entry.id is None or entry.sending:
+                continue
+            if not entry.deferred:
+                saved.append(entry.id)
+            entry.deferred = True
+            deferred += 1
+            if entry.waiter is not None and not entry.waiter.done():
+                entry.waiter.set_exception(SendDeferred(entry.endpoint))
+        if saved:
+            await self.db.defer_outbox(saved)
+        if deferred:
+            logger.info("📮 حُفظ %d طلب في صندوق الإرسال لإرساله عند التشغيل التالي", deferred)
+        if self.replaying is not None:
+            await asyncio.gather(self.replaying, return_exceptions=True)
+    
+    async def replay(self, bot):
+        """إعادة ما بقي في الصندوق من التشغيل السابق في الخلفية، بترتيب كل محادثة"""
+        rows = await self.db.load_outbox()
+        if not rows:
+            return
+        chats = {}
+        for entry_id, priority, endpoint, payload in rows:
+            data = json.loads(payload)
+            entry = OutboxEntry(priority, endpoint, data, entry_id=entry_id)
+            self.entries.add(entry)
+            chats.setdefault(data.get('chat_id', data.get('inline_message_id')), []).append(entry)
+        logger.info("📮 إعادة %d طلب من صندوق الإرسال", len(rows))
+        self.replaying = asyncio.create_task(self._replay(bot, list(chats.values())))
+    
+    async def _replay(self, bot, chats: list):
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        
+        async def replay_chat(entries: list):
+            async with semaphore:
+                for entry in entries:
+                    replay_token = outbox_replay.set(entry)
+                    priority_token = send_priority.set(entry.priority)
+                    try:
+                        await bot._post(entry.endpoint, dict(entry.data))
+                    except SendDeferred:
+                        return
+                    except TelegramError as e:
+                        logger.debug("outbox %s -> %s: %s", entry.endpoint, entry.data.get('chat_id'), e)
+                        if isinstance(entry.data.get('chat_id'), int):
+                            await handle_send_error(entry.data['chat_id'], e)
+                    finally:
+                        outbox_replay.reset(replay_token)
+                        send_priority.reset(priority_token)
+        
+        await asyncio.gather(*(replay_chat(entries) for entries in chats))
+
+outbox = Outbox(db)
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """محدد معدل عام لكل طلبات البوت مع حد خاص لكل مجموعة واحترام RetryAfter"""
+    
+    def __init__(self, rate: float = BROADCAST_RATE, group_rate_per_minute: float = GROUP_MESSAGES_PER_MINUTE, max_retries: int = 3):
+        self.max_rate = rate
+        self.min_rate = max(1.0, rate / 10)
+        self.group_rate = group_rate_per_minute / 60
+        self.max_retries = max_retries
+        self.bucket = PriorityTokenBucket(rate, capacity=rate)
+        self.group_buckets = {}
+        self.resume_event = asyncio.Event()
+        self.resume_event.set()
+        self.backoff_seconds = 0.0
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+    
+    def _group_bucket(self, chat_id) -> TokenBucket:
+        if len(self.group_buckets) > 1024:
+            # التخلص من المجموعات الممتلئة (غير النشطة) للحفاظ على الذاكرة
+            now = time.monotonic()
+            self.group_buckets = {
+                key: bucket for key, bucket in self.group_buckets.items()
+                if bucket.tokens + (now - bucket.updated) * bucket.rate < bucket.capacity
+            }
+        if chat_id not in self.group_buckets:
+            self.group_buckets[chat_id] = TokenBucket(self.group_rate, capacity=3)
+        return self.group_buckets[chat_id]
+    
+    def _on_retry_after(self, retry_after: float):
+        """إيقاف كل الطلبات مؤقتاً وخفض المعدل (تراجع تكيفي)"""
+        self.bucket.rate = max(self.min_rate, self.bucket.rate * 0.7)
+        self.backoff_seconds += retry_after
+        RATE_LIMIT_HITS.inc()
+        logger.warning("RetryAfter %.1fs - خفض المعدل إلى %.1f رسالة/ث", retry_after, self.bucket.rate)
+    
+    def _on_success(self):
+        if self.bucket.rate < self.max_rate:
+            self.bucket.rate = min(self.max_rate, self.bucket.rate + 0.05)
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        priority = send_priority.get()
+        entry = outbox_replay.get() or outbox.add(priority, endpoint, data)
+        
+        try:
+            for attempt in range(self.max_retries + 1):
+                await self.resume_event.wait()
+                if chat_id is not None:
+                    if isinstance(chat_id, str) or chat_id < 0:
+                        await self._group_bucket(chat_id).acquire()
+                    waited = time.perf_counter()
+                    await self.bucket.acquire(priority, entry)
+                    SEND_QUEUE_WAIT.observe(time.perf_counter() - waited, priority=priority)
+                await outbox.sending(entry)
+                
+                started = time.perf_counter()
+                try:
+                    result = await callback(*args, **kwargs)
+                    self._on_success()
+                    return result
+                except RetryAfter as e:
+                    if attempt == self.max_retries:
+                        raise
+                    if entry is not None:
+                        entry.sending = False
+                    retry_after = float(e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after)
+                    self._on_retry_after(retry_after)
+                    if self.resume_event.is_set():
+                        self.resume_event.clear()
+                        RATE_LIMIT_BACKOFF.inc(retry_after + 0.1)
+                        await asyncio.sleep(retry_after + 0.1)
+                        self.resume_event.set()
+                finally:
+                    TELEGRAM_API_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+        finally:
+            outbox.done(entry)
+
+class BroadcastReport:
+    """ملخص عملية بث واحدة"""
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.sent = 0
+        self.failed = Counter()
+        # ما عولج قبل إعادة التشغيل، وما تم تخطيه لأنه أُرسل مسبقاً في نفس العملية
+        self.resumed = 0
+        self.skipped = 0
+        # ما حُفظ في صندوق الإرسال عند الإيقاف ويُرسل عند التشغيل التالي
+        self.deferred = 0
+        self.run_id = None
+        self.started = time.monotonic()
+        self.duration = 0.0
+    
+    @property
+    def failed_total(self) -> int:
+        return sum(self.failed.values())
+    
+    @property
+    def processed(self) -> int:
+        return self.resumed + self.sent + self.failed_total + self.skipped + self.deferred
+    
+    def __str__(self):
+        failures = ', '.join(f'{error}: {count}' for error, count in self.failed.most_common()) or '-'
+        summary = f"{self.name}: {self.sent} sent, {self.failed_total} failed ({failures}) in {self.duration:.1f}s"
+        if self.deferred:
+            summary += f", {self.deferred} deferred to the outbox"
+        if self.resumed or self.skipped:
+            summary += f" [run {self.run_id}: resumed after {self.resumed}, skipped {self.skipped}]"
+        return summary
+
+# لاحقة اسم مهمة الاستئناف، حتى لا تمنع إنشاء المهمة اليومية التي تحمل نفس الاسم
+RESUME_JOB_SUFFIX = '#resume'
+
+def broadcast_run_info(context) -> Optional[tuple]:
+    """(run_id, job_name, callback, data) لعملية البث التي تنفذها المهمة المجدولة الحالية"""
+    job = getattr(context, 'job', None)
+    if job is None or not isinstance(job.data, dict):
+        return None
+    data = {key: value for key, value in job.data.items() if key != 'run_id'}
+    # معرّف ثابت لكل مهمة في كل يوم محلي، فإعادة تشغيل المهمة في نفس اليوم لا تكرر الإرسال
+    job_name = job.name.removesuffix(RESUME_JOB_SUFFIX)
+    run_id = job.data.get('run_id') or f"{job_name}:{local_now(data.get('tz')).date().isoformat()}"
+    return run_id, job_name, job.callback.__name__, data
+
+# أنواع فشل الإرسال التي تعني أن المحادثة لم تعد تستقبل الرسائل
+DEAD_CHAT_ERRORS = ('blocked', 'chat_not_found')
+
+def classify_send_error(error: Exception) -> str:
+    """تصنيف خطأ الإرسال: blocked / chat_not_found / migrated أو اسم الخطأ المؤقت"""
+    if isinstance(error, ChatMigrated):
+        return 'migrated'
+    if isinstance(error, Forbidden):
+        return 'blocked'
+    if isinstance(error, BadRequest) and 'chat not found' in error.message.lower():
+        return 'chat_not_found'
+    return type(error).__name__
+
+async def handle_send_error(chat_id: int, error: Exception) -> Optional[int]:
+    """تحديث حالة المحادثة حسب الخطأ، وإرجاع المعرّف الجديد إن نُقلت المجموعة"""
+    kind = classify_send_error(error)
+    if kind == 'migrated':
+        await db.migrate_chat(chat_id, error.new_chat_id)
+        logger.info("🔀 المجموعة %s انتقلت إلى %s", chat_id, error.new_chat_id)
+        return error.new_chat_id
+    if kind in DEAD_CHAT_ERRORS:
+        if await db.deactivate_chat(chat_id):
+            logger.info("🚫 إيقاف الإرسال إلى %s (%s)", chat_id, kind)
+    return None
+
+def parse_delivery_windows(value: str) -> dict:
+    """تحويل "morning_azkar:20,qiyam:0" إلى قاموس مدة النافذة بالدقائق لكل بث"""
+    windows = {}
+    for item in value.split(','):
+        if ':' in item:
+            name, minutes = item.rsplit(':', 1)
+            windows[name.strip()] = float(minutes)
+    return windows
+
+# مدة نافذة التوصيل لكل تذكير ثابت حسب اسم البث (0 = الكل في وقت التذكير)
+DELIVERY_WINDOWS = {
+    'morning_azkar': 20,
+    'evening_azkar': 20,
+    'mulk': 20,
+    'friday_kahf': 30,
+    'islamic_occasion': 20,
+    'white_days': 20,
+    'qiyam': 10,
+    'random_dhikr': 30,
+    **parse_delivery_windows(os.environ.get("DELIVERY_WINDOWS", "")),
+}
+
+# الحد الأعلى مشترك بين كل النوافذ في العملية: النوافذ المتزامنة (فروق توقيت مختلفة أو تذكيرات في نفس الوقت)
+# تتقاسمه ولا يأخذ كل منها حداً كاملاً، وعمّال البث يأخذ كل منهم حصته منه
+delivery_bucket = TokenBucket(BROADCAST_PEAK_RATE, 1) if BROADCAST_PEAK_RATE > 0 else None
+
+class DeliveryWindow:
+    """نافذة توصيل بث واحد: موعد كل محادثة ثابت داخلها حسب delivery_slot، والإرسال تحت delivery_bucket"""
+    
+    def __init__(self, start: float, seconds: float):
+        self.start = start
+        self.seconds = seconds
+    
+    def due(self, chat_id: int) -> float:
+        return self.start + self.seconds * delivery_slot(chat_id) / DELIVERY_SLOTS
+    
+    async def wait(self, chat_id: int, stopping: asyncio.Event) -> Optional[float]:
+        """انتظار موعد المحادثة ثم دورها تحت الحد الأعلى، وإرجاع التأخر عن موعدها (None عند إيقاف الخدمة)"""
+        delay = self.due(chat_id) - time.time()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(stopping.wait(), delay)
+                return None
+            except asyncio.TimeoutError:
+                pass
+        if delivery_bucket is not None:
+            await delivery_bucket.acquire()
+        if stopping.is_set():
+            return None
+        return max(0.0, time.time() - self.due(chat_id))
+
+class Broadcaster:
+    """إرسال جماعي متزامن بعدد محدود من المهام"""
+    
+    def __init__(self, concurrency: int = BROADCAST_CONCURRENCY):
+        self.concurrency = concurrency
+        # عند تشغيل العمّال تُرسل المهام المجدولة إليهم بدل الإرسال من هذه العملية
+        self.pool = None
+        # العمليات الجارية حسب run_id، ودالة تُستدعى بملخصها (تستخدمها العمليات العاملة للإبلاغ)
+        self.active = {}
+        self.on_report = None
+        # عند إيقاف الخدمة لا تُؤخذ أهداف جديدة، وتبقى العملية قابلة للاستئناف من موضعها
+        self.stopping = asyncio.Event()
+    
+    @staticmethod
+    def priority(name: str) -> int:
+        return PRIORITY_QURAN if name.startswith(QURAN_BROADCASTS) else PRIORITY_BROADCAST
+    
+    async def stop(self):
+        """إيقاف البث الجاري وحفظ موضعه في سجل البث، وما ينتظر دوره يحفظه صندوق الإرسال عند إغلاقه"""
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        if self.active:
+            logger.info("⏸️ إيقاف %d عملية بث لاستئنافها عند التشغيل التالي", len(self.active))
+        if self.pool is not None:
+            await self.pool.stop()
+    
+    async def run(self, name: str, targets, send, chat_of=None, key_of=None, context=None, window: Optional[DeliveryWindow] = None) -> BroadcastReport:
+        """تنفيذ send(target) لكل هدف مع تسجيل النجاح والفشل حسب نوع الخطأ
+        
+        chat_of تستخرج chat_id من الهدف إن لم يكن الهدف نفسه معرّف المحادثة، و key_of
+        مفتاح ترتيب الأهداف (الهدف نفسه افتراضياً). إن مُرّر context لمهمة مجدولة تُسجّل
+        العملية في سجل البث، وتكون targets دالة تقبل after لتكمل القراءة من نقطة الاستئناف.
+        بيانات المهمة shard و shards تقصر العملية على المحادثات التي chat_id % shards == shard،
+        وتُمرَّر إلى targets (shard=) ليقرأ كل عامل محادثاته فقط من القاعدة.
+        مع window تُرسل كل رسالة في موعد محادثتها داخل النافذة، والأهداف مرتبة حسب delivery_key.
+        """
+        run = broadcast_run_info(context)
+        if run and self.pool is not None and 'shard' not in run[3]:
+            return await self.pool.dispatch(name, run)
+        
+        # المهام التي ينشئها gather ترث أولوية هذا البث
+        priority_token = send_priority.set(self.priority(name))
+        try:
+            return await self._run(name, run, targets, send, chat_of, key_of, window)
+        finally:
+            send_priority.reset(priority_token)
+    
+    async def _run(self, name: str, run: Optional[tuple], targets, send, chat_of, key_of, window: Optional[DeliveryWindow]) -> BroadcastReport:
+        report = BroadcastReport(name)
+        checkpoint = None
+        done_keys = set()
+        shard, shards = (run[3].get('shard'), run[3].get('shards')) if run else (None, None)
+        
+        if run:
+            report.run_id = run[0]
+            status, checkpoint, report.resumed, delivered = await db.begin_broadcast(*run)
+            if status != 'running':
+                logger.info("⏭️ %s: العملية %s منتهية مسبقاً", name, report.run_id)
+                self.report_progress(report, True)
+                return report
+            done_keys.update(delivered)
+            if checkpoint is not None or delivered:
+                logger.info("▶️ %s: استئناف العملية %s بعد %d محادثة", name, report.run_id, report.resumed)
+        
+        # الأهداف التي تُقرأ بدالة تُقسَّم في الاستعلام، والقوائم الجاهزة تُقسَّم هنا
+        filter_shard = shard is not None and not callable(targets)
+        if callable(targets):
+            targets = targets(after=checkpoint) if shard is None else targets(after=checkpoint, shard=(shard, shards))
+        
+        if hasattr(targets, '__aiter__'):
+            iterator = targets.__aiter__()
+            lock = asyncio.Lock()
+            
+            async def next_target():
+                async with lock:
+                    return await anext(iterator, None)
+        else:
+            iterator = iter(targets)
+            
+            async def next_target():
+                return next(iterator, None)
+        
+        # الأهداف تُقرأ مرتبة حسب المفتاح، فنقطة الاستئناف هي آخر مفتاح انتهى كل ما قبله
+        pending = deque()
+        finished = set()
+        in_flight = set()
+        sequence = itertools.count()
+        journal = {'watermark': checkpoint, 'since_checkpoint': 0}
+        # ما أُرسل ولم يُكتب بعد: يُكتب مع نقطة الاستئناف التالية بدل معاملة لكل محادثة
+        unrecorded = []
+        
+        async def save_checkpoint():
+            watermark = journal['watermark']
+            delivered = [key for key in unrecorded if watermark is None or key > watermark]
+            journal['since_checkpoint'] = 0
+            unrecorded.clear()
+            await db.checkpoint_broadcast(report.run_id, watermark, report.processed, delivered)
+        
+        async def complete(seq: int):
+            finished.add(seq)
+            while pending and pending[0][0] in finished:
+                done_seq, key = pending.popleft()
+                finished.discard(done_seq)
+                done_keys.discard(key)
+                journal['watermark'] = key
+                journal['since_checkpoint'] += 1
+            if run and max(journal['since_checkpoint'], len(unrecorded)) >= JOURNAL_CHECKPOINT_EVERY:
+                await save_checkpoint()
+        
+        async def flush_journal():
+            """حفظ دوري حتى لا يبقى ما أُرسل غير مسجل أكثر من PROGRESS_FLUSH_INTERVAL مهما بطؤ البث"""
+            while True:
+                await asyncio.sleep(PROGRESS_FLUSH_INTERVAL)
+                if unrecorded or journal['since_checkpoint']:
+                    await save_checkpoint()
+        
+        async def deliver(target):
+            try:
+                await send(target)
+            except TelegramError as e:
+                chat_id = chat_of(target) if chat_of else target
+                new_chat_id = await handle_send_error(chat_id, e)
+                # إعادة المحاولة مرة واحدة على المعرّف الجديد للمجموعة
+                if new_chat_id is None or chat_of is not None:
+                    raise
+                await send(new_chat_id)
+        
+        async def worker():
+            while not self.stopping.is_set() and (target := await next_target()) is not None:
+                if filter_shard and (chat_of(target) if chat_of else target) % shards != shard:
+                    continue
+                key = key_of(target) if key_of else target
+                seq = next(sequence)
+                pending.append((seq, key))
+                
+                # ما أُرسل قبل الانقطاع أو يتكرر في نفس العملية لا يُرسل مرة ثانية
+                watermark = journal['watermark']
+                if run and (key in done_keys or key in in_flight or (watermark is not None and key <= watermark)):
+                    report.skipped += 1
+                    await complete(seq)
+                    continue
+                
+                if window is not None:
+                    # الموضع الذي لم يُرسل عند الإيقاف يبقى بعد نقطة الاستئناف
+                    lag = await window.wait(chat_of(target) if chat_of else target, self.stopping)
+                    if lag is None:
+                        break
+                    DELIVERY_LAG.observe(lag, job=name)
+                
+                in_flight.add(key)
+                target_token = outbox_target.set((report.run_id, key) if run else None)
+                try:
+                    await deliver(target)
+                    report.sent += 1
+                except SendDeferred:
+                    # الطلب في صندوق الإرسال، فتُعدّ المحادثة مرسلة في السجل
+                    report.deferred += 1
+                except TelegramError as e:
+                    report.failed[classify_send_error(e)] += 1
+                    logger.debug("broadcast %s -> %s: %s", name, target, e)
+                except Exception as e:
+                    report.failed[type(e).__name__] += 1
+                    logger.exception("broadcast %s -> %s failed", name, target)
+                finally:
+                    in_flight.discard(key)
+                    outbox_target.reset(target_token)
+                
+                if run:
+                    done_keys.add(key)
+                    unrecorded.append(key)
+                await complete(seq)
+        
+        if run:
+            self.active[report.run_id] = report
+        flusher = asyncio.create_task(flush_journal()) if run else None
+        try:
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+            if flusher is not None:
+                flusher.cancel()
+                await asyncio.gather(flusher, return_exceptions=True)
+            if run and self.stopping.is_set():
+                # ما أُرسل بعد نقطة الاستئناف محفوظ في سجل الإرسال، فلا يتكرر عند الاستئناف
+                await save_checkpoint()
+                logger.info("⏸️ %s: حُفظ موضع العملية %s بعد %d محادثة", name, report.run_id, report.processed)
+            elif run:
+                await db.finish_broadcast(report.run_id, report.processed)
+        finally:
+            if flusher is not None:
+                flusher.cancel()
+            self.active.pop(report.run_id, None)
+            # العمّال الذين توقفوا مبكراً يتركون مولّد القراءة معلقاً، وإغلاقه يغلق اتصال القراءة الخاص به فوراً
+            if hasattr(iterator, 'aclose'):
+                async with lock:
+                    await iterator.aclose()
+        report.duration = time.monotonic() - report.started
+        
+        JOB_DURATION.observe(report.duration, job=name)
+        MESSAGES_SENT.inc(report.sent, job=name)
+        for error, count in report.failed.items():
+            MESSAGES_FAILED.inc(count, job=name, error=error)
+        logger.info("📤 %s", report)
+        self.report_progress(report, True)
+        return report
     
-    # التحقق من وجود مدينة محفوظة
-    user_data = db.get_user(user.id)
+    def report_progress(self, report: BroadcastReport, done: bool = False):
+        if self.on_report is not None and report.run_id is not None:
+            self.on_report(report, done)
+
+broadcaster = Broadcaster()
+
+# ======================== عمّال البث ========================
+class ShardJob:
+    """بديل Job داخل عامل البث: نفس الاسم والبيانات، والجدولة تبقى في العملية الرئيسية"""
     
-    if not user_data or (len(user_data) > 11 and not user_data[11]):
-        # لم يختر مدينة بعد
-        return await ask_city_selection(update, context)
+    def __init__(self, name: str, callback, data: dict):
+        self.name = name
+        self.callback = callback
+        self.data = data
     
-    # عرض القائمة الرئيسية
-    if chat_type in ['group', 'supergroup', 'channel']:
-        welcome_message = """
-السلام عليكم 🌙
+    def schedule_removal(self):
+        pass
 
-*وِرْدُ المُسْلِم*
+class ShardContext:
+    def __init__(self, bot, job: ShardJob):
+        self.bot = bot
+        self.job = job
+        self.job_queue = None
 
-📚 التذكيرات:
-• الورد اليومي
-• أذكار الصباح والمساء
-• سورة الكهف (الجمعة)
-• المناسبات الإسلامية
+def report_snapshot(report: BroadcastReport) -> dict:
+    return {
+        'name': report.name,
+        'sent': report.sent,
+        'failed': dict(report.failed),
+        'resumed': report.resumed,
+        'skipped': report.skipped,
+        'deferred': report.deferred,
+    }
 
-🕌 بارك الله فيكم
-        """
-        await update.message.reply_text(welcome_message, parse_mode='Markdown')
-    else:
-        await show_main_menu(update, context)
+def merge_snapshots(first: Optional[dict], second: Optional[dict]) -> Optional[dict]:
+    if not first or not second:
+        return first or second
+    failed = Counter(first['failed'])
+    failed.update(second['failed'])
+    return {
+        'name': second['name'],
+        'sent': first['sent'] + second['sent'],
+        'failed': dict(failed),
+        'resumed': first['resumed'],
+        'skipped': first['skipped'] + second['skipped'],
+        'deferred': first['deferred'] + second['deferred'],
+    }
 
-async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """قائمة الإعدادات"""
-    query = update.callback_query
-    await query.answer()
+class BroadcastWorkerPool:
+    """توزيع البث المجدول على عمليات منفصلة حسب chat_id، مع متابعة تقدّم كل جزء
     
-    keyboard = [
-        [InlineKeyboardButton("📖 عدد الصفحات", callback_data='set_pages')],
-        [InlineKeyboardButton("⏰ وقت الورد", callback_data='set_quran_time')],
-        [InlineKeyboardButton("🌍 المدينة", callback_data='set_city')],
-        [InlineKeyboardButton("📗 سورة البقرة", callback_data='set_bakarah')],
-        [InlineKeyboardButton("🔔 التنبيهات", callback_data='set_notifications')],
-        [InlineKeyboardButton("🔙 رجوع", callback_data='back_main')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    كل جزء عملية بث مستقلة في السجل (run_id#shard/shards)، فإن توقف عامل يُعاد
+    تشغيله وتُعاد أجزاؤه إلى الطابور لتكمل من آخر نقطة محفوظة دون تكرار.
+    """
     
-    await query.edit_message_text("⚙️ *الإعدادات*", reply_markup=reply_markup, parse_mode='Markdown')
-
-async def set_daily_pages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """تعيين عدد الصفحات"""
-    query = update.callback_query
-    await query.answer()
+    def __init__(self, workers: int = BROADCAST_WORKERS):
+        self.workers = workers
+        self.mp = multiprocessing.get_context('spawn')
+        self.tasks = self.mp.Queue()
+        self.results = self.mp.Queue()
+        self.upload_lock = self.mp.Lock()
+        self.processes = []
+        # run_id الجزء -> المهمة، future، آخر ملخص، ملخص المحاولات السابقة، رقم العامل
+        self.shards = {}
+        self.loop = None
+        self.reader = None
+        self.stopping = False
     
-    keyboard = [
-        [InlineKeyboardButton("1", callback_data='pages_1'), InlineKeyboardButton("2", callback_data='pages_2'), InlineKeyboardButton("3", callback_data='pages_3')],
-        [InlineKeyboardButton("5", callback_data='pages_5'), InlineKeyboardButton("10", callback_data='pages_10'), InlineKeyboardButton("20", callback_data='pages_20')],
-        [InlineKeyboardButton("🔙 رجوع", callback_data='settings')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    def spawn(self, index: int):
+        # معدل الإرسال العام والحد الأعلى لنوافذ التوصيل يُقسمان على العمّال
+        process = self.mp.Process(
+            target=broadcast_worker_main,
+            args=(index, self.tasks, self.results, self.upload_lock, BROADCAST_RATE / self.workers, BROADCAST_PEAK_RATE / self.workers),
+            name=f'broadcast-worker-{index}',
+            daemon=True
+        )
+        process.start()
+        return process
     
-    await query.edit_message_text("📖 *عدد الصفحات*", reply_markup=reply_markup, parse_mode='Markdown')
-
-async def set_quran_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """تعيين وقت الورد"""
-    query = update.callback_query
-    await query.answer()
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        # العمّال يفتحون نفس القاعدة، فإنشاء الجداول وترقيتها يتم هنا أولاً
+        db.start()
+        await asyncio.to_thread(db.ready.wait)
+        media_cache.shared_lock = self.upload_lock
+        self.processes = [self.spawn(index) for index in range(self.workers)]
+        self.reader = threading.Thread(target=self._read_results, name='broadcast-results', daemon=True)
+        self.reader.start()
+        logger.info("👷 %d عمّال بث", self.workers)
     
-    keyboard = [
-        [InlineKeyboardButton("05:00", callback_data='qtime_05:00'), InlineKeyboardButton("06:00", callback_data='qtime_06:00'), InlineKeyboardButton("07:00", callback_data='qtime_07:00')],
-        [InlineKeyboardButton("08:00", callback_data='qtime_08:00'), InlineKeyboardButton("09:00", callback_data='qtime_09:00'), InlineKeyboardButton("10:00", callback_data='qtime_10:00')],
-        [InlineKeyboardButton("20:00", callback_data='qtime_20:00'), InlineKeyboardButton("21:00", callback_data='qtime_21:00'), InlineKeyboardButton("22:00", callback_data='qtime_22:00')],
-        [InlineKeyboardButton("🔙 رجوع", callback_data='settings')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    def _read_results(self):
+        while True:
+            try:
+                message = self.results.get(timeout=1)
+            except queue.Empty:
+                message = ('check',)
+            if message is None:
+                break
+            try:
+                self.loop.call_soon_threadsafe(self._handle, message)
+            except RuntimeError:
+                break
     
-    await query.edit_message_text("⏰ *وقت الورد*", reply_markup=reply_markup, parse_mode='Markdown')
-
-async def set_bakarah_setting(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """إعدادات سورة البقرة"""
-    query = update.callback_query
-    await query.answer()
+    def _handle(self, message: tuple):
+        kind = message[0]
+        if kind == 'check':
+            self._check_workers()
+            return
+        
+        shard = self.shards.get(message[1])
+        if shard is None:
+            return
+        if kind == 'started':
+            shard['worker'] = message[2]
+        elif kind == 'progress':
+            self._record(shard, message[2])
+        elif kind == 'done':
+            del self.shards[message[1]]
+            if not shard['future'].done():
+                shard['future'].set_result(merge_snapshots(shard['offset'], shard['snapshot']))
     
-    user = db.get_user(query.from_user.id)
-    bakarah_status = "✅ مفعّلة" if user and len(user) > 3 and user[3] else "❌ معطّلة"
+    @staticmethod
+    def _record(shard: dict, snapshot: dict):
+        """إضافة الفرق منذ آخر ملخص إلى مقاييس هذه العملية"""
+        previous = shard['snapshot'] or {'sent': 0, 'failed': {}}
+        MESSAGES_SENT.inc(snapshot['sent'] - previous['sent'], job=snapshot['name'])
+        for error, count in snapshot['failed'].items():
+            if count != previous['failed'].get(error, 0):
+                MESSAGES_FAILED.inc(count - previous['failed'].get(error, 0), job=snapshot['name'], error=error)
+        shard['snapshot'] = snapshot
     
-    keyboard = [
-        [InlineKeyboardButton("تفعيل ✅" if not (user and len(user) > 3 and user[3]) else "تعطيل ❌", callback_data='toggle_bakarah')],
-        [InlineKeyboardButton("🔙 رجوع", callback_data='settings')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    def _check_workers(self):
+        if self.stopping:
+            return
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            logger.error("💥 عامل البث %d توقف (exit %s)، إعادة تشغيله", index, process.exitcode)
+            self.processes[index] = self.spawn(index)
+            for shard in self.shards.values():
+                if shard['worker'] != index:
+                    continue
+                # ما أُرسل بعد آخر ملخص لا يظهر في المقاييس، لكن السجل يمنع تكراره
+                shard['offset'] = merge_snapshots(shard['offset'], shard['snapshot'])
+                shard['snapshot'] = None
+                shard['worker'] = None
+                self.tasks.put(shard['task'])
     
-    await query.edit_message_text(f"📗 *سورة البقرة*\n\n{bakarah_status}\n\n12 صفحة على 5 صلوات", reply_markup=reply_markup, parse_mode='Markdown')
-
-async def set_notifications(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """إعدادات التنبيهات"""
-    query = update.callback_query
-    await query.answer()
+    async def dispatch(self, name: str, run: tuple) -> BroadcastReport:
+        """تقسيم عملية البث على العمّال وانتظار كل الأجزاء"""
+        run_id, job_name, callback, data = run
+        report = BroadcastReport(name)
+        report.run_id = run_id
+        futures = []
+        for index in range(self.workers):
+            task = {
+                'run_id': f'{run_id}#{index}/{self.workers}',
+                'job_name': job_name,
+                'callback': callback,
+                'data': {**data, 'shard': index, 'shards': self.workers},
+            }
+            future = self.loop.create_future()
+            self.shards[task['run_id']] = {'task': task, 'future': future, 'snapshot': None, 'offset': None, 'worker': None}
+            self.tasks.put(task)
+            futures.append(future)
+        
+        for snapshot in await asyncio.gather(*futures):
+            if snapshot:
+                report.sent += snapshot['sent']
+                report.failed.update(snapshot['failed'])
+                report.resumed += snapshot['resumed']
+                report.skipped += snapshot['skipped']
+                report.deferred += snapshot['deferred']
+        report.duration = time.monotonic() - report.started
+        JOB_DURATION.observe(report.duration, job=name)
+        # العمّال غيّروا التقدّم وحالة المحادثات في القاعدة مباشرة
+        db.settings_cache.clear()
+        logger.info("📤 %s [%d عمّال]", report, self.workers)
+        return report
     
-    user = db.get_user(query.from_user.id)
+    def _join(self):
+        for process in self.processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
     
-    kahf = user[6] if user and len(user) > 6 else 1
-    mulk = user[7] if user and len(user) > 7 else 1
-    white = user[10] if user and len(user) > 10 else 1
+    async def stop(self):
+        """إنهاء العمّال بعد إكمال الأجزاء الجارية، وما لم يكتمل يُستأنف عند التشغيل التالي"""
+        self.stopping = True
+        for _ in self.processes:
+            self.tasks.put(None)
+        await asyncio.to_thread(self._join)
+        self.results.put(None)
+        for shard in self.shards.values():
+            shard['future'].cancel()
+        media_cache.shared_lock = None
+
+def broadcast_worker_main(index: int, tasks, results, upload_lock, rate: float, peak_rate: float):
+    # الإيقاف يأتي من العملية الرئيسية عبر الطابور، لا من Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(run_broadcast_worker(index, tasks, results, upload_lock, rate, peak_rate))
+
+async def run_broadcast_worker(index: int, tasks, results, upload_lock, rate: float, peak_rate: float):
+    """حلقة عامل البث: تنفيذ الأجزاء من الطابور بدوال المهام نفسها والإبلاغ عن التقدّم"""
+    media_cache.shared_lock = upload_lock
+    if delivery_bucket is not None:
+        delivery_bucket.rate = peak_rate
+    broadcaster.on_report = lambda report, done: results.put(('progress', report.run_id, report_snapshot(report)))
+    bot = ExtBot(
+        BOT_TOKEN,
+        base_url=TELEGRAM_API_URL,
+        request=HTTPXRequest(connection_pool_size=BROADCAST_CONCURRENCY + 4),
+        rate_limiter=TelegramRateLimiter(rate)
+    )
+    await bot.initialize()
+    loop = asyncio.get_running_loop()
+    running = set()
     
-    keyboard = [
-        [InlineKeyboardButton(f"{'✅' if kahf else '❌'} سورة الكهف", callback_data='toggle_kahf')],
-        [InlineKeyboardButton(f"{'✅' if mulk else '❌'} سورة الملك", callback_data='toggle_mulk')],
-        [InlineKeyboardButton(f"{'✅' if white else '❌'} الأيام البيض", callback_data='toggle_white_days')],
-        [InlineKeyboardButton("🔙 رجوع", callback_data='settings')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    async def run_shard(task: dict):
+        results.put(('started', task['run_id'], index))
+        job = ShardJob(task['job_name'], RESUMABLE_JOBS[task['callback']], {**task['data'], 'run_id': task['run_id']})
+        try:
+            await job.callback(ShardContext(bot, job))
+        except Exception:
+            logger.exception("عامل البث %d: فشل الجزء %s", index, task['run_id'])
+        finally:
+            results.put(('done', task['run_id']))
     
-    await query.edit_message_text("🔔 *التنبيهات*", reply_markup=reply_markup, parse_mode='Markdown')
-
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """معالج الأزرار"""
-    query = update.callback_query
-    await query.answer()
+    async def report_active():
+        while True:
+            await asyncio.sleep(WORKER_PROGRESS_INTERVAL)
+            for report in list(broadcaster.active.values()):
+                broadcaster.report_progress(report)
     
-    data = query.data
-    user_id = query.from_user.id
+    reporter = asyncio.create_task(report_active())
+    while (task := await loop.run_in_executor(None, tasks.get)) is not None:
+        shard_task = asyncio.create_task(run_shard(task))
+        running.add(shard_task)
+        shard_task.add_done_callback(running.discard)
     
-    if data == 'back_main':
-        await show_main_menu(update, context)
-    elif data == 'settings':
-        await settings_menu(update, context)
-    elif data == 'set_pages':
-        await set_daily_pages(update, context)
-    elif data == 'set_quran_time':
-        await set_quran_time(update, context)
-    elif data == 'set_city':
-        await ask_city_selection(update, context)
-    elif data == 'set_bakarah':
-        await set_bakarah_setting(update, context)
-    elif data == 'set_notifications':
-        await set_notifications(update, context)
-    elif data.startswith('pages_'):
-        pages = int(data.split('_')[1])
-        db.update_user_setting(user_id, 'daily_pages', pages)
-        await query.edit_message_text(f"✅ {pages} صفحة", parse_mode='Markdown')
-        await asyncio.sleep(1)
-        await settings_menu(update, context)
-    elif data.startswith('qtime_'):
-        time_str = data.split('_')[1]
-        db.update_user_setting(user_id, 'quran_time', time_str)
-        await query.edit_message_text(f"✅ الوقت: {time_str}", parse_mode='Markdown')
-        await asyncio.sleep(1)
-        await settings_menu(update, context)
-    elif data == 'toggle_bakarah':
-        user = db.get_user(user_id)
-        current = user[3] if user and len(user) > 3 else 0
-        db.update_user_setting(user_id, 'bakarah_enabled', 0 if current else 1)
-        await set_bakarah_setting(update, context)
-    elif data == 'toggle_kahf':
-        user = db.get_user(user_id)
-        current = user[6] if user and len(user) > 6 else 1
-        db.update_user_setting(user_id, 'kahf_enabled', 0 if current else 1)
-        await set_notifications(update, context)
-    elif data == 'toggle_mulk':
-        user = db.get_user(user_id)
-        current = user[7] if user and len(user) > 7 else 1
-        db.update_user_setting(user_id, 'mulk_enabled', 0 if current else 1)
-        await set_notifications(update, context)
-    elif data == 'toggle_white_days':
-        user = db.get_user(user_id)
-        current = user[10] if user and len(user) > 10 else 1
-        db.update_user_setting(user_id, 'white_days_reminder', 0 if current else 1)
-        await set_notifications(update, context)
-    elif data == 'daily_wird':
-        user = db.get_user(user_id)
-        if user:
-            pages = user[2] if len(user) > 2 else 2
-            quran_time = user[8] if len(user) > 8 else '09:00'
-            await query.edit_message_text(f"📖 *وردك*\n\nالصفحات: {pages}\nالوقت: {quran_time}", parse_mode='Markdown')
-    elif data == 'quick_azkar':
-        keyboard = [
-            [InlineKeyboardButton("📿 ذكر", callback_data='random_dhikr')],
-            [InlineKeyboardButton("🔙 رجوع", callback_data='back_main')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text("📿 *أذكار*", reply_markup=reply_markup, parse_mode='Markdown')
-    elif data == 'random_dhikr':
-        await query.edit_message_text(IslamicContent.get_random_dhikr(), parse_mode='Markdown')
-    elif data == 'help':
-        help_text = """ℹ️ *وِرْدُ المُسْلِم*
+    await broadcaster.stop()
+    await outbox.close()
+    await asyncio.gather(*running)
+    reporter.cancel()
+    await outbox.flush()
+    await db.flush_progress()
+    db.close()
+    await bot.shutdown()
 
-/start - البدء
+# ======================== المهام المجدولة ========================
+def job_timezone(context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
+    """فرق التوقيت الذي تخدمه المهمة الحالية (None = كل المستخدمين)"""
+    job = getattr(context, 'job', None)
+    if job and isinstance(job.data, dict):
+        return job.data.get('tz')
+    return None
 
-*المميزات:*
-📖 الورد اليومي
-📗 سورة البقرة
-☀️ أذكار الصباح والمساء
-🌙 سورة الملك
-🕋 سورة الكهف
-⚪ الأيام البيض
-📅 المناسبات الاسلامية
+def local_now(tz: Optional[int]) -> datetime:
+    if tz is None:
+        return datetime.now()
+    return datetime.now(timezone(timedelta(hours=tz)))
 
-*للمجموعات:*
-أضف البوت كأدمن وسيعمل تلقائياً
+def delivery_window(name: str, context: ContextTypes.DEFAULT_TYPE) -> Optional[DeliveryWindow]:
+    """نافذة التذكير الثابت الذي تنفذه المهمة: تبدأ من وقته المحلي في يوم العملية، فتستأنف بنفس المواعيد
+    
+    الوقت من بيانات المهمة (time) لأن وقت الذكر العشوائي يُختار عند الاستيراد ويختلف في كل عملية،
+    وبيانات المهمة تنتقل كما هي إلى عمّال البث وإلى سجل العملية.
+    """
+    run = broadcast_run_info(context)
+    minutes = DELIVERY_WINDOWS.get(name)
+    if run is None or not minutes:
+        return None
+    run_id, job_name, _, data = run
+    reminder = FIXED_REMINDERS.get(job_name.rsplit('_tz', 1)[0])
+    if reminder is None or data.get('tz') is None:
+        return None
+    # مهام العمليات التي بدأت قبل حفظ الوقت في بياناتها
+    reminder_time = data.get('time', reminder[0])
+    
+    # اليوم المحلي من run_id، وعمّال البث يضيفون إليه #shard/shards
+    try:
+        day = date.fromisoformat(run_id.split('#', 1)[0].rsplit(':', 1)[1])
+    except (IndexError, ValueError):
+        day = local_now(data['tz']).date()
+    local_time = datetime.strptime(reminder_time, '%H:%M').time().replace(tzinfo=timezone(timedelta(hours=data['tz'])))
+    # العملية التي بدأت بلا time تأخذ وقت هذا التشغيل، فلا تبدأ نافذتها بعد الآن
+    start = min(datetime.combine(day, local_time).timestamp(), time.time())
+    return DeliveryWindow(start, minutes * 60)
 
-🤲 بارك الله فيك"""
-        await query.edit_message_text(help_text, parse_mode='Markdown')
+async def broadcast_reminder(context: ContextTypes.DEFAULT_TYPE, name: str, send, flag: Optional[str] = None) -> BroadcastReport:
+    """بث تذكير ثابت لمحادثات فرق توقيت المهمة مرتبة حسب موضع التوصيل، وموزعاً على نافذته إن كانت له نافذة"""
+    targets = partial(db.iter_window_chat_ids, flag, job_timezone(context))
+    return await broadcaster.run(name, targets, send, key_of=delivery_key, context=context, window=delivery_window(name, context))
 
-# ======================== المهام المجدولة ========================
 async def send_morning_azkar(context: ContextTypes.DEFAULT_TYPE):
-    users = db.get_all_users()
     image_path = MediaManager.get_morning_azkar_image()
     
-    for user in users:
-        morning_enabled = user[4] if len(user) > 4 else 1
-        if morning_enabled:
-            try:
-                if image_path:
-                    with open(image_path, 'rb') as photo:
-                        await context.bot.send_photo(chat_id=user[1], photo=photo, caption=IslamicContent.MORNING_AZKAR, parse_mode='Markdown')
-                else:
-                    await context.bot.send_message(chat_id=user[1], text=IslamicContent.MORNING_AZKAR, parse_mode='Markdown')
-            except:
-                pass
+    async def send(chat_id):
+        if image_path:
+            await send_cached_photo(context.bot, chat_id, image_path, caption=IslamicContent.MORNING_AZKAR, parse_mode='Markdown')
+        else:
+            await context.bot.send_message(chat_id=chat_id, text=IslamicContent.MORNING_AZKAR, parse_mode='Markdown')
+    
+    await broadcast_reminder(context, 'morning_azkar', send, 'morning_azkar_enabled')
 
 async def send_evening_azkar(context: ContextTypes.DEFAULT_TYPE):
-    users = db.get_all_users()
     image_path = MediaManager.get_evening_azkar_image()
     
-    for user in users:
-        evening_enabled = user[5] if len(user) > 5 else 1
-        if evening_enabled:
-            try:
-                if image_path:
-                    with open(image_path, 'rb') as photo:
-                        await context.bot.send_photo(chat_id=user[1], photo=photo, caption=IslamicContent.EVENING_AZKAR, parse_mode='Markdown')
-                else:
-                    await context.bot.send_message(chat_id=user[1], text=IslamicContent.EVENING_AZKAR, parse_mode='Markdown')
-            except:
-                pass
+    async def send(chat_id):
+        if image_path:
+            await send_cached_photo(context.bot, chat_id, image_path, caption=IslamicContent.EVENING_AZKAR, parse_mode='Markdown')
+        else:
+            await context.bot.send_message(chat_id=chat_id, text=IslamicContent.EVENING_AZKAR, parse_mode='Markdown')
+    
+    await broadcast_reminder(context, 'evening_azkar', send, 'evening_azkar_enabled')
 
-async def send_daily_wird_single(context: ContextTypes.DEFAULT_TYPE, user_id: int):
-    user = db.get_user(user_id)
-    if not user:
+async def send_daily_wird_single(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    progress = await db.get_wird_progress(chat_id)
+    if not progress:
         return
     
-    try:
-        pages = user[2] if len(user) > 2 else 2
-        current_page = user[9] if len(user) > 9 else 1
-        
-        end_page = current_page + pages - 1
-        if end_page > QURAN_PAGES:
-            end_page = QURAN_PAGES
-            current_page = 1
-        
-        caption = f"""📖 *الورد اليومي*
+    pages, current_page = progress
+    pages = pages or 2
+    current_page = current_page or 1
+    
+    end_page = current_page + pages - 1
+    if end_page > QURAN_PAGES:
+        end_page = QURAN_PAGES
+        current_page = 1
+    
+    caption = f"""📖 *الورد اليومي*
 
 ﴿إِنَّ الَّذِينَ يَتْلُونَ كِتَابَ اللَّهِ وَأَقَامُوا الصَّلَاةَ وَأَنفَقُوا مِمَّا رَزَقْنَاهُمْ سِرًّا وَعَلَانِيَةً يَرْجُونَ تِجَارَةً لَّن تَبُورَ﴾
 
 الصفحات: {current_page} - {end_page}"""
-        
-        media_group = []
-        for page_num in range(current_page, min(current_page + 10, end_page + 1)):
+    
+    # بعد إغلاق صندوق الإرسال يُحفظ كل جزء من الورد فيه بالترتيب، فلا يتوقف الورد عند أول جزء مؤجل
+    deferred = None
+    
+    async def send_part(send, *args, **kwargs):
+        nonlocal deferred
+        try:
+            await send(context.bot, chat_id, *args, **kwargs)
+        except SendDeferred as e:
+            deferred = e
+    
+    group_pages = []
+    for page_num in range(current_page, min(current_page + 10, end_page + 1)):
+        image_path = MediaManager.get_quran_page_image(page_num)
+        if image_path:
+            group_pages.append(image_path)
+    
+    if group_pages:
+        await send_part(send_cached_media_group, group_pages, caption=caption, parse_mode='Markdown')
+    
+    if end_page - current_page >= 10:
+        for page_num in range(current_page + 10, end_page + 1):
             image_path = MediaManager.get_quran_page_image(page_num)
             if image_path:
-                with open(image_path, 'rb') as photo:
-                    if page_num == current_page:
-                        media_group.append(InputMediaPhoto(media=photo.read(), caption=caption, parse_mode='Markdown'))
-                    else:
-                        media_group.append(InputMediaPhoto(media=photo.read()))
-        
-        if media_group:
-            await context.bot.send_media_group(chat_id=user[1], media=media_group)
-        
-        if end_page - current_page >= 10:
-            for page_num in range(current_page + 10, end_page + 1):
-                image_path = MediaManager.get_quran_page_image(page_num)
-                if image_path:
-                    with open(image_path, 'rb') as photo:
-                        await context.bot.send_photo(chat_id=user[1], photo=photo)
+                await send_part(send_cached_photo, image_path)
+                if deferred is None:
                     await asyncio.sleep(0.3)
-        
-        next_page = end_page + 1 if end_page < QURAN_PAGES else 1
-        db.update_current_page(user[0], next_page)
-    except:
-        pass
+    
+    next_page = end_page + 1 if end_page < QURAN_PAGES else 1
+    await db.update_current_page(chat_id, next_page)
+    if deferred is not None:
+        raise deferred
 
 async def send_mulk(context: ContextTypes.DEFAULT_TYPE):
-    users = db.get_all_users()
     image_path = MediaManager.get_mulk_image()
     
-    for user in users:
-        mulk_enabled = user[7] if len(user) > 7 else 1
-        if mulk_enabled:
-            try:
-                if image_path:
-                    with open(image_path, 'rb') as photo:
-                        await context.bot.send_photo(chat_id=user[1], photo=photo, caption=IslamicContent.MULK_REMINDER, parse_mode='Markdown')
-                else:
-                    await context.bot.send_message(chat_id=user[1], text=IslamicContent.MULK_REMINDER, parse_mode='Markdown')
-            except:
-                pass
+    async def send(chat_id):
+        if image_path:
+            await send_cached_photo(context.bot, chat_id, image_path, caption=IslamicContent.MULK_REMINDER, parse_mode='Markdown')
+        else:
+            await context.bot.send_message(chat_id=chat_id, text=IslamicContent.MULK_REMINDER, parse_mode='Markdown')
+    
+    await broadcast_reminder(context, 'mulk', send, 'mulk_enabled')
 
 async def send_friday_kahf(context: ContextTypes.DEFAULT_TYPE):
-    if datetime.now().weekday() == 4:
-        users = db.get_all_users()
+    tz = job_timezone(context)
+    if local_now(tz).weekday() == 4:
         pdf_path = MediaManager.get_kahf_pdf()
         
-        for user in users:
-            kahf_enabled = user[6] if len(user) > 6 else 1
-            if kahf_enabled:
-                try:
-                    if pdf_path:
-                        with open(pdf_path, 'rb') as document:
-                            await context.bot.send_document(chat_id=user[1], document=document, caption=IslamicContent.KAHF_FRIDAY, parse_mode='Markdown', filename="سورة_الكهف.pdf")
-                    else:
-                        await context.bot.send_message(chat_id=user[1], text=IslamicContent.KAHF_FRIDAY, parse_mode='Markdown')
-                except:
-                    pass
+        async def send(chat_id):
+            if pdf_path:
+                await send_cached_document(context.bot, chat_id, pdf_path, caption=IslamicContent.KAHF_FRIDAY, parse_mode='Markdown', filename="سورة_الكهف.pdf")
+            else:
+                await context.bot.send_message(chat_id=chat_id, text=IslamicContent.KAHF_FRIDAY, parse_mode='Markdown')
+        
+        await broadcast_reminder(context, 'friday_kahf', send, 'kahf_enabled')
 
-async def send_bakarah_part(context: ContextTypes.DEFAULT_TYPE, prayer_name: str):
-    users = db.get_all_users()
-    
+async def send_bakarah_part(context: ContextTypes.DEFAULT_TYPE, prayer_name: str, city: Optional[str] = None, country: Optional[str] = None):
     parts = {'Fajr': (1, 3), 'Dhuhr': (4, 6), 'Asr': (7, 9), 'Maghrib': (10, 10), 'Isha': (11, 12)}
     
     if prayer_name not in parts:
@@ -814,6 +3692,8 @@ async def send_bakarah_part(context: ContextTypes.DEFAULT_TYPE, prayer_name: str
     
     start_page, end_page = parts[prayer_name]
     images = MediaManager.get_bakarah_qiyam_images(start_page, end_page)
+    if not images:
+        return
     
     prayers_ar = {'Fajr': 'الفجر', 'Dhuhr': 'الظهر', 'Asr': 'العصر', 'Maghrib': 'المغرب', 'Isha': 'العشاء'}
     caption = f"""📗 *سورة البقرة - مصحف القيام*
@@ -824,45 +3704,66 @@ async def send_bakarah_part(context: ContextTypes.DEFAULT_TYPE, prayer_name: str
 
 صفحات {start_page}-{end_page}"""
     
-    for user in users:
-        bakarah_enabled = user[3] if len(user) > 3 else 0
-        if bakarah_enabled:
-            try:
-                media_group = []
-                for idx, image_path in enumerate(images):
-                    with open(image_path, 'rb') as photo:
-                        if idx == 0:
-                            media_group.append(InputMediaPhoto(media=photo.read(), caption=caption, parse_mode='Markdown'))
-                        else:
-                            media_group.append(InputMediaPhoto(media=photo.read()))
-                
-                if media_group:
-                    await context.bot.send_media_group(chat_id=user[1], media=media_group)
-            except:
-                pass
+    async def send(chat_id):
+        await send_cached_media_group(context.bot, chat_id, images, caption=caption, parse_mode='Markdown')
+    
+    if city:
+        chat_ids = partial(db.iter_bakarah_chat_ids, city, country)
+    else:
+        chat_ids = partial(db.iter_chat_ids, 'bakarah_enabled')
+    return await broadcaster.run(f'bakarah_{prayer_name}', chat_ids, send, context=context)
 
-async def check_islamic_occasions_daily(context: ContextTypes.DEFAULT_TYPE):
-    occasion = IslamicCalendar.check_islamic_occasions()
+def hijri_day_countries() -> dict:
+    """دولة تمثل كل فرق أيام مستخدم في HIJRI_DAY_OFFSETS (0 = أم القرى لباقي الدول)"""
+    countries = {0: None}
+    for country, offset in HIJRI_DAY_OFFSETS.items():
+        countries.setdefault(offset, country)
+    return countries
+
+async def broadcast_hijri_reminder(context: ContextTypes.DEFAULT_TYPE, name: str, messages: dict, flag: Optional[str] = None):
+    """بث رسالة تتبع التاريخ الهجري في دولة كل محادثة: messages لكل فرق أيام، و None = لا شيء في ذلك اليوم"""
+    if not any(messages.values()):
+        return
     
-    if occasion:
-        users = db.get_all_users()
-        hijri = IslamicCalendar.get_hijri_date()
+    if len(set(messages.values())) == 1:
+        text = next(iter(messages.values()))
         
-        if hijri:
-            message = f"🌙 *مناسبة إسلامية*\n\n📅 {hijri['day']} {hijri['month_name']} {hijri['year']}هـ\n\n{occasion}"
-            for user in users:
-                try:
-                    await context.bot.send_message(chat_id=user[1], text=message, parse_mode='Markdown')
-                except:
-                    pass
-
-async def send_white_days_reminder(context: ContextTypes.DEFAULT_TYPE):
-    if IslamicCalendar.is_day_before_white_days():
-        users = db.get_all_users()
-        hijri = IslamicCalendar.get_hijri_date()
+        async def send(chat_id):
+            await context.bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown')
         
-        if hijri:
-            message = f"""⚪ *تذكير: الأيام البيض*
+        await broadcast_reminder(context, name, send, flag)
+        return
+    
+    # الدولة تُقرأ مع المحادثة في نفس الاستعلام فقط إن اختلف التاريخ بين الدول
+    async def send_country(target):
+        chat_id, country = target
+        text = messages[HIJRI_DAY_OFFSETS.get(country, 0)]
+        if text:
+            await context.bot.send_message(chat_id=chat_id, text=text, parse_mode='Markdown')
+    
+    targets = partial(db.iter_window_chat_countries, flag, job_timezone(context))
+    await broadcaster.run(
+        name, targets, send_country, chat_of=lambda target: target[0], key_of=lambda target: delivery_key(target[0]),
+        context=context, window=delivery_window(name, context),
+    )
+
+def islamic_occasion_message(today: date, country: Optional[str]) -> Optional[str]:
+    occasion = IslamicCalendar.check_islamic_occasions(today, country)
+    hijri = IslamicCalendar.get_hijri_date(today, country)
+    if occasion and hijri:
+        return f"🌙 *مناسبة إسلامية*\n\n📅 {hijri['day']} {hijri['month_name']} {hijri['year']}هـ\n\n{occasion}"
+    return None
+
+async def check_islamic_occasions_daily(context: ContextTypes.DEFAULT_TYPE):
+    today = local_now(job_timezone(context)).date()
+    messages = {offset: islamic_occasion_message(today, country) for offset, country in hijri_day_countries().items()}
+    await broadcast_hijri_reminder(context, 'islamic_occasion', messages)
+
+def white_days_message(today: date, country: Optional[str]) -> Optional[str]:
+    hijri = IslamicCalendar.get_hijri_date(today, country)
+    if not hijri or not IslamicCalendar.is_day_before_white_days(today, country):
+        return None
+    return f"""⚪ *تذكير: الأيام البيض*
 
 غدًا يبدأ صيام الأيام البيض من شهر {hijri['month_name']}
 
@@ -871,113 +3772,486 @@ async def send_white_days_reminder(context: ContextTypes.DEFAULT_TYPE):
 عن أبي ذر رضي الله عنه: أمرنا رسول الله ﷺ أن نصوم من الشهر ثلاثة أيام البيض: ثلاث عشرة وأربع عشرة وخمس عشرة
 
 🤲 بارك الله في صيامك"""
-            
-            for user in users:
-                white_enabled = user[10] if len(user) > 10 else 1
-                if white_enabled:
-                    try:
-                        await context.bot.send_message(chat_id=user[1], text=message, parse_mode='Markdown')
-                    except:
-                        pass
+
+async def send_white_days_reminder(context: ContextTypes.DEFAULT_TYPE):
+    today = local_now(job_timezone(context)).date()
+    messages = {offset: white_days_message(today, country) for offset, country in hijri_day_countries().items()}
+    await broadcast_hijri_reminder(context, 'white_days', messages, 'white_days_reminder')
 
 async def send_random_dhikr(context: ContextTypes.DEFAULT_TYPE):
-    users = db.get_all_users()
     message = IslamicContent.get_random_dhikr()
     
-    for user in users:
-        try:
-            await context.bot.send_message(chat_id=user[1], text=message, parse_mode='Markdown')
-        except:
-            pass
+    async def send(chat_id):
+        await context.bot.send_message(chat_id=chat_id, text=message, parse_mode='Markdown')
+    
+    await broadcast_reminder(context, 'random_dhikr', send)
 
 async def send_qiyam_reminder(context: ContextTypes.DEFAULT_TYPE):
-    users = db.get_all_users()
+    async def send(chat_id):
+        await context.bot.send_message(chat_id=chat_id, text=IslamicContent.QIYAM_REMINDER, parse_mode='Markdown')
     
-    for user in users:
-        try:
-            await context.bot.send_message(chat_id=user[1], text=IslamicContent.QIYAM_REMINDER, parse_mode='Markdown')
-        except:
-            pass
+    await broadcast_reminder(context, 'qiyam', send)
 
 # ======================== الجدولة ========================
-async def schedule_bakarah_prayers(application):
-    users = db.get_all_users()
-    if not users:
+DEFAULT_PRAYER_TIMES = {'Fajr': '05:00', 'Dhuhr': '12:30', 'Asr': '15:45', 'Maghrib': '18:15', 'Isha': '19:45'}
+
+def next_bakarah_time(city: str, country: str, tz: int, prayer_name: str) -> datetime:
+    """موعد إرسال ورد البقرة القادم (بعد الصلاة بخمس دقائق) بتوقيت المدينة
+    
+    مواقيت aladhan تشمل التوقيت الصيفي فتُقرن بمنطقتها الزمنية، والجدول المحلي بفرق التوقيت الثابت
+    """
+    fixed_tz = timezone(timedelta(hours=tz))
+    now = datetime.now(fixed_tz)
+    
+    for day in (now.date(), now.date() + timedelta(days=1)):
+        prayer_times, city_tz = IslamicCalendar.get_prayer_times_zone(city, country, day)
+        prayer_times = prayer_times or DEFAULT_PRAYER_TIMES
+        hour, minute = map(int, prayer_times[prayer_name].split(':'))
+        # جمع الساعات على التوقيت المحلي لا العالمي، فيبقى الموعد صحيحاً في يوم تغيير الساعة
+        run_at = datetime.combine(day, datetime.min.time(), city_tz or fixed_tz) + timedelta(hours=hour, minutes=minute + 5)
+        if run_at > now:
+            return run_at
+    return run_at + timedelta(days=1)
+
+async def next_bakarah_times(city: str, country: str, tz: int, prayers) -> dict:
+    """مواعيد عدة صلوات خارج حلقة الأحداث، بعد جلب تقويم aladhan للمدن التي تحتاجه"""
+    if needs_prayer_calendar(city, country):
+        today = datetime.now(timezone(timedelta(hours=tz))).date()
+        await prayer_calendar.ensure(city, country, (today, today + timedelta(days=1)))
+    return await asyncio.to_thread(lambda: {prayer: next_bakarah_time(city, country, tz, prayer) for prayer in prayers})
+
+async def schedule_bakarah_city(job_queue, city: str, country: str, tz: int):
+    """مهمة لكل صلاة لكل مدينة، تُجدول نفسها لليوم التالي بعد كل إرسال"""
+    if job_queue is None:
         return
     
-    user = users[0]
-    city = user[11] if len(user) > 11 else 'Makkah'
-    country = user[12] if len(user) > 12 else 'Saudi Arabia'
+    names = {prayer_name: f'bakarah_{city}_{country}_{prayer_name}' for prayer_name in PrayerTimesCalculator.PRAYERS}
+    missing = [prayer_name for prayer_name, name in names.items() if not job_queue.get_jobs_by_name(name)]
+    if not missing:
+        return
     
-    prayer_times = IslamicCalendar.get_prayer_times(city, country)
+    times = await next_bakarah_times(city, country, tz, missing)
+    for prayer_name in missing:
+        # قد تكون جدولتها من طلب آخر أثناء انتظار المواعيد
+        if job_queue.get_jobs_by_name(names[prayer_name]):
+            continue
+        job_queue.run_once(
+            bakarah_job,
+            when=times[prayer_name],
+            name=names[prayer_name],
+            data={'prayer': prayer_name, 'city': city, 'country': country, 'tz': tz}
+        )
+
+async def bakarah_job(context: ContextTypes.DEFAULT_TYPE):
+    data = context.job.data
+    # المهمة المستأنفة بعد إعادة التشغيل تكمل البث فقط، فموعد الغد مجدول مسبقاً
+    if 'run_id' in data:
+        await send_bakarah_part(context, data['prayer'], data['city'], data['country'])
+        return
     
-    if not prayer_times:
-        prayer_times = {'Fajr': '05:00', 'Dhuhr': '12:30', 'Asr': '15:45', 'Maghrib': '18:15', 'Isha': '19:45'}
+    # جدولة موعد الغد قبل الإرسال حتى لا تُنشأ مهمة مكررة أثناء البث
+    times = await next_bakarah_times(data['city'], data['country'], data['tz'], [data['prayer']])
+    scheduled = context.job_queue.get_jobs_by_name(context.job.name)
+    next_job = scheduled[0] if scheduled else context.job_queue.run_once(
+        bakarah_job,
+        when=times[data['prayer']],
+        name=context.job.name,
+        data=data
+    )
+    report = await send_bakarah_part(context, data['prayer'], data['city'], data['country'])
     
+    # المدينة التي لم يبق فيها مشتركون تُحذف مهامها تلقائياً
+    if report and not report.processed:
+        next_job.schedule_removal()
+
+async def schedule_bakarah_prayers(application):
+    cities = [city async for city in db.iter_bakarah_cities()]
+    await asyncio.gather(*(
+        schedule_bakarah_city(application.job_queue, city or 'Makkah', country or 'Saudi Arabia', tz if tz is not None else 3)
+        for city, country, tz in cities
+    ))
+
+async def prefetch_prayer_calendars():
+    """تقويم aladhan لكل مدن CITIES إن كان هو المصدر، ولمدن البقرة خارج الجدول المحلي"""
+    cities = set()
+    if PRAYER_TIMES_SOURCE == 'aladhan':
+        cities.update((city, country) for city, country, _ in CITIES.values())
+    async for city, country, _ in db.iter_bakarah_cities():
+        if city and country and needs_prayer_calendar(city, country):
+            cities.add((city, country))
+    await prayer_calendar.ensure_loaded()
+    if cities:
+        available = await prayer_calendar.prefetch(sorted(cities))
+        logger.info("🕌 تقويم المواقيت: %d/%d مدينة متاحة", available, len(cities))
+
+async def prayer_calendar_job(context: ContextTypes.DEFAULT_TYPE):
+    await prefetch_prayer_calendars()
+
+async def schedule_prayer_calendar(application):
+    """فحص يومي لا يطلب إلا الأشهر الناقصة، فيكون الجلب مرة لكل مدينة في الشهر"""
     job_queue = application.job_queue
+    if job_queue is not None and not job_queue.get_jobs_by_name('prayer_calendar'):
+        check_time = datetime.strptime('03:00', '%H:%M').time().replace(tzinfo=timezone.utc)
+        job_queue.run_daily(prayer_calendar_job, time=check_time, name='prayer_calendar')
+    await prefetch_prayer_calendars()
+
+def schedule_quran_slot(job_queue, quran_time: str, tz: int):
+    """مهمة واحدة لكل (وقت ورد، فرق توقيت) بدل مهمة لكل مستخدم"""
+    if job_queue is None or not quran_time or tz is None:
+        return
     
-    for prayer_name, prayer_time in prayer_times.items():
-        try:
-            hour, minute = map(int, prayer_time.split(':'))
-            minute += 5
-            if minute >= 60:
-                minute -= 60
-                hour += 1
-            if hour >= 24:
-                hour -= 24
-            
-            time_obj = datetime.strptime(f'{hour:02d}:{minute:02d}', '%H:%M').time()
-            job_queue.run_daily(callback=lambda c, p=prayer_name: send_bakarah_part(c, p), time=time_obj, name=f'bakarah_{prayer_name}')
-        except:
-            pass
+    name = f'daily_wird_{quran_time}_tz{tz}'
+    if job_queue.get_jobs_by_name(name):
+        return
+    try:
+        time_obj = datetime.strptime(quran_time, '%H:%M').time().replace(tzinfo=timezone(timedelta(hours=tz)))
+    except ValueError:
+        logger.warning("وقت ورد غير صالح: %s", quran_time)
+        return
+    job_queue.run_daily(daily_wird_slot_job, time=time_obj, name=name, data={'quran_time': quran_time, 'tz': tz})
+
+async def daily_wird_slot_job(context: ContextTypes.DEFAULT_TYPE):
+    data = context.job.data
+    report = await broadcaster.run(
+        'daily_wird',
+        partial(db.iter_wird_targets, data['quran_time'], data['tz']),
+        partial(send_daily_wird_single, context),
+        context=context
+    )
+    
+    # الوقت الذي لم يعد أحد يختاره تُحذف مهمته
+    if not report.processed:
+        context.job.schedule_removal()
 
 async def schedule_user_quran_times(application):
-    users = db.get_all_users()
-    job_queue = application.job_queue
+    async for quran_time, tz in db.iter_quran_slots():
+        schedule_quran_slot(application.job_queue, quran_time, tz)
+
+async def refresh_chat_schedule(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    """إنشاء مهام المحادثة الناقصة فور تسجيلها أو تغيير إعداداتها دون إعادة تشغيل"""
+    settings = await db.get_chat_settings(chat_id)
+    if not settings:
+        return
     
-    for user in users:
-        user_id = user[0]
-        quran_time = user[8] if len(user) > 8 else '09:00'
-        
+    tz = settings.timezone_offset
+    schedule_timezone_bucket(context.job_queue, tz)
+    schedule_quran_slot(context.job_queue, settings.quran_time, tz)
+    if settings.bakarah_enabled:
+        await schedule_bakarah_city(context.job_queue, settings.city or 'Makkah', settings.country or 'Saudi Arabia', tz if tz is not None else 3)
+
+async def resume_broadcasts(application):
+    """استئناف عمليات البث التي قطعها إعادة تشغيل الخدمة من آخر نقطة محفوظة"""
+    await db.prune_broadcasts()
+    resuming = {
+        job.data.get('run_id') for job in application.job_queue.jobs()
+        if job.name.endswith(RESUME_JOB_SUFFIX) and isinstance(job.data, dict)
+    }
+    for run_id, job_name, callback, data, processed, age_hours in await db.get_unfinished_broadcasts():
+        job_callback = RESUMABLE_JOBS.get(callback)
+        if job_callback is None or age_hours > BROADCAST_RESUME_HOURS:
+            await db.finish_broadcast(run_id, processed, 'abandoned')
+            continue
+        if run_id in resuming:
+            continue
+        logger.info("▶️ استئناف البث %s", run_id)
+        application.job_queue.run_once(
+            job_callback, when=1, name=f'{job_name}{RESUME_JOB_SUFFIX}', data={**json.loads(data), 'run_id': run_id}
+        )
+
+# مهام التهيئة الجارية في الخلفية بعد بدء استقبال التحديثات
+startup_tasks = set()
+
+async def timed_startup_step(phase: str, step):
+    with startup_timer.measure(phase):
         try:
-            time_obj = datetime.strptime(quran_time, '%H:%M').time()
-            job_queue.run_daily(lambda c, uid=user_id: send_daily_wird_single(c, uid), time=time_obj, name=f'daily_wird_{user_id}')
-        except:
-            pass
+            await step
+        except Exception:
+            logger.exception("فشلت خطوة التشغيل %s", phase)
+
+async def start_broadcast_workers():
+    if BROADCAST_WORKERS > 0:
+        pool = BroadcastWorkerPool(BROADCAST_WORKERS)
+        await pool.start()
+        broadcaster.pool = pool
+
+async def bootstrap(application: Application):
+    """جدولة المهام واستئناف البث وتجهيز الملفات دون تأخير أول تحديث"""
+    async def schedule_then_resume():
+        # قبل تشغيل العمّال والاستئناف: طلبات البث المحفوظة في الصندوق تُسجَّل في سجل عملياتها أولاً
+        await timed_startup_step('outbox', outbox.replay(application.bot))
+        await asyncio.gather(
+            timed_startup_step('reminder jobs', setup_jobs(application)),
+            timed_startup_step('quran slots', schedule_user_quran_times(application)),
+            timed_startup_step('bakarah prayers', schedule_bakarah_prayers(application)),
+            timed_startup_step('broadcast workers', start_broadcast_workers()),
+        )
+        # الاستئناف بعد اكتمال الجدولة وتشغيل العمّال
+        await timed_startup_step('resume broadcasts', resume_broadcasts(application))
+    
+    with startup_timer.measure('bootstrap (background)'):
+        await asyncio.gather(
+            schedule_then_resume(),
+            timed_startup_step('prayer calendar', schedule_prayer_calendar(application)),
+            timed_startup_step('asset manifest', asyncio.to_thread(asset_manifest.ensure_loaded)),
+        )
+    startup_timer.report()
 
 async def post_init(application: Application) -> None:
-    await schedule_bakarah_prayers(application)
-    await schedule_user_quran_times(application)
+    startup_timer.mark('application initialize')
+    # فتح القاعدة يبدأ في خيطها، والباقي مهام خلفية لا ينتظرها استقبال التحديثات
+    db.start()
+    task = asyncio.create_task(bootstrap(application))
+    startup_tasks.add(task)
+    task.add_done_callback(startup_tasks.discard)
+    startup_timer.mark_ready()
 
-def setup_jobs(application):
+async def post_shutdown(application: Application) -> None:
+    for task in list(startup_tasks):
+        task.cancel()
+    await asyncio.gather(*startup_tasks, return_exceptions=True)
+    await outbox.flush()
+    await db.flush_progress()
+    db.close()
+    await aladhan_http.close()
+
+# التذكيرات الثابتة بالتوقيت المحلي لكل مستخدم
+FIXED_REMINDERS = {
+    'morning_azkar': ('06:00', send_morning_azkar),
+    'evening_azkar': ('17:00', send_evening_azkar),
+    'mulk': ('22:00', send_mulk),
+    'friday_kahf': ('08:00', send_friday_kahf),
+    'islamic_occasions': ('07:00', check_islamic_occasions_daily),
+    'white_days': ('20:00', send_white_days_reminder),
+    'qiyam': ('02:00', send_qiyam_reminder),
+    'random_dhikr_morning': (f'{random.randint(10, 11)}:{random.randint(0, 59):02d}', send_random_dhikr),
+    'random_dhikr_afternoon': (f'{random.randint(15, 16)}:{random.randint(0, 59):02d}', send_random_dhikr),
+}
+
+# المهام التي يمكن استئناف بثها بعد إعادة التشغيل، حسب اسم الدالة المحفوظ في سجل البث
+RESUMABLE_JOBS = {
+    callback.__name__: callback
+    for callback in [reminder[1] for reminder in FIXED_REMINDERS.values()] + [bakarah_job, daily_wird_slot_job]
+}
+
+def schedule_timezone_bucket(job_queue, tz: int):
+    """مهمة واحدة لكل تذكير لكل فرق توقيت، تعمل في الوقت المحلي لمستخدميه"""
+    if job_queue is None or tz is None:
+        return
+    
+    bucket_tz = timezone(timedelta(hours=tz))
+    for key, (local_time, callback) in FIXED_REMINDERS.items():
+        name = f'{key}_tz{tz}'
+        if job_queue.get_jobs_by_name(name):
+            continue
+        time_obj = datetime.strptime(local_time, '%H:%M').time().replace(tzinfo=bucket_tz)
+        job_queue.run_daily(callback, time=time_obj, name=name, data={'tz': tz, 'time': local_time})
+
+async def setup_jobs(application):
     job_queue = application.job_queue
     
     if job_queue is None:
         return
     
-    job_queue.run_daily(send_morning_azkar, time=datetime.strptime('06:00', '%H:%M').time())
-    job_queue.run_daily(send_evening_azkar, time=datetime.strptime('17:00', '%H:%M').time())
-    job_queue.run_daily(send_mulk, time=datetime.strptime('22:00', '%H:%M').time())
-    job_queue.run_daily(send_friday_kahf, time=datetime.strptime('08:00', '%H:%M').time())
-    job_queue.run_daily(check_islamic_occasions_daily, time=datetime.strptime('07:00', '%H:%M').time())
-    job_queue.run_daily(send_white_days_reminder, time=datetime.strptime('20:00', '%H:%M').time())
-    job_queue.run_daily(send_qiyam_reminder, time=datetime.strptime('02:00', '%H:%M').time())
-    
-    job_queue.run_daily(send_random_dhikr, time=datetime.strptime(f'{random.randint(10, 11)}:{random.randint(0, 59):02d}', '%H:%M').time())
-    job_queue.run_daily(send_random_dhikr, time=datetime.strptime(f'{random.randint(15, 16)}:{random.randint(0, 59):02d}', '%H:%M').time())
+    async for tz in db.iter_timezone_offsets():
+        schedule_timezone_bucket(job_queue, tz)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("""ℹ️ *وِرْدُ المُسْلِم*
+    await update.message.reply_text(UI.HELP_COMMAND_TEXT, parse_mode='Markdown')
 
-/start - البدء
+# ======================== معالجة التحديثات ========================
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    """معالجة تحديثات المحادثات المختلفة بالتوازي، وتحديثات المحادثة الواحدة بترتيب وصولها
+    
+    حالة ConversationHandler مفتاحها (المحادثة، المستخدم)، فتبقى صحيحة ما دامت تحديثات المحادثة لا تتداخل.
+    حد التوازي للصنف الأساسي، وهنا طابور لكل محادثة: التحديث الذي يصل ومحادثته مشغولة يُضاف إلى طابورها
+    ويحرر مكانه فوراً، وتنفذه مهمة التحديث الجاري بعد انتهائه، فلا تشغل المحادثة أكثر من مكان واحد.
+    """
+    
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # المحادثة -> طابور (coroutine، وقت الوصول) للتحديثات التي تنتظر التحديث الجاري
+        self.chats = {}
+    
+    @staticmethod
+    def chat_key(update: object) -> Optional[int]:
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+    
+    async def do_process_update(self, update: object, coroutine):
+        key = self.chat_key(update)
+        if key is None:
+            await coroutine
+            return
+        queue = self.chats.get(key)
+        if queue is not None:
+            queue.append((coroutine, time.perf_counter()))
+            return
+        
+        self.chats[key] = queue = deque([(coroutine, time.perf_counter())])
+        try:
+            while queue:
+                coroutine, queued = queue.popleft()
+                UPDATE_WAIT.observe(time.perf_counter() - queued)
+                try:
+                    await coroutine
+                except Exception:
+                    logger.exception("update for chat %s failed", key)
+        finally:
+            del self.chats[key]
+            # عند الإلغاء (إيقاف التطبيق) لا تبقى coroutines لم تُنتظر
+            for coroutine, _ in queue:
+                coroutine.close()
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
 
-📖 الورد اليومي
-📗 سورة البقرة
-☀️ أذكار والاستغفار
-🕋 سورة الكهف
-📅 المناسبات الاسلامية
+class WirdApplication(Application):
+    """Application.stop ينتظر المهام الجارية، فيُوقف البث أولاً ليحفظ موضعه بدل انتظار انتهائه،
+    ثم يُغلق صندوق الإرسال فيُحفظ ما ينتظر دوره بدل انتظار إرساله"""
+    
+    async def stop(self):
+        await broadcaster.stop()
+        await outbox.close()
+        await super().stop()
+
+# ======================== خادم webhook والمقاييس ========================
+class WebhookServer:
+    """خادم HTTP صغير يستقبل تحديثات تيليجرام ويعرض المقاييس على نفس المنفذ"""
+    
+    MAX_BODY = 1024 * 1024
+    
+    def __init__(self, application: Application, listen: str, port: int, url_path: str, secret_token: Optional[str] = None):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.url_path = '/' + url_path.lstrip('/')
+        self.secret_token = secret_token
+        self.server = None
+    
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.listen, self.port)
+    
+    async def stop(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+    
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                key, _, value = line.decode('latin-1').partition(':')
+                headers[key.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+            if length > self.MAX_BODY:
+                raise ValueError('body too large')
+            body = await reader.readexactly(length) if length else b''
+            status, content_type, payload = await self.route(method, target.split('?', 1)[0], headers, body)
+        except (ValueError, asyncio.IncompleteReadError):
+            status, content_type, payload = 400, 'text/plain', b'bad request'
+        except Exception:
+            logger.exception("خطأ في خادم webhook")
+            status, content_type, payload = 500, 'text/plain', b'error'
+        
+        reasons = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 500: 'Internal Server Error'}
+        writer.write(
+            f'HTTP/1.1 {status} {reasons[status]}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + payload
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+    
+    async def route(self, method: str, path: str, headers: dict, body: bytes):
+        if path == METRICS_PATH and method == 'GET':
+            return 200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render().encode()
+        if path == self.url_path and method == 'POST':
+            if self.secret_token and headers.get('x-telegram-bot-api-secret-token') != self.secret_token:
+                return 403, 'text/plain', b'forbidden'
+            update = Update.de_json(json.loads(body), self.application.bot)
+            await self.application.update_queue.put(update)
+            return 200, 'text/plain', b'ok'
+        if path == '/' and method in ('GET', 'HEAD'):
+            return 200, 'text/plain', b'ok'
+        return 404, 'text/plain', b'not found'
+
+async def run_webhook(application: Application):
+    """تشغيل البوت عبر webhook مع خادم المقاييس على نفس المنفذ"""
+    await application.initialize()
+    
+    # الاستماع أولاً: التحديث الذي أيقظ الخدمة ينتظر على المنفذ، و webhook مسجّل من التشغيل السابق
+    server = WebhookServer(application, "0.0.0.0", PORT, BOT_TOKEN, WEBHOOK_SECRET)
+    await server.start()
+    await application.start()
+    if application.post_init:
+        await application.post_init(application)
+    
+    await application.bot.set_webhook(
+        f"{WEBHOOK_URL}/{BOT_TOKEN}",
+        allowed_updates=Update.ALL_TYPES,
+        secret_token=WEBHOOK_SECRET
+    )
+    
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    
+    try:
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    # ردود حُفظت في صندوق الإرسال أثناء الإيقاف، وليست خطأ
+    if isinstance(context.error, SendDeferred):
+        return
+    HANDLER_ERRORS.inc(error=type(context.error).__name__)
+    logger.error("خطأ أثناء معالجة التحديث", exc_info=context.error)
 
-🤲 بارك الله فيك""", parse_mode='Markdown')
+def build_application(concurrency: int = UPDATE_CONCURRENCY) -> Application:
+    """بناء التطبيق ومعالجاته بدون تشغيله"""
+    application = (
+        Application.builder()
+        .application_class(WirdApplication)
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .rate_limiter(TelegramRateLimiter())
+        # مثل عامل البث: الطلبات الجارية محدودة بالمعدل العام، ومجمع httpx الافتراضي (256 اتصالاً)
+        # يُفحص كاملاً مع كل طلب فيستهلك المعالج تحت دفعات النقرات
+        .connection_pool_size(BROADCAST_CONCURRENCY + 4)
+        .concurrent_updates(ChatUpdateProcessor(concurrency))
+        .build()
+    )
+    
+    conv_handler = ConversationHandler(
+        entry_points=[CommandHandler('start', instrumented(start))],
+        states={SELECTING_CITY: [CallbackQueryHandler(instrumented(city_selected), pattern=r'^city_\d+$')]},
+        fallbacks=[CommandHandler('start', instrumented(start))],
+    )
+    
+    application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("help", instrumented(help_command)))
+    application.add_handler(CallbackQueryHandler(instrumented(button_callback)))
+    application.add_handler(ChatMemberHandler(instrumented(track_bot_added), ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_handler(MessageHandler(filters.StatusUpdate.MIGRATE, instrumented(track_chat_migration)))
+    application.add_error_handler(error_handler)
+    
+    return application
 
 def main():
     print("=" * 60)
@@ -988,35 +4262,22 @@ def main():
         print("\n❌ ضع التوكن")
         return
     
-    application = Application.builder().token(BOT_TOKEN).build()
-    
-    conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start)],
-        states={SELECTING_CITY: [CallbackQueryHandler(city_selected, pattern=r'^city_\d+$')]},
-        fallbacks=[CommandHandler('start', start)],
-    )
-    
-    application.add_handler(conv_handler)
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CallbackQueryHandler(button_callback))
-    application.add_handler(ChatMemberHandler(track_bot_added, ChatMemberHandler.MY_CHAT_MEMBER))
-    
+    create_directories()
+    application = build_application()
     application.post_init = post_init
-    setup_jobs(application)
+    application.post_shutdown = post_shutdown
+    startup_timer.mark('application build')
     
     print("\n🚀 البوت يعمل")
     print("=" * 60 + "\n")
     
-    # لـ Render - استخدام webhook
+    # لـ Render - استخدام webhook مع المقاييس على نفس المنفذ
     if os.environ.get("RENDER"):
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path=BOT_TOKEN,
-            webhook_url=f"https://wird-muslim-bot.onrender.com/{BOT_TOKEN}"
-        )
+        asyncio.run(run_webhook(application))
     else:
         application.run_polling(allowed_updates=Update.ALL_TYPES)
 
+startup_timer.mark('module import')
+
 if __name__ == '__main__':
     main()
\ No newline at end of file